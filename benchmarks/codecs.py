@@ -0,0 +1,99 @@
+"""
+Compare the value codecs with serializing values in Python before storing
+them as bytes (JSON, and pickle protocol 5).
+
+Each variant stores the same records in an in-memory database, reads them back
+with fetch() and with a full scan, and reports the time taken along with the
+total size of the serialized values.
+
+Usage::
+
+    python benchmarks/codecs.py [--rows N]
+"""
+import argparse
+import json
+import pickle
+import time
+
+from unqlite import UnQLite
+from unqlite import encode_value
+
+
+def make_record(i):
+    return {
+        'id': i,
+        'name': 'user-%d' % i,
+        'score': i * 0.5,
+        'active': i % 2 == 0,
+        'tags': ['alpha', 'beta', 'gamma'][:i % 4],
+        'avatar': bytes(range(i % 64)),
+    }
+
+
+def json_dumps(value):
+    # JSON has no bytes type.
+    value = dict(value, avatar=value['avatar'].hex())
+    return json.dumps(value)
+
+
+VARIANTS = [
+    ('json', None, json_dumps, json.loads),
+    ('pickle', None, pickle.dumps, pickle.loads),
+    ('codec=pickle', 'pickle', None, None),
+    ('codec=msgpack', 'msgpack', None, None),
+]
+
+
+def run(name, codec, dumps, loads, records):
+    db = UnQLite(codec=codec)
+    keys = ['record:%d' % i for i in range(len(records))]
+
+    start = time.perf_counter()
+    with db.transaction():
+        if dumps is None:
+            for key, record in zip(keys, records):
+                db.store(key, record)
+        else:
+            for key, record in zip(keys, records):
+                db.store(key, dumps(record))
+    store = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if loads is None:
+        for key in keys:
+            db.fetch(key)
+    else:
+        for key in keys:
+            loads(db.fetch(key))
+    fetch = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if loads is None:
+        for key, value in db.items():
+            pass
+    else:
+        for key, value in db.items():
+            loads(value)
+    scan = time.perf_counter() - start
+
+    if dumps is None:
+        size = sum(len(encode_value(record, codec)) for record in records)
+    else:
+        size = sum(len(dumps(record)) for record in records)
+    db.close()
+    print('%14s %8.2fs %8.2fs %8.2fs %10d' % (name, store, fetch, scan, size))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rows', type=int, default=200000)
+    args = parser.parse_args()
+
+    records = [make_record(i) for i in range(args.rows)]
+    print('%14s %9s %9s %9s %10s' % ('', 'store', 'fetch', 'scan', 'bytes'))
+    for name, codec, dumps, loads in VARIANTS:
+        run(name, codec, dumps, loads, records)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+Compare storing JSON documents one at a time with Collection.store() and in
+bulk with Collection.store_many(), in a file-backed database.
+
+Both variants run inside a single transaction, so the difference is the
+cost of compiling and executing one Jx9 VM per document rather than one per
+chunk of documents.
+
+Usage::
+
+    python benchmarks/collection_store.py [--rows N] [--chunk-size N]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from unqlite import UnQLite
+
+
+def make_record(i):
+    return {'name': 'user-%d' % i, 'age': i % 90, 'active': i % 2 == 0}
+
+
+def run(nrows, store_many, chunk_size):
+    fd, filename = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    os.unlink(filename)
+    try:
+        db = UnQLite(filename)
+        users = db.collection('users')
+        users.create()
+        records = [make_record(i) for i in range(nrows)]
+
+        start = time.perf_counter()
+        if store_many:
+            users.store_many(records, chunk_size=chunk_size)
+        else:
+            with db.transaction():
+                for record in records:
+                    users.store(record)
+        elapsed = time.perf_counter() - start
+
+        assert len(users) == nrows
+        db.close()
+        return elapsed
+    finally:
+        if os.path.exists(filename):
+            os.unlink(filename)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rows', type=int, default=100000,
+                        help='documents stored with store_many()')
+    parser.add_argument('--store-rows', type=int, default=20000,
+                        help='documents stored with store()')
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    print('%12s %10s %10s %14s' % ('method', 'documents', 'total',
+                                   'per 1k docs'))
+    for name, nrows, store_many in (('store', args.store_rows, False),
+                                    ('store_many', args.rows, True)):
+        elapsed = run(nrows, store_many, args.chunk_size)
+        print('%12s %10d %9.2fs %13.2fms' % (name, nrows, elapsed,
+                                             1000 * elapsed * 1000 / nrows))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+"""
+Compare the hash functions available to the hash-based storage engines on
+typical key patterns: sequential integers and UUID-prefixed keys.
+
+UnQLite's linear hash table picks a bucket from the low bits of a key's hash,
+so the benchmark reports how evenly each function spreads the keys over a
+power-of-two number of buckets (the largest bucket, and the ratio of the
+observed chi-square statistic to its expected value -- 1.0 for a uniformly
+random hash), followed by the time taken to load a file-backed database and
+to look up every key in random order.
+
+Usage::
+
+    python benchmarks/hash_functions.py [--rows N] [--buckets N]
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+import uuid
+
+from unqlite import UnQLite
+
+
+MASK = 0xffffffff
+
+
+def djb2(data):
+    # UnQLite's default hash function.
+    h = 5381
+    for c in data[:2048]:
+        h = (h * 33 + c) & MASK
+    return h
+
+
+def fnv1a(data):
+    h = 2166136261
+    for c in data:
+        h = ((h ^ c) * 16777619) & MASK
+    return h
+
+
+def murmur3(data):
+    def rotl(x, r):
+        return ((x << r) | (x >> (32 - r))) & MASK
+
+    c1, c2 = 0xcc9e2d51, 0x1b873593
+    h = 0
+    nblocks = len(data) // 4
+    for i in range(nblocks):
+        k = int.from_bytes(data[4 * i:4 * i + 4], 'little')
+        k = (rotl((k * c1) & MASK, 15) * c2) & MASK
+        h = (rotl(h ^ k, 13) * 5 + 0xe6546b64) & MASK
+    tail = data[4 * nblocks:]
+    if tail:
+        k = int.from_bytes(tail, 'little')
+        h ^= (rotl((k * c1) & MASK, 15) * c2) & MASK
+    h ^= len(data)
+    h ^= h >> 16
+    h = (h * 0x85ebca6b) & MASK
+    h ^= h >> 13
+    h = (h * 0xc2b2ae35) & MASK
+    h ^= h >> 16
+    return h
+
+
+HASH_FUNCTIONS = (
+    (None, djb2),
+    ('fnv1a', fnv1a),
+    ('murmur3', murmur3),
+)
+
+
+def sequential_keys(n):
+    return ['%d' % i for i in range(n)]
+
+
+def uuid_prefix_keys(n):
+    # A handful of tenant/device UUIDs, each followed by a counter.
+    rnd = random.Random(0)
+    prefixes = [str(uuid.UUID(int=rnd.getrandbits(128))) for _ in range(16)]
+    return ['%s:%d' % (prefixes[i % 16], i // 16) for i in range(n)]
+
+
+KEY_SETS = (
+    ('sequential', sequential_keys),
+    ('uuid-prefix', uuid_prefix_keys),
+)
+
+
+def distribution(keys, hash_fn, nbuckets):
+    counts = [0] * nbuckets
+    for key in keys:
+        counts[hash_fn(key.encode('utf8')) & (nbuckets - 1)] += 1
+    expected = len(keys) / nbuckets
+    chi2 = sum((c - expected) ** 2 / expected for c in counts)
+    return max(counts), chi2 / (nbuckets - 1)
+
+
+def timings(keys, hash_function):
+    fd, filename = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    os.unlink(filename)
+    lookups = list(keys)
+    random.Random(1).shuffle(lookups)
+    try:
+        db = UnQLite(filename, hash_function=hash_function)
+        start = time.perf_counter()
+        with db.transaction():
+            for key in keys:
+                db.store(key, 'v')
+        load_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for key in lookups:
+            db.fetch(key)
+        fetch_time = time.perf_counter() - start
+        db.close()
+    finally:
+        if os.path.exists(filename):
+            os.unlink(filename)
+    return load_time, fetch_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--buckets', type=int, default=4096,
+                        help='number of buckets (a power of two)')
+    args = parser.parse_args()
+
+    print('%12s %8s %11s %11s %9s %12s' % ('keys', 'hash', 'max/bucket',
+                                           'chi2 ratio', 'load',
+                                           'fetch/key'))
+    for label, make_keys in KEY_SETS:
+        keys = make_keys(args.rows)
+        for name, hash_fn in HASH_FUNCTIONS:
+            max_load, chi2 = distribution(keys, hash_fn, args.buckets)
+            load_time, fetch_time = timings(keys, name)
+            print('%12s %8s %11d %11.2f %8.2fs %10.2fus' % (
+                label, name or 'djb2', max_load, chi2, load_time,
+                1e6 * fetch_time / len(keys)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Compare prefix and range scans on the default hash storage engine and the
+ordered "btree" engine, using time-ordered keys in a file-backed database.
+
+With the hash engine every scan visits all records. The btree engine seeks
+to the first matching key and stops after the last one, so the cost of a
+scan depends on the number of records it returns rather than on the size of
+the database.
+
+Usage::
+
+    python benchmarks/ordered_scans.py [--rows N] [--scans N] [--width N]
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from unqlite import UnQLite
+
+
+def populate(filename, kv_engine, nrows, value_size):
+    db = UnQLite(filename, kv_engine=kv_engine)
+    value = 'v' * value_size
+    start = time.perf_counter()
+    with db.transaction():
+        for i in range(nrows):
+            db.store('event:%012d' % i, value)
+    elapsed = time.perf_counter() - start
+    return db, elapsed
+
+
+def run_scans(db, nrows, nscans, width):
+    rnd = random.Random(0)
+    starts = [rnd.randrange(nrows - width) for _ in range(nscans)]
+
+    start = time.perf_counter()
+    for i in starts:
+        prefix = 'event:%011d' % (i // 10)
+        for item in db.match_prefix(prefix):
+            pass
+    prefix_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in starts:
+        for item in db.range('event:%012d' % i, 'event:%012d' % (i + width)):
+            pass
+    range_time = time.perf_counter() - start
+    return prefix_time, range_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--scans', type=int, default=20)
+    parser.add_argument('--width', type=int, default=100,
+                        help='records returned by each range scan')
+    parser.add_argument('--value-size', type=int, default=64)
+    args = parser.parse_args()
+
+    print('%8s %10s %14s %14s' % ('engine', 'load', 'prefix/scan',
+                                  'range/scan'))
+    for kv_engine in ('hash', 'btree'):
+        fd, filename = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        os.unlink(filename)
+        try:
+            db, load_time = populate(filename, kv_engine, args.rows,
+                                     args.value_size)
+            prefix_time, range_time = run_scans(db, args.rows, args.scans,
+                                                args.width)
+            db.close()
+            print('%8s %9.2fs %13.2fms %13.2fms' % (
+                kv_engine, load_time,
+                1000 * prefix_time / args.scans,
+                1000 * range_time / args.scans))
+        finally:
+            if os.path.exists(filename):
+                os.unlink(filename)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""
+Compare a full scan of a file-backed database in a single process with
+parallel_scan() using an increasing number of worker processes.
+
+Each record is checked by a CPU-bound validation function (a CRC of the
+value), which is the kind of work a full-keyspace validation pass performs.
+
+Usage::
+
+    python benchmarks/parallel_scan.py [--rows N] [--value-size N]
+                                       [--kv-engine hash|btree] [--mmap]
+"""
+import argparse
+import os
+import tempfile
+import time
+import zlib
+
+from unqlite import UNQLITE_OPEN_MMAP
+from unqlite import UNQLITE_OPEN_READONLY
+from unqlite import UnQLite
+
+
+def validate(items):
+    checksum = 0
+    for key, value in items:
+        checksum ^= zlib.crc32(value)
+    return checksum
+
+
+def populate(filename, kv_engine, nrows, value_size):
+    db = UnQLite(filename, kv_engine=kv_engine)
+    value = os.urandom(value_size)
+    with db.transaction():
+        for i in range(nrows):
+            db.store('record:%012d' % i, value)
+    db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--value-size', type=int, default=1024)
+    parser.add_argument('--kv-engine', default='hash')
+    parser.add_argument('--mmap', action='store_true')
+    args = parser.parse_args()
+
+    fd, filename = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    os.unlink(filename)
+    try:
+        populate(filename, args.kv_engine, args.rows, args.value_size)
+        flags = UNQLITE_OPEN_READONLY
+        if args.mmap:
+            flags |= UNQLITE_OPEN_MMAP
+        db = UnQLite(filename, flags,
+                     kv_engine=args.kv_engine if args.kv_engine != 'hash'
+                     else None)
+
+        start = time.perf_counter()
+        expected = validate(db.items())
+        serial = time.perf_counter() - start
+        print('%8s %9.2fs' % ('serial', serial))
+
+        workers = 1
+        while workers <= (os.cpu_count() or 1):
+            start = time.perf_counter()
+            checksum = 0
+            for result in db.parallel_scan(validate, workers=workers):
+                checksum ^= result
+            elapsed = time.perf_counter() - start
+            assert checksum == expected
+            print('%8d %9.2fs %7.2fx' % (workers, elapsed, serial / elapsed))
+            workers *= 2
+        db.close()
+    finally:
+        if os.path.exists(filename):
+            os.unlink(filename)
+
+
+if __name__ == '__main__':
+    main()
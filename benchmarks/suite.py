@@ -0,0 +1,456 @@
+"""
+Benchmark suite for the key/value store, cursors, transactions, threaded
+reads and collections. Results are written as JSON so that runs made at
+different commits can be compared.
+
+Key/value operations are measured for in-memory databases, file-backed
+databases (with and without journaling) and, for reads, memory-mapped
+read-only databases, with values from 16B to 1MB. Every case is run
+`--repeat` times and the fastest run is reported.
+
+Usage::
+
+    python benchmarks/suite.py [--quick] [--repeat N] [--only PATTERN]
+                               [--output results.json]
+    python benchmarks/suite.py --compare before.json after.json
+                               [--threshold 1.1]
+
+The suite can also be run from the repository root with
+``python -m benchmarks.suite``.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from unqlite import UNQLITE_OPEN_CREATE
+from unqlite import UNQLITE_OPEN_MMAP
+from unqlite import UNQLITE_OPEN_OMIT_JOURNALING
+from unqlite import UNQLITE_OPEN_READONLY
+from unqlite import UnQLite
+
+
+# Storage modes: (file-backed, flags used to write, flags used to read).
+MODES = {
+    'mem': (False, UNQLITE_OPEN_CREATE, UNQLITE_OPEN_CREATE),
+    'file': (True, UNQLITE_OPEN_CREATE, UNQLITE_OPEN_CREATE),
+    'nojournal': (True, UNQLITE_OPEN_CREATE | UNQLITE_OPEN_OMIT_JOURNALING,
+                  UNQLITE_OPEN_CREATE | UNQLITE_OPEN_OMIT_JOURNALING),
+    'mmap': (True, UNQLITE_OPEN_CREATE,
+             UNQLITE_OPEN_READONLY | UNQLITE_OPEN_MMAP),
+}
+
+VALUE_SIZES = [16, 256, 4096, 65536, 1048576]
+
+
+class Suite(object):
+    def __init__(self, workdir, quick=False, repeat=3, only=None, seed=0):
+        self.workdir = workdir
+        self.quick = quick
+        self.repeat = repeat
+        self.only = only
+        self.seed = seed
+        self.results = []
+
+    def path(self, name='bench.db'):
+        return os.path.join(self.workdir, name)
+
+    def remove(self, name='bench.db'):
+        filename = self.path(name)
+        for path in (filename, filename + '_unqlite_journal'):
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def scale(self, n):
+        return max(1, n // 10) if self.quick else n
+
+    def measure(self, name, params, nops, run, setup=None, teardown=None):
+        """
+        Time `run(state)`, where `state` is returned by `setup()`, keeping
+        the fastest of `repeat` runs. `teardown(state)` is not timed.
+        """
+        ident = '%s[%s]' % (name, ','.join('%s=%s' % item for item in
+                                           sorted(params.items())))
+        if self.only and self.only not in ident:
+            return
+        timings = []
+        for _ in range(self.repeat):
+            state = setup() if setup is not None else None
+            try:
+                start = time.perf_counter()
+                run(state)
+                timings.append(time.perf_counter() - start)
+            finally:
+                if teardown is not None:
+                    teardown(state)
+        best = min(timings)
+        self.results.append({
+            'id': ident,
+            'name': name,
+            'params': params,
+            'ops': nops,
+            'seconds': best,
+            'timings': timings,
+            'ops_per_sec': nops / best if best else None,
+            'us_per_op': 1e6 * best / nops,
+        })
+        print('%-60s %10.2f us/op %12.0f ops/s' % (
+            ident, 1e6 * best / nops, nops / best if best else 0))
+
+    def keys(self, n, prefix='k'):
+        return ['%s%012d' % (prefix, i) for i in range(n)]
+
+    def shuffled(self, keys):
+        keys = list(keys)
+        random.Random(self.seed).shuffle(keys)
+        return keys
+
+    def populate(self, mode, keys, value, kv_engine=None):
+        file_backed, write_flags, read_flags = MODES[mode]
+        if not file_backed:
+            db = UnQLite(':mem:', kv_engine=kv_engine)
+            db.store_many((key, value) for key in keys)
+            return db
+        self.remove()
+        db = UnQLite(self.path(), write_flags, kv_engine=kv_engine)
+        db.store_many((key, value) for key in keys)
+        db.close()
+        return UnQLite(self.path(), read_flags)
+
+    # Key/value store.
+
+    def bench_kv(self):
+        sizes = [16, 4096, 1048576] if self.quick else VALUE_SIZES
+        budget = (16 if self.quick else 128) * 1024 * 1024
+        for mode in MODES:
+            for size in sizes:
+                nops = max(10, min(self.scale(20000), budget // size))
+                self.bench_kv_case(mode, size, nops)
+
+    def bench_kv_case(self, mode, size, nops):
+        file_backed, write_flags, read_flags = MODES[mode]
+        params = {'mode': mode, 'size': size}
+        value = os.urandom(size)
+        keys = self.keys(nops)
+        random_keys = self.shuffled(keys)
+
+        def open_empty():
+            if not file_backed:
+                return UnQLite(':mem:')
+            self.remove()
+            return UnQLite(self.path(), write_flags)
+
+        def populated():
+            return self.populate(mode, keys, value)
+
+        def close(db):
+            db.close()
+
+        def store(db):
+            for key in keys:
+                db.store(key, value)
+            db.commit()
+
+        def fetch(db):
+            for key in random_keys:
+                db.fetch(key)
+
+        def append(db):
+            for key in random_keys:
+                db.append(key, b'0123456789abcdef')
+            db.commit()
+
+        def delete(db):
+            for key in random_keys:
+                db.delete(key)
+            db.commit()
+
+        # Memory-mapped databases are read-only.
+        if mode != 'mmap':
+            self.measure('kv.store', params, nops, store, open_empty, close)
+        self.measure('kv.fetch', params, nops, fetch, populated, close)
+        if mode != 'mmap':
+            self.measure('kv.append', params, nops, append, populated, close)
+            self.measure('kv.delete', params, nops, delete, populated, close)
+
+    # Cursors and transactions.
+
+    def bench_cursor(self):
+        nrows = self.scale(100000)
+        keys = self.keys(nrows)
+        value = b'v' * 100
+        for mode in ('mem', 'file'):
+            for kv_engine in (None, 'btree'):
+                params = {'mode': mode, 'engine': kv_engine or 'default'}
+                db = self.populate(mode, keys, value, kv_engine)
+
+                def items(state):
+                    for _ in db.items():
+                        pass
+
+                def key_scan(state):
+                    for _ in db.keys():
+                        pass
+
+                def cursor_scan(state):
+                    with db.cursor() as cursor:
+                        for _ in cursor:
+                            pass
+
+                self.measure('cursor.items', params, nrows, items)
+                self.measure('cursor.keys', params, nrows, key_scan)
+                self.measure('cursor.iterate', params, nrows, cursor_scan)
+                if kv_engine == 'btree':
+                    # Each prefix matches 100 keys.
+                    step = max(1, nrows // 10000)
+                    prefixes = ['k%010d' % i
+                                for i in range(0, nrows // 100, step)]
+
+                    def match_prefix(state):
+                        for prefix in prefixes:
+                            for _ in db.match_prefix(prefix):
+                                pass
+
+                    self.measure('cursor.match_prefix', params,
+                                 len(prefixes), match_prefix)
+                db.close()
+
+    def bench_transactions(self):
+        nops = self.scale(5000)
+        value = b'v' * 100
+        keys = self.keys(nops)
+        for size in (1, 10, 100, 1000):
+            def setup():
+                self.remove()
+                return UnQLite(self.path())
+
+            def run(db):
+                for i in range(0, nops, size):
+                    with db.transaction():
+                        for key in keys[i:i + size]:
+                            db.store(key, value)
+
+            self.measure('transaction.store', {'ops_per_txn': size}, nops,
+                         run, setup, lambda db: db.close())
+
+    # Threaded readers.
+
+    def bench_threads(self):
+        nrows = self.scale(50000)
+        nreads = self.scale(50000)
+        keys = self.keys(nrows)
+        self.populate('file', keys, b'v' * 256).close()
+
+        def reader(barrier, seed):
+            rnd = random.Random(seed)
+            sample = [keys[rnd.randrange(nrows)] for _ in range(nreads)]
+            db = UnQLite(self.path())
+            barrier.wait()
+            for key in sample:
+                db.fetch(key)
+            db.close()
+
+        for nthreads in (1, 2, 4):
+            def setup():
+                barrier = threading.Barrier(nthreads + 1)
+                threads = [threading.Thread(target=reader,
+                                            args=(barrier, self.seed + i))
+                           for i in range(nthreads)]
+                for t in threads:
+                    t.start()
+                return barrier, threads
+
+            def run(state):
+                barrier, threads = state
+                barrier.wait()
+                for t in threads:
+                    t.join()
+
+            self.measure('threads.fetch', {'threads': nthreads},
+                         nthreads * nreads, run, setup)
+
+    # Collections.
+
+    def bench_collection(self):
+        nrecords = self.scale(5000)
+        records = [{'name': 'user-%d' % i, 'age': i % 90,
+                    'tags': ['a', 'b'][:i % 3]} for i in range(nrecords)]
+        for mode in ('mem', 'file'):
+            for vm_cache_size in (0, 16):
+                params = {'mode': mode, 'vm_cache': vm_cache_size}
+
+                def open_db():
+                    if mode == 'mem':
+                        db = UnQLite(':mem:', vm_cache_size=vm_cache_size)
+                    else:
+                        self.remove()
+                        db = UnQLite(self.path(),
+                                     vm_cache_size=vm_cache_size)
+                    users = db.collection('users')
+                    users.create()
+                    return db, users
+
+                def populated():
+                    db, users = open_db()
+                    users.store(records)
+                    return db, users
+
+                def close(state):
+                    state[0].close()
+
+                def store(state):
+                    users = state[1]
+                    for record in records[:nrecords // 10]:
+                        users.store(record)
+
+                def store_many(state):
+                    state[1].store(records)
+
+                def fetch(state):
+                    users = state[1]
+                    for i in range(nrecords // 10):
+                        users.fetch(i)
+
+                def update(state):
+                    users = state[1]
+                    for i in range(nrecords // 10):
+                        users.update(i, {'name': 'updated', 'age': 1})
+
+                def delete(state):
+                    users = state[1]
+                    for i in range(nrecords // 10):
+                        users.delete(i)
+
+                def filter_(state):
+                    state[1].filter(lambda record: record['age'] > 45)
+
+                def where(state):
+                    state[1].where(age__gt=45)
+
+                def iterate(state):
+                    for _ in state[1].iterator():
+                        pass
+
+                def all_(state):
+                    state[1].all()
+
+                n = nrecords // 10
+                self.measure('collection.store', params, n, store, open_db,
+                             close)
+                self.measure('collection.store_many', params, nrecords,
+                             store_many, open_db, close)
+                self.measure('collection.fetch', params, n, fetch, populated,
+                             close)
+                self.measure('collection.update', params, n, update,
+                             populated, close)
+                self.measure('collection.delete', params, n, delete,
+                             populated, close)
+                self.measure('collection.filter', params, nrecords, filter_,
+                             populated, close)
+                self.measure('collection.where', params, nrecords, where,
+                             populated, close)
+                self.measure('collection.iterator', params, nrecords,
+                             iterate, populated, close)
+                self.measure('collection.all', params, nrecords, all_,
+                             populated, close)
+
+    def run(self):
+        self.bench_kv()
+        self.bench_cursor()
+        self.bench_transactions()
+        self.bench_threads()
+        self.bench_collection()
+
+
+def metadata(args):
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    db = UnQLite()
+    version = db.lib_version()
+    db.close()
+    if isinstance(version, bytes):
+        version = version.decode('utf-8')
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'commit': commit,
+        'python': sys.version.split()[0],
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'unqlite': version,
+        'quick': args.quick,
+        'repeat': args.repeat,
+        'seed': args.seed,
+    }
+
+
+def compare(before_file, after_file, threshold):
+    with open(before_file) as fh:
+        before = dict((r['id'], r) for r in json.load(fh)['results'])
+    with open(after_file) as fh:
+        after = json.load(fh)['results']
+
+    regressions = 0
+    print('%-60s %10s %10s %8s' % ('benchmark', 'before', 'after', 'ratio'))
+    for result in after:
+        old = before.get(result['id'])
+        if old is None:
+            continue
+        ratio = result['us_per_op'] / old['us_per_op']
+        flag = ''
+        if ratio > threshold:
+            flag = ' slower'
+            regressions += 1
+        elif ratio < 1 / threshold:
+            flag = ' faster'
+        print('%-60s %10.2f %10.2f %7.2fx%s' % (
+            result['id'], old['us_per_op'], result['us_per_op'], ratio, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--quick', action='store_true',
+                        help='run a tenth of the operations')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', help='only run benchmarks whose id '
+                        'contains this string, e.g. "kv.fetch"')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'))
+    parser.add_argument('--threshold', type=float, default=1.1,
+                        help='ratio reported as a regression by --compare')
+    args = parser.parse_args()
+
+    if args.compare:
+        # Exit status is non-zero if any benchmark regressed.
+        sys.exit(1 if compare(args.compare[0], args.compare[1],
+                              args.threshold) else 0)
+
+    workdir = tempfile.mkdtemp(prefix='unqlite-bench-')
+    try:
+        suite = Suite(workdir, args.quick, args.repeat, args.only, args.seed)
+        suite.run()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump({'meta': metadata(args), 'results': suite.results},
+                      fh, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""
+Measure random-read throughput against a file-backed database as the number
+of reader threads increases. Each thread opens its own handle (with
+``thread_safe=True``) and performs random ``fetch()`` calls.
+
+Because the key/value calls release the GIL while UnQLite is working, the
+aggregate throughput should scale with the number of available cores.
+
+Usage::
+
+    python benchmarks/threaded_reads.py [--rows N] [--reads N] [--threads 1,2,4]
+"""
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+
+from unqlite import UnQLite
+
+
+def populate(filename, nrows, value_size):
+    db = UnQLite(filename, thread_safe=True)
+    value = 'v' * value_size
+    with db.transaction():
+        for i in range(nrows):
+            db.store('k%012d' % i, value)
+    db.close()
+
+
+def reader(filename, nrows, nreads, barrier, seed):
+    rnd = random.Random(seed)
+    keys = ['k%012d' % rnd.randrange(nrows) for _ in range(nreads)]
+    db = UnQLite(filename, thread_safe=True)
+    fetch = db.fetch
+    barrier.wait()
+    for key in keys:
+        fetch(key)
+    db.close()
+
+
+def run(filename, nrows, nreads, nthreads):
+    # The extra party is the timing thread.
+    barrier = threading.Barrier(nthreads + 1)
+    threads = [threading.Thread(target=reader,
+                                args=(filename, nrows, nreads, barrier, i))
+               for i in range(nthreads)]
+    for t in threads: t.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for t in threads: t.join()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--reads', type=int, default=100000,
+                        help='reads performed by each thread')
+    parser.add_argument('--value-size', type=int, default=256)
+    parser.add_argument('--threads', default='1,2,4,8')
+    args = parser.parse_args()
+
+    fd, filename = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    os.unlink(filename)
+    try:
+        populate(filename, args.rows, args.value_size)
+        baseline = None
+        print('%8s %12s %14s %8s' % ('threads', 'seconds', 'reads/sec',
+                                     'speedup'))
+        for nthreads in [int(n) for n in args.threads.split(',')]:
+            elapsed = run(filename, args.rows, args.reads, nthreads)
+            rate = (nthreads * args.reads) / elapsed
+            if baseline is None:
+                baseline = rate
+            print('%8d %12.3f %14.0f %7.2fx' % (nthreads, elapsed, rate,
+                                                 rate / baseline))
+    finally:
+        if os.path.exists(filename):
+            os.unlink(filename)
+
+
+if __name__ == '__main__':
+    main()
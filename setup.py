@@ -15,6 +15,7 @@ else:
     cythonize = lambda obj: obj
 
 library_source = os.path.join('src', 'unqlite.c')
+btree_source = os.path.join('src', 'btree_kv.c')
 
 if sys.platform.find('win') < 0:
     libs = ['pthread']
@@ -25,6 +26,6 @@ unqlite_extension = Extension(
     'unqlite',
     define_macros=[('UNQLITE_ENABLE_THREADS', '1')],
     libraries=libs,
-    sources=[python_source, library_source])
+    sources=[python_source, library_source, btree_source])
 
 setup(name='unqlite', ext_modules=cythonize([unqlite_extension]))
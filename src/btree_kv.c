@@ -0,0 +1,1824 @@
+/*
+ * Ordered (B+tree) Key/Value storage engine for UnQLite.
+ *
+ * The built-in engines are hash based: lookups are O(1) but records are
+ * visited in no particular order, so range and prefix scans must walk the
+ * whole database. This engine keeps records in a B+tree whose nodes live in
+ * the pages of the UnQLite pager, so journaling, transactions and rollback
+ * behave exactly as they do for the linear hash engine.
+ *
+ * Keys are ordered by memcmp(), a key sorting before any longer key it is a
+ * prefix of. Alternatively, keys can be ordered by length first and then by
+ * memcmp(), so that decimal numbers stored as strings sort numerically; the
+ * order is selected with UNQLITE_KV_CONFIG_KEY_ORDER before the database is
+ * created and is recorded in the engine header. Cursors support
+ * UNQLITE_CURSOR_MATCH_LE and _GE seeks in O(log n) and leaves are chained in
+ * both directions, so scanning k records from a seek position costs
+ * O(log n + k). UNQLITE_KV_CONFIG_PARTITION splits the leaves into disjoint
+ * sets so that several handles can scan a database in parallel; seeks are not
+ * affected.
+ *
+ * Page 1 holds the engine header. Every other page is a tree node, an
+ * overflow page holding part of a value too large to be stored in a leaf, or
+ * a free page waiting to be reused. All integers are stored big-endian.
+ *
+ * Engine header (page 1):
+ *     4 byte magic number
+ *     8 byte root page number (0 for an empty tree)
+ *     8 byte first free page
+ *     1 byte key order (UNQLITE_KV_ORDER_MEMCMP or UNQLITE_KV_ORDER_LENGTH)
+ *
+ * Node page:
+ *     1 byte page type (BT_PAGE_LEAF or BT_PAGE_INTERIOR)
+ *     2 byte number of cells
+ *     2 byte offset of the cell content area
+ *     2 byte number of fragmented free bytes in the content area
+ *     8 byte right pointer: next leaf, or right-most child of an interior node
+ *     8 byte left pointer: previous leaf (unused by interior nodes)
+ *     2 byte cell offsets, in key order
+ *
+ * Leaf cell:    2 byte key length (high bit set if the value overflows,
+ *               next bit set if it is chained), 8 byte value length, key,
+ *               value or first overflow page.
+ *
+ * Overflow values normally fill a run of consecutive pages, which have no
+ * header, so a value is stored contiguously in the database file and can be
+ * read in place from a memory map. When no free run is large enough but the
+ * free list is not empty, the value is instead chained through free pages
+ * so that the file does not grow: each chained page holds a 1 byte page type
+ * (BT_PAGE_OVFL) and the 8 byte next page number before its data.
+ *
+ * Free page:    1 byte page type (BT_PAGE_FREE), 8 byte next free run,
+ *               8 byte number of pages in this run. Freeing an overflow
+ *               value only writes the header of its first page. Runs are
+ *               allocated first-fit from the tail of a free run, looking at
+ *               a bounded number of runs before appending to the file.
+ * Interior cell: 8 byte child page, 2 byte key length, key. The child holds
+ *               the keys ordered before the cell key; keys equal to or
+ *               greater than the last cell key live under the right pointer.
+ *
+ * Deleting the last record of a leaf unlinks and frees the leaf, so scans
+ * never walk over empty pages. Nodes are not merged otherwise.
+ */
+#include <stdlib.h>
+#include <string.h>
+#include "unqlite.h"
+
+/* Engine header layout */
+#define BT_MAGIC            0x42545245 /* 'BTRE' */
+#define BT_META_PAGE        1
+#define BT_META_ROOT        4
+#define BT_META_FREE        12
+#define BT_META_ORDER       20
+/* Page types */
+#define BT_PAGE_FREE        0x00
+#define BT_PAGE_LEAF        0x01
+#define BT_PAGE_INTERIOR    0x02
+#define BT_PAGE_OVFL        0x04
+/* Node header layout */
+#define BT_NODE_NCELL       1
+#define BT_NODE_CONTENT     3
+#define BT_NODE_FRAG        5
+#define BT_NODE_RIGHT       7
+#define BT_NODE_LEFT        15
+#define BT_NODE_HDR         23
+/* Chained overflow page layout */
+#define BT_OVFL_NEXT        1
+#define BT_OVFL_HDR         9
+/* Free page layout */
+#define BT_FREE_NEXT        1
+#define BT_FREE_COUNT       9
+#define BT_FREE_HDR         17
+/* Free runs examined when looking for room for an overflow value */
+#define BT_FREE_SCAN        16
+/* Cells */
+#define BT_CELL_HDR         10
+#define BT_CELL_OVFL        0x8000
+#define BT_CELL_CHAIN       0x4000
+#define BT_CELL_FLAGS       (BT_CELL_OVFL|BT_CELL_CHAIN)
+/* Deepest tree we are willing to walk */
+#define BT_MAX_DEPTH        64
+/* Seek targets */
+#define BT_SEEK_KEY         0
+#define BT_SEEK_FIRST       1
+#define BT_SEEK_LAST        2
+
+typedef struct bt_engine bt_engine;
+typedef struct bt_cursor bt_cursor;
+typedef struct bt_path bt_path;
+
+struct bt_engine
+{
+	const unqlite_kv_io *pIo;   /* IO methods: MUST be first */
+	int nPageSize;              /* Pager page size */
+	int nUsable;                /* Bytes of a page addressable by a node */
+	int nMaxCell;               /* Largest cell (including its offset) a node accepts */
+	unsigned char *zScratch;    /* Work area used to split and defragment nodes */
+	unsigned char *zCell;       /* Cell on its way into a node */
+	int *aOfft;                 /* Offsets of the cells gathered in zScratch */
+	int *aSize;                 /* Sizes of the cells gathered in zScratch */
+	int nAlloc;                 /* Page size the buffers above were allocated for */
+	int iOrder;                 /* Key order, UNQLITE_KV_ORDER_* */
+	int bOrderSet;              /* True if iOrder was configured by the caller */
+	int iPart;                  /* Partition visited by cursor scans */
+	int nPart;                  /* Number of partitions, 0 or 1 to scan every leaf */
+};
+
+struct bt_cursor
+{
+	unqlite_kv_engine *pStore;  /* Must be first */
+	pgno iLeaf;                 /* Current leaf, 0 when not pointing to a record */
+	int iCell;                  /* Index of the current cell on that leaf */
+	int bFirst;                 /* Not positioned yet, see btCursorFirstUse() */
+};
+
+/* A node visited on the way from the root to a leaf */
+struct bt_path
+{
+	unqlite_page *pPage;        /* The node */
+	int iIdx;                   /* Child (interior) or cell (leaf) index taken */
+	int bRight;                 /* True if the node is the right-most of its level */
+};
+
+static unsigned int bt_get16(const unsigned char *z)
+{
+	return ((unsigned int)z[0] << 8) | z[1];
+}
+static void bt_put16(unsigned char *z,unsigned int v)
+{
+	z[0] = (unsigned char)(v >> 8);
+	z[1] = (unsigned char)v;
+}
+static unsigned int bt_get32(const unsigned char *z)
+{
+	return ((unsigned int)z[0] << 24) | ((unsigned int)z[1] << 16) | ((unsigned int)z[2] << 8) | z[3];
+}
+static void bt_put32(unsigned char *z,unsigned int v)
+{
+	z[0] = (unsigned char)(v >> 24);
+	z[1] = (unsigned char)(v >> 16);
+	z[2] = (unsigned char)(v >> 8);
+	z[3] = (unsigned char)v;
+}
+static sxu64 bt_get64(const unsigned char *z)
+{
+	return ((sxu64)bt_get32(z) << 32) | bt_get32(&z[4]);
+}
+static void bt_put64(unsigned char *z,sxu64 v)
+{
+	bt_put32(z,(unsigned int)(v >> 32));
+	bt_put32(&z[4],(unsigned int)v);
+}
+/*
+ * Compare two keys. Shorter keys sort before longer keys sharing a prefix,
+ * or before any longer key if the tree is ordered by length first.
+ */
+static int btCompare(int iOrder,const unsigned char *zA,int nA,const unsigned char *zB,int nB)
+{
+	int rc = 0;
+	if( iOrder == UNQLITE_KV_ORDER_LENGTH && nA != nB ){
+		return nA - nB;
+	}
+	if( nA > 0 && nB > 0 ){
+		rc = memcmp(zA,zB,(size_t)(nA < nB ? nA : nB));
+	}
+	return rc != 0 ? rc : nA - nB;
+}
+/*
+ * Node accessors.
+ */
+static int btNodeCount(const unsigned char *zNode)
+{
+	return (int)bt_get16(&zNode[BT_NODE_NCELL]);
+}
+static unsigned char * btCellPtr(unsigned char *zNode,int iCell)
+{
+	return &zNode[bt_get16(&zNode[BT_NODE_HDR + 2 * iCell])];
+}
+static int btCellKey(const unsigned char *zNode,const unsigned char *zCell,const unsigned char **pzKey)
+{
+	*pzKey = &zCell[BT_CELL_HDR];
+	if( zNode[0] == BT_PAGE_LEAF ){
+		return (int)(bt_get16(zCell) & ~BT_CELL_FLAGS);
+	}
+	return (int)bt_get16(&zCell[8]);
+}
+static int btCellSize(const unsigned char *zNode,const unsigned char *zCell)
+{
+	unsigned int nKey;
+	if( zNode[0] != BT_PAGE_LEAF ){
+		return BT_CELL_HDR + (int)bt_get16(&zCell[8]);
+	}
+	nKey = bt_get16(zCell);
+	if( nKey & BT_CELL_OVFL ){
+		return BT_CELL_HDR + (int)(nKey & ~BT_CELL_FLAGS) + 8;
+	}
+	return BT_CELL_HDR + (int)nKey + (int)bt_get64(&zCell[2]);
+}
+static pgno btChild(unsigned char *zNode,int iIdx)
+{
+	if( iIdx < btNodeCount(zNode) ){
+		return (pgno)bt_get64(btCellPtr(zNode,iIdx));
+	}
+	return (pgno)bt_get64(&zNode[BT_NODE_RIGHT]);
+}
+/*
+ * Return the index of the first cell whose key is greater than or equal to
+ * the given key, setting *pFound if the keys are equal.
+ */
+static int btNodeSearch(int iOrder,unsigned char *zNode,const unsigned char *zKey,int nKey,int *pFound)
+{
+	const unsigned char *zCellKey;
+	int iLo = 0,iHi = btNodeCount(zNode);
+	int iMid,nCellKey,rc;
+	*pFound = 0;
+	while( iLo < iHi ){
+		iMid = (iLo + iHi) / 2;
+		nCellKey = btCellKey(zNode,btCellPtr(zNode,iMid),&zCellKey);
+		rc = btCompare(iOrder,zCellKey,nCellKey,zKey,nKey);
+		if( rc < 0 ){
+			iLo = iMid + 1;
+		}else{
+			if( rc == 0 ){
+				*pFound = 1;
+			}
+			iHi = iMid;
+		}
+	}
+	return iLo;
+}
+static void btNodeInit(bt_engine *pBt,unsigned char *zNode,int iType)
+{
+	memset(zNode,0,BT_NODE_HDR);
+	zNode[0] = (unsigned char)iType;
+	bt_put16(&zNode[BT_NODE_CONTENT],(unsigned int)pBt->nUsable);
+}
+/*
+ * Append a cell to a node under construction.
+ */
+static void btNodeAppend(unsigned char *zNode,const unsigned char *zCell,int nCell)
+{
+	int n = btNodeCount(zNode);
+	int iContent = (int)bt_get16(&zNode[BT_NODE_CONTENT]) - nCell;
+	memcpy(&zNode[iContent],zCell,(size_t)nCell);
+	bt_put16(&zNode[BT_NODE_HDR + 2 * n],(unsigned int)iContent);
+	bt_put16(&zNode[BT_NODE_NCELL],(unsigned int)(n + 1));
+	bt_put16(&zNode[BT_NODE_CONTENT],(unsigned int)iContent);
+}
+/*
+ * Pack the cells of a node at the end of the page, reclaiming the space
+ * left behind by removed cells.
+ */
+static void btNodeDefragment(bt_engine *pBt,unsigned char *zNode)
+{
+	int i,n = btNodeCount(zNode);
+	int iContent = pBt->nUsable;
+	unsigned char *zCell;
+	int nSize;
+	for( i = 0 ; i < n ; ++i ){
+		zCell = btCellPtr(zNode,i);
+		nSize = btCellSize(zNode,zCell);
+		iContent -= nSize;
+		memcpy(&pBt->zScratch[iContent],zCell,(size_t)nSize);
+		bt_put16(&zNode[BT_NODE_HDR + 2 * i],(unsigned int)iContent);
+	}
+	memcpy(&zNode[iContent],&pBt->zScratch[iContent],(size_t)(pBt->nUsable - iContent));
+	bt_put16(&zNode[BT_NODE_CONTENT],(unsigned int)iContent);
+	bt_put16(&zNode[BT_NODE_FRAG],0);
+}
+/*
+ * Insert a cell at the given index. Return UNQLITE_FULL if the node does not
+ * have room for it and must be split.
+ */
+static int btNodeInsert(bt_engine *pBt,unsigned char *zNode,int iIdx,const unsigned char *zCell,int nCell)
+{
+	int n = btNodeCount(zNode);
+	int iContent = (int)bt_get16(&zNode[BT_NODE_CONTENT]);
+	int nFree = iContent - (BT_NODE_HDR + 2 * n);
+	if( nFree < nCell + 2 ){
+		if( nFree + (int)bt_get16(&zNode[BT_NODE_FRAG]) < nCell + 2 ){
+			return UNQLITE_FULL;
+		}
+		btNodeDefragment(pBt,zNode);
+		iContent = (int)bt_get16(&zNode[BT_NODE_CONTENT]);
+	}
+	iContent -= nCell;
+	memcpy(&zNode[iContent],zCell,(size_t)nCell);
+	memmove(&zNode[BT_NODE_HDR + 2 * (iIdx + 1)],&zNode[BT_NODE_HDR + 2 * iIdx],(size_t)(2 * (n - iIdx)));
+	bt_put16(&zNode[BT_NODE_HDR + 2 * iIdx],(unsigned int)iContent);
+	bt_put16(&zNode[BT_NODE_NCELL],(unsigned int)(n + 1));
+	bt_put16(&zNode[BT_NODE_CONTENT],(unsigned int)iContent);
+	return UNQLITE_OK;
+}
+/*
+ * Remove the cell at the given index.
+ */
+static void btNodeDropCell(bt_engine *pBt,unsigned char *zNode,int iIdx)
+{
+	int n = btNodeCount(zNode);
+	int iOfft = (int)bt_get16(&zNode[BT_NODE_HDR + 2 * iIdx]);
+	int nSize = btCellSize(zNode,&zNode[iOfft]);
+	memmove(&zNode[BT_NODE_HDR + 2 * iIdx],&zNode[BT_NODE_HDR + 2 * (iIdx + 1)],(size_t)(2 * (n - iIdx - 1)));
+	n--;
+	bt_put16(&zNode[BT_NODE_NCELL],(unsigned int)n);
+	if( n == 0 ){
+		bt_put16(&zNode[BT_NODE_CONTENT],(unsigned int)pBt->nUsable);
+		bt_put16(&zNode[BT_NODE_FRAG],0);
+	}else if( iOfft == (int)bt_get16(&zNode[BT_NODE_CONTENT]) ){
+		bt_put16(&zNode[BT_NODE_CONTENT],(unsigned int)(iOfft + nSize));
+	}else{
+		bt_put16(&zNode[BT_NODE_FRAG],bt_get16(&zNode[BT_NODE_FRAG]) + (unsigned int)nSize);
+	}
+}
+/*
+ * Size the work buffers for the page size in use. The page size is only
+ * final once the pager has read the database header, so this is called
+ * after the engine header has been loaded.
+ */
+static int btGeometry(bt_engine *pBt)
+{
+	int nPage = pBt->pIo->xPageSize(pBt->pIo->pHandle);
+	if( nPage != pBt->nAlloc ){
+		int nCell = nPage / 8 + 2;
+		free(pBt->zScratch);
+		free(pBt->aOfft);
+		pBt->zScratch = (unsigned char *)malloc((size_t)nPage * 3);
+		pBt->aOfft = (int *)malloc(sizeof(int) * 2 * (size_t)nCell);
+		if( pBt->zScratch == 0 || pBt->aOfft == 0 ){
+			free(pBt->zScratch);
+			free(pBt->aOfft);
+			pBt->zScratch = 0;
+			pBt->aOfft = 0;
+			pBt->nAlloc = 0;
+			return UNQLITE_NOMEM;
+		}
+		pBt->zCell = &pBt->zScratch[nPage * 2];
+		pBt->aSize = &pBt->aOfft[nCell];
+		pBt->nAlloc = nPage;
+	}
+	pBt->nPageSize = nPage;
+	pBt->nUsable = nPage > 0xFFFF ? 0xFFFF : nPage;
+	/* At least four cells fit in a node, so a split always leaves both
+	 * halves with room to spare.
+	 */
+	pBt->nMaxCell = (pBt->nUsable - BT_NODE_HDR) / 4;
+	return UNQLITE_OK;
+}
+/*
+ * Largest key the engine accepts: a leaf cell with an overflowing value
+ * must not exceed nMaxCell.
+ */
+static int btMaxKey(bt_engine *pBt)
+{
+	return pBt->nMaxCell - 2 - BT_CELL_HDR - 8;
+}
+/*
+ * Load the engine header, optionally making it writable.
+ */
+static int btOpenMeta(bt_engine *pBt,int bWrite,unqlite_page **ppMeta)
+{
+	const unqlite_kv_io *pIo = pBt->pIo;
+	unqlite_page *pMeta;
+	unsigned int iMagic;
+	int rc;
+	rc = pIo->xGet(pIo->pHandle,BT_META_PAGE,&pMeta);
+	if( rc != UNQLITE_OK ){
+		return rc;
+	}
+	rc = btGeometry(pBt);
+	if( rc != UNQLITE_OK ){
+		pIo->xPageUnref(pMeta);
+		return rc;
+	}
+	iMagic = bt_get32(pMeta->zData);
+	if( iMagic != BT_MAGIC && iMagic != 0 ){
+		pIo->xPageUnref(pMeta);
+		pIo->xErr(pIo->pHandle,"Malformed B+tree header");
+		return UNQLITE_CORRUPT;
+	}
+	if( iMagic == BT_MAGIC ){
+		if( pBt->bOrderSet && pBt->iOrder != pMeta->zData[BT_META_ORDER] ){
+			pIo->xPageUnref(pMeta);
+			pIo->xErr(pIo->pHandle,"Key order does not match the database");
+			return UNQLITE_INVALID;
+		}
+		pBt->iOrder = pMeta->zData[BT_META_ORDER];
+	}
+	if( bWrite ){
+		rc = pIo->xWrite(pMeta);
+		if( rc != UNQLITE_OK ){
+			pIo->xPageUnref(pMeta);
+			return rc;
+		}
+		if( iMagic == 0 ){
+			/* A new database */
+			memset(pMeta->zData,0,BT_META_ORDER + 1);
+			bt_put32(pMeta->zData,BT_MAGIC);
+			pMeta->zData[BT_META_ORDER] = (unsigned char)pBt->iOrder;
+		}
+	}
+	*ppMeta = pMeta;
+	return UNQLITE_OK;
+}
+/*
+ * Load the free run starting at page iFree and return its length.
+ */
+static int btGetFreeRun(bt_engine *pBt,pgno iFree,unqlite_page **ppPage,sxu64 *pCount)
+{
+	const unqlite_kv_io *pIo = pBt->pIo;
+	unqlite_page *pPage;
+	int rc;
+	rc = pIo->xGet(pIo->pHandle,iFree,&pPage);
+	if( rc != UNQLITE_OK ){
+		return rc;
+	}
+	*pCount = bt_get64(&pPage->zData[BT_FREE_COUNT]);
+	if( pPage->zData[0] != BT_PAGE_FREE || *pCount < 1 ){
+		pIo->xPageUnref(pPage);
+		pIo->xErr(pIo->pHandle,"Malformed B+tree free list");
+		return UNQLITE_CORRUPT;
+	}
+	*ppPage = pPage;
+	return UNQLITE_OK;
+}
+/*
+ * Take nPage pages from a free run of nCount pages whose first page is
+ * pFree: the run shrinks from its tail, or is unlinked if nothing remains.
+ * pPrev is the page linking to the run (the engine header for the first
+ * run). Return the first page taken.
+ */
+static int btTakeFreeRun(bt_engine *pBt,unqlite_page *pPrev,unqlite_page *pFree,sxu64 nCount,sxu64 nPage,pgno *pFirst)
+{
+	const unqlite_kv_io *pIo = pBt->pIo;
+	int rc;
+	if( nCount > nPage ){
+		rc = pIo->xWrite(pFree);
+		if( rc != UNQLITE_OK ){
+			return rc;
+		}
+		bt_put64(&pFree->zData[BT_FREE_COUNT],nCount - nPage);
+		*pFirst = pFree->iPage + (pgno)(nCount - nPage);
+	}else{
+		rc = pIo->xWrite(pPrev);
+		if( rc != UNQLITE_OK ){
+			return rc;
+		}
+		memcpy(&pPrev->zData[pPrev->iPage == BT_META_PAGE ? BT_META_FREE : BT_FREE_NEXT],
+			&pFree->zData[BT_FREE_NEXT],8);
+		*pFirst = pFree->iPage;
+	}
+	return UNQLITE_OK;
+}
+/*
+ * Allocate a writable, zeroed page, reusing a free page if there is one.
+ */
+static int btAllocPage(bt_engine *pBt,unqlite_page *pMeta,unqlite_page **ppPage)
+{
+	const unqlite_kv_io *pIo = pBt->pIo;
+	unqlite_page *pPage,*pFree;
+	sxu64 nCount;
+	pgno iFree;
+	int rc;
+	iFree = (pgno)bt_get64(&pMeta->zData[BT_META_FREE]);
+	if( iFree ){
+		rc = btGetFreeRun(pBt,iFree,&pFree,&nCount);
+		if( rc != UNQLITE_OK ){
+			return rc;
+		}
+		rc = btTakeFreeRun(pBt,pMeta,pFree,nCount,1,&iFree);
+		if( rc != UNQLITE_OK ){
+			pIo->xPageUnref(pFree);
+			return rc;
+		}
+		if( iFree == pFree->iPage ){
+			pPage = pFree;
+		}else{
+			pIo->xPageUnref(pFree);
+			rc = pIo->xGet(pIo->pHandle,iFree,&pPage);
+			if( rc != UNQLITE_OK ){
+				return rc;
+			}
+		}
+	}else{
+		rc = pIo->xNew(pIo->pHandle,&pPage);
+		if( rc != UNQLITE_OK ){
+			return rc;
+		}
+	}
+	rc = pIo->xWrite(pPage);
+	if( rc != UNQLITE_OK ){
+		pIo->xPageUnref(pPage);
+		return rc;
+	}
+	memset(pPage->zData,0,(size_t)pBt->nPageSize);
+	*ppPage = pPage;
+	return UNQLITE_OK;
+}
+/*
+ * Put the run of nPage pages starting at pPage on the free list. The run is
+ * merged with an adjacent free run if one is found among the first
+ * BT_FREE_SCAN runs, so that freed overflow values leave room for larger
+ * ones. The caller keeps its reference.
+ */
+static int btFreeRunPage(bt_engine *pBt,unqlite_page *pMeta,unqlite_page *pPage,sxu64 nPage)
+{
+	const unqlite_kv_io *pIo = pBt->pIo;
+	unqlite_page *pPrev = pMeta,*pFree;
+	sxu64 nCount;
+	pgno iFree;
+	int i,rc;
+	iFree = (pgno)bt_get64(&pMeta->zData[BT_META_FREE]);
+	for( i = 0 ; iFree && i < BT_FREE_SCAN ; ++i ){
+		rc = btGetFreeRun(pBt,iFree,&pFree,&nCount);
+		if( rc != UNQLITE_OK ){
+			goto end;
+		}
+		if( pFree->iPage + (pgno)nCount == pPage->iPage ){
+			/* Extend the preceding run */
+			rc = pIo->xWrite(pFree);
+			if( rc == UNQLITE_OK ){
+				bt_put64(&pFree->zData[BT_FREE_COUNT],nCount + nPage);
+			}
+			pIo->xPageUnref(pFree);
+			goto end;
+		}
+		if( pPage->iPage + (pgno)nPage == pFree->iPage ){
+			/* Unlink the following run and absorb it */
+			rc = pIo->xWrite(pPrev);
+			if( rc != UNQLITE_OK ){
+				pIo->xPageUnref(pFree);
+				goto end;
+			}
+			memcpy(&pPrev->zData[pPrev == pMeta ? BT_META_FREE : BT_FREE_NEXT],
+				&pFree->zData[BT_FREE_NEXT],8);
+			nPage += nCount;
+			pIo->xPageUnref(pFree);
+			break;
+		}
+		iFree = (pgno)bt_get64(&pFree->zData[BT_FREE_NEXT]);
+		if( pPrev != pMeta ){
+			pIo->xPageUnref(pPrev);
+		}
+		pPrev = pFree;
+	}
+	rc = pIo->xWrite(pPage);
+	if( rc != UNQLITE_OK ){
+		goto end;
+	}
+	memset(pPage->zData,0,BT_FREE_HDR);
+	pPage->zData[0] = BT_PAGE_FREE;
+	memcpy(&pPage->zData[BT_FREE_NEXT],&pMeta->zData[BT_META_FREE],8);
+	bt_put64(&pPage->zData[BT_FREE_COUNT],nPage);
+	bt_put64(&pMeta->zData[BT_META_FREE],pPage->iPage);
+end:
+	if( pPrev != pMeta ){
+		pIo->xPageUnref(pPrev);
+	}
+	return rc;
+}
+/*
+ * Put a page on the free list. The caller keeps its reference.
+ */
+static int btFreePage(bt_engine *pBt,unqlite_page *pMeta,unqlite_page *pPage)
+{
+	return btFreeRunPage(pBt,pMeta,pPage,1);
+}
+/*
+ * Put the pages [iFirst,iFirst+nPage) of an overflow run on the free list.
+ */
+static int btFreeRun(bt_engine *pBt,unqlite_page *pMeta,pgno iFirst,sxu64 nPage)
+{
+	const unqlite_kv_io *pIo = pBt->pIo;
+	unqlite_page *pPage;
+	int rc;
+	if( nPage < 1 ){
+		return UNQLITE_OK;
+	}
+	rc = pIo->xGet(pIo->pHandle,iFirst,&pPage);
+	if( rc != UNQLITE_OK ){
+		return rc;
+	}
+	rc = btFreeRunPage(pBt,pMeta,pPage,nPage);
+	pIo->xPageUnref(pPage);
+	return rc;
+}
+/*
+ * Find nPage consecutive free pages, first-fit among the first BT_FREE_SCAN
+ * free runs. *pFirst is left to zero if there is no room.
+ */
+static int btAllocRun(bt_engine *pBt,unqlite_page *pMeta,sxu64 nPage,pgno *pFirst)
+{
+	const unqlite_kv_io *pIo = pBt->pIo;
+	unqlite_page *pPrev = pMeta,*pFree;
+	sxu64 nCount;
+	pgno iFree;
+	int i,rc = UNQLITE_OK;
+	*pFirst = 0;
+	iFree = (pgno)bt_get64(&pMeta->zData[BT_META_FREE]);
+	for( i = 0 ; iFree && i < BT_FREE_SCAN ; ++i ){
+		rc = btGetFreeRun(pBt,iFree,&pFree,&nCount);
+		if( rc != UNQLITE_OK ){
+			break;
+		}
+		if( nCount >= nPage ){
+			rc = btTakeFreeRun(pBt,pPrev,pFree,nCount,nPage,pFirst);
+			pIo->xPageUnref(pFree);
+			break;
+		}
+		iFree = (pgno)bt_get64(&pFree->zData[BT_FREE_NEXT]);
+		if( pPrev != pMeta ){
+			pIo->xPageUnref(pPrev);
+		}
+		pPrev = pFree;
+	}
+	if( pPrev != pMeta ){
+		pIo->xPageUnref(pPrev);
+	}
+	return rc;
+}
+/*
+ * Number of overflow pages holding a value of the given size.
+ */
+static sxu64 btOverflowPages(bt_engine *pBt,sxu64 nData)
+{
+	return (nData + pBt->nPageSize - 1) / (sxu64)pBt->nPageSize;
+}
+/*
+ * Store a value in a chain of overflow pages taken from the free list.
+ */
+static int btWriteChain(bt_engine *pBt,unqlite_page *pMeta,const unsigned char *zData,sxu64 nData,pgno *pFirst)
+{
+	const unqlite_kv_io *pIo = pBt->pIo;
+	unqlite_page *pPrev = 0,*pPage;
+	sxu64 nCap = (sxu64)(pBt->nPageSize - BT_OVFL_HDR);
+	sxu64 n;
+	int rc;
+	*pFirst = 0;
+	while( nData > 0 ){
+		rc = btAllocPage(pBt,pMeta,&pPage);
+		if( rc != UNQLITE_OK ){
+			if( pPrev ){
+				pIo->xPageUnref(pPrev);
+			}
+			return rc;
+		}
+		pPage->zData[0] = BT_PAGE_OVFL;
+		n = nData < nCap ? nData : nCap;
+		memcpy(&pPage->zData[BT_OVFL_HDR],zData,(size_t)n);
+		if( pPrev ){
+			bt_put64(&pPrev->zData[BT_OVFL_NEXT],pPage->iPage);
+			pIo->xPageUnref(pPrev);
+		}else{
+			*pFirst = pPage->iPage;
+		}
+		pPrev = pPage;
+		zData += n;
+		nData -= n;
+	}
+	if( pPrev ){
+		pIo->xPageUnref(pPrev);
+	}
+	return UNQLITE_OK;
+}
+/*
+ * Store a value too large for a leaf. If iFirst is not zero, the value
+ * overwrites the run of pages starting at iFirst. Otherwise a run is taken
+ * from the free list, or the value is chained through free pages if there
+ * is no room for it, or the run is appended to the file if the free list is
+ * empty. *pbChain is set if the value was chained.
+ */
+static int btWriteOverflow(bt_engine *pBt,unqlite_page *pMeta,pgno iFirst,const unsigned char *zData,sxu64 nData,pgno *pFirst,int *pbChain)
+{
+	const unqlite_kv_io *pIo = pBt->pIo;
+	sxu64 nPage = btOverflowPages(pBt,nData);
+	sxu64 i,n;
+	unqlite_page *pPage;
+	int bAppend,rc;
+	*pbChain = 0;
+	if( iFirst == 0 ){
+		rc = btAllocRun(pBt,pMeta,nPage,&iFirst);
+		if( rc != UNQLITE_OK ){
+			return rc;
+		}
+		if( iFirst == 0 && bt_get64(&pMeta->zData[BT_META_FREE]) ){
+			*pbChain = 1;
+			return btWriteChain(pBt,pMeta,zData,nData,pFirst);
+		}
+	}
+	bAppend = iFirst == 0;
+	*pFirst = iFirst;
+	for( i = 0 ; i < nPage ; ++i ){
+		if( bAppend ){
+			rc = pIo->xNew(pIo->pHandle,&pPage);
+		}else{
+			rc = pIo->xGet(pIo->pHandle,iFirst + (pgno)i,&pPage);
+		}
+		if( rc != UNQLITE_OK ){
+			return rc;
+		}
+		rc = pIo->xWrite(pPage);
+		if( rc != UNQLITE_OK ){
+			pIo->xPageUnref(pPage);
+			return rc;
+		}
+		if( i == 0 ){
+			*pFirst = pPage->iPage;
+		}else if( pPage->iPage != *pFirst + (pgno)i ){
+			pIo->xPageUnref(pPage);
+			pIo->xErr(pIo->pHandle,"Cannot allocate consecutive B+tree overflow pages");
+			return UNQLITE_CORRUPT;
+		}
+		n = nData < (sxu64)pBt->nPageSize ? nData : (sxu64)pBt->nPageSize;
+		memcpy(pPage->zData,zData,(size_t)n);
+		if( n < (sxu64)pBt->nPageSize ){
+			memset(&pPage->zData[n],0,(size_t)(pBt->nPageSize - n));
+		}
+		pIo->xPageUnref(pPage);
+		zData += n;
+		nData -= n;
+	}
+	return UNQLITE_OK;
+}
+/*
+ * Release the overflow pages holding the value of a leaf cell.
+ */
+static int btFreeOverflow(bt_engine *pBt,unqlite_page *pMeta,const unsigned char *zCell)
+{
+	const unqlite_kv_io *pIo = pBt->pIo;
+	unsigned int nKey = bt_get16(zCell);
+	unqlite_page *pPage;
+	pgno iNext;
+	int rc;
+	if( !(nKey & BT_CELL_OVFL) ){
+		return UNQLITE_OK;
+	}
+	iNext = (pgno)bt_get64(&zCell[BT_CELL_HDR + (nKey & ~BT_CELL_FLAGS)]);
+	if( !(nKey & BT_CELL_CHAIN) ){
+		return btFreeRun(pBt,pMeta,iNext,btOverflowPages(pBt,bt_get64(&zCell[2])));
+	}
+	while( iNext ){
+		rc = pIo->xGet(pIo->pHandle,iNext,&pPage);
+		if( rc != UNQLITE_OK ){
+			return rc;
+		}
+		if( pPage->zData[0] != BT_PAGE_OVFL ){
+			pIo->xPageUnref(pPage);
+			pIo->xErr(pIo->pHandle,"Malformed B+tree overflow page");
+			return UNQLITE_CORRUPT;
+		}
+		iNext = (pgno)bt_get64(&pPage->zData[BT_OVFL_NEXT]);
+		rc = btFreePage(pBt,pMeta,pPage);
+		pIo->xPageUnref(pPage);
+		if( rc != UNQLITE_OK ){
+			return rc;
+		}
+	}
+	return UNQLITE_OK;
+}
+/*
+ * Feed the value of a leaf cell to a consumer callback.
+ */
+static int btConsumeData(bt_engine *pBt,const unsigned char *zCell,int (*xConsumer)(const void *,unsigned int,void *),void *pUserData)
+{
+	const unqlite_kv_io *pIo = pBt->pIo;
+	unsigned int nKey = bt_get16(zCell);
+	sxu64 nData = bt_get64(&zCell[2]);
+	sxu64 nPageSize,n;
+	unqlite_page *pPage;
+	int bChain,rc;
+	pgno iPage;
+	if( !(nKey & BT_CELL_OVFL) ){
+		rc = xConsumer(&zCell[BT_CELL_HDR + nKey],(unsigned int)nData,pUserData);
+		return rc != UNQLITE_OK ? UNQLITE_ABORT : UNQLITE_OK;
+	}
+	bChain = (nKey & BT_CELL_CHAIN) != 0;
+	nKey &= ~BT_CELL_FLAGS;
+	nPageSize = (sxu64)pIo->xPageSize(pIo->pHandle);
+	iPage = (pgno)bt_get64(&zCell[BT_CELL_HDR + nKey]);
+	while( nData > 0 && iPage ){
+		rc = pIo->xGet(pIo->pHandle,iPage,&pPage);
+		if( rc != UNQLITE_OK ){
+			return rc;
+		}
+		if( bChain ){
+			n = nData < nPageSize - BT_OVFL_HDR ? nData : nPageSize - BT_OVFL_HDR;
+			rc = xConsumer(&pPage->zData[BT_OVFL_HDR],(unsigned int)n,pUserData);
+			iPage = (pgno)bt_get64(&pPage->zData[BT_OVFL_NEXT]);
+		}else{
+			n = nData < nPageSize ? nData : nPageSize;
+			rc = xConsumer(pPage->zData,(unsigned int)n,pUserData);
+			iPage++;
+		}
+		pIo->xPageUnref(pPage);
+		if( rc != UNQLITE_OK ){
+			return UNQLITE_ABORT;
+		}
+		nData -= n;
+	}
+	return UNQLITE_OK;
+}
+static void btReleasePath(bt_engine *pBt,bt_path *aPath,int nDepth)
+{
+	int i;
+	for( i = 0 ; i < nDepth ; ++i ){
+		pBt->pIo->xPageUnref(aPath[i].pPage);
+	}
+}
+/*
+ * Walk from the root to the leaf holding (or that would hold) the given
+ * key, or to the first or last leaf. On success *pnDepth nodes, root first,
+ * are referenced in aPath and the last entry's iIdx is the position of the
+ * key in the leaf.
+ */
+static int btDescend(bt_engine *pBt,pgno iRoot,const unsigned char *zKey,int nKey,int iWhere,bt_path *aPath,int *pnDepth,int *pFound)
+{
+	const unqlite_kv_io *pIo = pBt->pIo;
+	unsigned char *zNode;
+	int nDepth = 0,bRight = 1;
+	int iIdx,n,rc;
+	pgno iPage = iRoot;
+	*pFound = 0;
+	for(;;){
+		if( nDepth >= BT_MAX_DEPTH ){
+			rc = UNQLITE_CORRUPT;
+			goto fail;
+		}
+		rc = pIo->xGet(pIo->pHandle,iPage,&aPath[nDepth].pPage);
+		if( rc != UNQLITE_OK ){
+			goto fail;
+		}
+		zNode = aPath[nDepth].pPage->zData;
+		aPath[nDepth].bRight = bRight;
+		nDepth++;
+		n = btNodeCount(zNode);
+		if( iWhere == BT_SEEK_FIRST ){
+			iIdx = 0;
+		}else if( iWhere == BT_SEEK_LAST ){
+			iIdx = zNode[0] == BT_PAGE_LEAF ? (n > 0 ? n - 1 : 0) : n;
+		}else{
+			iIdx = btNodeSearch(pBt->iOrder,zNode,zKey,nKey,pFound);
+		}
+		aPath[nDepth - 1].iIdx = iIdx;
+		if( zNode[0] == BT_PAGE_LEAF ){
+			break;
+		}
+		if( zNode[0] != BT_PAGE_INTERIOR ){
+			rc = UNQLITE_CORRUPT;
+			goto fail;
+		}
+		if( iWhere == BT_SEEK_KEY && *pFound ){
+			/* Keys equal to a divider live to its right */
+			iIdx++;
+			aPath[nDepth - 1].iIdx = iIdx;
+			*pFound = 0;
+		}
+		bRight = bRight && iIdx == n;
+		iPage = btChild(zNode,iIdx);
+	}
+	*pnDepth = nDepth;
+	return UNQLITE_OK;
+fail:
+	if( rc == UNQLITE_CORRUPT ){
+		pIo->xErr(pIo->pHandle,"Malformed B+tree node");
+	}
+	btReleasePath(pBt,aPath,nDepth);
+	return rc;
+}
+/*
+ * Split a node that has no room for a new cell. The cells ordered before
+ * the split point move to a new page that becomes the left sibling, while
+ * the original page keeps the rest, so the parent's pointer to it remains
+ * valid. On return pBt->zCell holds the divider cell, pointing at the new
+ * left sibling, that must be inserted in the parent at the same index.
+ */
+static int btSplit(bt_engine *pBt,unqlite_page *pMeta,unqlite_page *pPage,int iIdx,const unsigned char *zNew,int nNew,int bAppend,int *pnDivider)
+{
+	const unqlite_kv_io *pIo = pBt->pIo;
+	unsigned char *zNode = pPage->zData;
+	int isLeaf = zNode[0] == BT_PAGE_LEAF;
+	int n = btNodeCount(zNode);
+	int nTotal = n + 1;
+	const unsigned char *zSrc,*zKey;
+	unsigned char *zLeft;
+	unqlite_page *pLeft,*pPrev;
+	int i,k,nSize,nOfft = 0,nSum = 0,nAccum,nKey,rc;
+	pgno iRight,iPrev;
+	/* Gather every cell, including the new one, in key order */
+	for( i = 0 ; i < nTotal ; ++i ){
+		if( i == iIdx ){
+			zSrc = zNew;
+			nSize = nNew;
+		}else{
+			zSrc = btCellPtr(zNode,i < iIdx ? i : i - 1);
+			nSize = btCellSize(zNode,zSrc);
+		}
+		memcpy(&pBt->zScratch[nOfft],zSrc,(size_t)nSize);
+		pBt->aOfft[i] = nOfft;
+		pBt->aSize[i] = nSize;
+		nOfft += nSize;
+		nSum += nSize + 2;
+	}
+	if( bAppend ){
+		/* Appending past the right-most key: keep the existing node full
+		 * and start a new one, so sequential loads produce full pages.
+		 */
+		k = n;
+	}else{
+		nAccum = 0;
+		for( k = 0 ; k < nTotal - 1 ; ++k ){
+			nAccum += pBt->aSize[k] + 2;
+			if( nAccum * 2 >= nSum ){
+				break;
+			}
+		}
+		if( k < 1 ){
+			k = 1;
+		}
+		if( !isLeaf && k > nTotal - 2 ){
+			k = nTotal - 2;
+		}
+	}
+	rc = btAllocPage(pBt,pMeta,&pLeft);
+	if( rc != UNQLITE_OK ){
+		return rc;
+	}
+	zLeft = pLeft->zData;
+	iRight = (pgno)bt_get64(&zNode[BT_NODE_RIGHT]);
+	iPrev = (pgno)bt_get64(&zNode[BT_NODE_LEFT]);
+	btNodeInit(pBt,zLeft,zNode[0]);
+	btNodeInit(pBt,zNode,zNode[0]);
+	for( i = 0 ; i < k ; ++i ){
+		btNodeAppend(zLeft,&pBt->zScratch[pBt->aOfft[i]],pBt->aSize[i]);
+	}
+	/* Leaves keep the divider key as their first record, interior nodes
+	 * move it up to the parent.
+	 */
+	for( i = isLeaf ? k : k + 1 ; i < nTotal ; ++i ){
+		btNodeAppend(zNode,&pBt->zScratch[pBt->aOfft[i]],pBt->aSize[i]);
+	}
+	bt_put64(&zNode[BT_NODE_RIGHT],iRight);
+	if( isLeaf ){
+		nKey = btCellKey(zLeft,&pBt->zScratch[pBt->aOfft[k]],&zKey);
+		bt_put64(&zLeft[BT_NODE_RIGHT],pPage->iPage);
+		bt_put64(&zLeft[BT_NODE_LEFT],iPrev);
+		bt_put64(&zNode[BT_NODE_LEFT],pLeft->iPage);
+		if( iPrev ){
+			rc = pIo->xGet(pIo->pHandle,iPrev,&pPrev);
+			if( rc == UNQLITE_OK ){
+				rc = pIo->xWrite(pPrev);
+				if( rc == UNQLITE_OK ){
+					bt_put64(&pPrev->zData[BT_NODE_RIGHT],pLeft->iPage);
+				}
+				pIo->xPageUnref(pPrev);
+			}
+			if( rc != UNQLITE_OK ){
+				pIo->xPageUnref(pLeft);
+				return rc;
+			}
+		}
+	}else{
+		zSrc = &pBt->zScratch[pBt->aOfft[k]];
+		nKey = btCellKey(zLeft,zSrc,&zKey);
+		bt_put64(&zLeft[BT_NODE_RIGHT],bt_get64(zSrc));
+	}
+	/* Build the divider */
+	bt_put64(pBt->zCell,pLeft->iPage);
+	bt_put16(&pBt->zCell[8],(unsigned int)nKey);
+	memcpy(&pBt->zCell[BT_CELL_HDR],zKey,(size_t)nKey);
+	*pnDivider = BT_CELL_HDR + nKey;
+	pIo->xPageUnref(pLeft);
+	return UNQLITE_OK;
+}
+/*
+ * Insert a cell at aPath[nDepth-1], splitting nodes up the tree as needed.
+ */
+static int btInsertCell(bt_engine *pBt,unqlite_page *pMeta,bt_path *aPath,int nDepth,const unsigned char *zCell,int nCell)
+{
+	const unqlite_kv_io *pIo = pBt->pIo;
+	unqlite_page *pPage,*pRoot;
+	int iDepth = nDepth - 1;
+	int iIdx = aPath[iDepth].iIdx;
+	int bAppend,rc;
+	for(;;){
+		pPage = aPath[iDepth].pPage;
+		rc = pIo->xWrite(pPage);
+		if( rc != UNQLITE_OK ){
+			return rc;
+		}
+		rc = btNodeInsert(pBt,pPage->zData,iIdx,zCell,nCell);
+		if( rc != UNQLITE_FULL ){
+			return rc;
+		}
+		bAppend = aPath[iDepth].bRight && iIdx == btNodeCount(pPage->zData);
+		rc = btSplit(pBt,pMeta,pPage,iIdx,zCell,nCell,bAppend,&nCell);
+		if( rc != UNQLITE_OK ){
+			return rc;
+		}
+		zCell = pBt->zCell;
+		if( iDepth == 0 ){
+			/* The root was split, grow the tree by one level */
+			rc = btAllocPage(pBt,pMeta,&pRoot);
+			if( rc != UNQLITE_OK ){
+				return rc;
+			}
+			btNodeInit(pBt,pRoot->zData,BT_PAGE_INTERIOR);
+			bt_put64(&pRoot->zData[BT_NODE_RIGHT],pPage->iPage);
+			btNodeAppend(pRoot->zData,zCell,nCell);
+			bt_put64(&pMeta->zData[BT_META_ROOT],pRoot->iPage);
+			pIo->xPageUnref(pRoot);
+			return UNQLITE_OK;
+		}
+		iDepth--;
+		iIdx = aPath[iDepth].iIdx;
+	}
+}
+/*
+ * Insert or overwrite a record.
+ */
+static int btStore(bt_engine *pBt,const void *pKey,int nKey,const void *pData,unqlite_int64 nData)
+{
+	const unqlite_kv_io *pIo = pBt->pIo;
+	bt_path aPath[BT_MAX_DEPTH];
+	unqlite_page *pMeta,*pLeaf;
+	unsigned char *zLeaf,*zCell;
+	int nDepth,bFound,iIdx,nCell,bOverflow,bChain,rc;
+	sxu64 nOld,nNew;
+	pgno iRoot,iOvfl;
+	rc = btOpenMeta(pBt,1,&pMeta);
+	if( rc != UNQLITE_OK ){
+		return rc;
+	}
+	if( nKey > btMaxKey(pBt) ){
+		pIo->xPageUnref(pMeta);
+		pIo->xErr(pIo->pHandle,"Key too large for the B+tree storage engine");
+		return UNQLITE_LIMIT;
+	}
+	iRoot = (pgno)bt_get64(&pMeta->zData[BT_META_ROOT]);
+	if( iRoot == 0 ){
+		/* First record, the root starts out as a leaf */
+		rc = btAllocPage(pBt,pMeta,&pLeaf);
+		if( rc != UNQLITE_OK ){
+			goto end;
+		}
+		btNodeInit(pBt,pLeaf->zData,BT_PAGE_LEAF);
+		iRoot = pLeaf->iPage;
+		bt_put64(&pMeta->zData[BT_META_ROOT],iRoot);
+		pIo->xPageUnref(pLeaf);
+	}
+	rc = btDescend(pBt,iRoot,(const unsigned char *)pKey,nKey,BT_SEEK_KEY,aPath,&nDepth,&bFound);
+	if( rc != UNQLITE_OK ){
+		goto end;
+	}
+	pLeaf = aPath[nDepth - 1].pPage;
+	zLeaf = pLeaf->zData;
+	iIdx = aPath[nDepth - 1].iIdx;
+	rc = pIo->xWrite(pLeaf);
+	if( rc != UNQLITE_OK ){
+		goto release;
+	}
+	nCell = BT_CELL_HDR + nKey;
+	bOverflow = 2 + nCell + nData > pBt->nMaxCell;
+	iOvfl = 0;
+	if( bFound ){
+		/* Overwrite: drop the old record first. If both values overflow and
+		 * the new one fits in the pages of the old one, reuse them in place
+		 * rather than appending a new run to the file.
+		 */
+		zCell = btCellPtr(zLeaf,iIdx);
+		if( bOverflow && (bt_get16(zCell) & BT_CELL_FLAGS) == BT_CELL_OVFL ){
+			nOld = btOverflowPages(pBt,bt_get64(&zCell[2]));
+			nNew = btOverflowPages(pBt,(sxu64)nData);
+			if( nNew <= nOld ){
+				iOvfl = (pgno)bt_get64(&zCell[BT_CELL_HDR + (bt_get16(zCell) & ~BT_CELL_FLAGS)]);
+				rc = btFreeRun(pBt,pMeta,iOvfl + (pgno)nNew,nOld - nNew);
+			}else{
+				rc = btFreeOverflow(pBt,pMeta,zCell);
+			}
+		}else{
+			rc = btFreeOverflow(pBt,pMeta,zCell);
+		}
+		if( rc != UNQLITE_OK ){
+			goto release;
+		}
+		btNodeDropCell(pBt,zLeaf,iIdx);
+	}
+	/* Build the leaf cell */
+	if( !bOverflow ){
+		bt_put16(pBt->zCell,(unsigned int)nKey);
+		memcpy(&pBt->zCell[nCell],pData,(size_t)nData);
+		nCell += (int)nData;
+	}else{
+		rc = btWriteOverflow(pBt,pMeta,iOvfl,(const unsigned char *)pData,(sxu64)nData,&iOvfl,&bChain);
+		if( rc != UNQLITE_OK ){
+			goto release;
+		}
+		bt_put16(pBt->zCell,(unsigned int)nKey | BT_CELL_OVFL | (bChain ? BT_CELL_CHAIN : 0));
+		bt_put64(&pBt->zCell[nCell],iOvfl);
+		nCell += 8;
+	}
+	bt_put64(&pBt->zCell[2],(sxu64)nData);
+	memcpy(&pBt->zCell[BT_CELL_HDR],pKey,(size_t)nKey);
+	rc = btInsertCell(pBt,pMeta,aPath,nDepth,pBt->zCell,nCell);
+release:
+	btReleasePath(pBt,aPath,nDepth);
+end:
+	pIo->xPageUnref(pMeta);
+	return rc;
+}
+/*
+ * Unlink an empty leaf from its siblings and free it, along with any
+ * interior node left without children.
+ */
+static int btRemoveLeaf(bt_engine *pBt,unqlite_page *pMeta,bt_path *aPath,int nDepth)
+{
+	const unqlite_kv_io *pIo = pBt->pIo;
+	unqlite_page *pLeaf = aPath[nDepth - 1].pPage;
+	unqlite_page *pSibling,*pRoot;
+	unsigned char *zNode;
+	pgno iPrev,iNext,iRoot;
+	int iDepth,iIdx,n,rc;
+	iPrev = (pgno)bt_get64(&pLeaf->zData[BT_NODE_LEFT]);
+	iNext = (pgno)bt_get64(&pLeaf->zData[BT_NODE_RIGHT]);
+	if( iPrev ){
+		rc = pIo->xGet(pIo->pHandle,iPrev,&pSibling);
+		if( rc != UNQLITE_OK ){
+			return rc;
+		}
+		rc = pIo->xWrite(pSibling);
+		if( rc == UNQLITE_OK ){
+			bt_put64(&pSibling->zData[BT_NODE_RIGHT],iNext);
+		}
+		pIo->xPageUnref(pSibling);
+		if( rc != UNQLITE_OK ){
+			return rc;
+		}
+	}
+	if( iNext ){
+		rc = pIo->xGet(pIo->pHandle,iNext,&pSibling);
+		if( rc != UNQLITE_OK ){
+			return rc;
+		}
+		rc = pIo->xWrite(pSibling);
+		if( rc == UNQLITE_OK ){
+			bt_put64(&pSibling->zData[BT_NODE_LEFT],iPrev);
+		}
+		pIo->xPageUnref(pSibling);
+		if( rc != UNQLITE_OK ){
+			return rc;
+		}
+	}
+	rc = btFreePage(pBt,pMeta,pLeaf);
+	if( rc != UNQLITE_OK ){
+		return rc;
+	}
+	/* Remove the pointer to the freed node from its parent */
+	for( iDepth = nDepth - 2 ; iDepth >= 0 ; --iDepth ){
+		zNode = aPath[iDepth].pPage->zData;
+		iIdx = aPath[iDepth].iIdx;
+		n = btNodeCount(zNode);
+		rc = pIo->xWrite(aPath[iDepth].pPage);
+		if( rc != UNQLITE_OK ){
+			return rc;
+		}
+		if( iIdx < n ){
+			btNodeDropCell(pBt,zNode,iIdx);
+			break;
+		}
+		if( n > 0 ){
+			/* The right-most child is gone, promote the last cell's child */
+			bt_put64(&zNode[BT_NODE_RIGHT],bt_get64(btCellPtr(zNode,n - 1)));
+			btNodeDropCell(pBt,zNode,n - 1);
+			break;
+		}
+		/* No children left */
+		rc = btFreePage(pBt,pMeta,aPath[iDepth].pPage);
+		if( rc != UNQLITE_OK ){
+			return rc;
+		}
+		if( iDepth == 0 ){
+			bt_put64(&pMeta->zData[BT_META_ROOT],0);
+			return UNQLITE_OK;
+		}
+	}
+	/* Drop root nodes that are left with a single child */
+	for(;;){
+		iRoot = (pgno)bt_get64(&pMeta->zData[BT_META_ROOT]);
+		rc = pIo->xGet(pIo->pHandle,iRoot,&pRoot);
+		if( rc != UNQLITE_OK ){
+			return rc;
+		}
+		zNode = pRoot->zData;
+		if( zNode[0] != BT_PAGE_INTERIOR || btNodeCount(zNode) > 0 ){
+			pIo->xPageUnref(pRoot);
+			return UNQLITE_OK;
+		}
+		bt_put64(&pMeta->zData[BT_META_ROOT],bt_get64(&zNode[BT_NODE_RIGHT]));
+		rc = btFreePage(pBt,pMeta,pRoot);
+		pIo->xPageUnref(pRoot);
+		if( rc != UNQLITE_OK ){
+			return rc;
+		}
+	}
+}
+/*
+ * Remove a record. Return UNQLITE_NOTFOUND if there is no such key.
+ */
+static int btDelete(bt_engine *pBt,const void *pKey,int nKey)
+{
+	const unqlite_kv_io *pIo = pBt->pIo;
+	bt_path aPath[BT_MAX_DEPTH];
+	unqlite_page *pMeta,*pLeaf;
+	int nDepth,bFound,iIdx,rc;
+	pgno iRoot;
+	rc = btOpenMeta(pBt,0,&pMeta);
+	if( rc != UNQLITE_OK ){
+		return rc;
+	}
+	iRoot = (pgno)bt_get64(&pMeta->zData[BT_META_ROOT]);
+	if( iRoot == 0 ){
+		rc = UNQLITE_NOTFOUND;
+		goto end;
+	}
+	rc = btDescend(pBt,iRoot,(const unsigned char *)pKey,nKey,BT_SEEK_KEY,aPath,&nDepth,&bFound);
+	if( rc != UNQLITE_OK ){
+		goto end;
+	}
+	if( !bFound ){
+		rc = UNQLITE_NOTFOUND;
+		goto release;
+	}
+	rc = pIo->xWrite(pMeta);
+	if( rc != UNQLITE_OK ){
+		goto release;
+	}
+	pLeaf = aPath[nDepth - 1].pPage;
+	iIdx = aPath[nDepth - 1].iIdx;
+	rc = pIo->xWrite(pLeaf);
+	if( rc != UNQLITE_OK ){
+		goto release;
+	}
+	rc = btFreeOverflow(pBt,pMeta,btCellPtr(pLeaf->zData,iIdx));
+	if( rc != UNQLITE_OK ){
+		goto release;
+	}
+	btNodeDropCell(pBt,pLeaf->zData,iIdx);
+	if( btNodeCount(pLeaf->zData) == 0 && nDepth > 1 ){
+		rc = btRemoveLeaf(pBt,pMeta,aPath,nDepth);
+	}
+release:
+	btReleasePath(pBt,aPath,nDepth);
+end:
+	pIo->xPageUnref(pMeta);
+	return rc;
+}
+/*
+ * Exported: xInit() method.
+ */
+static int bt_kv_init(unqlite_kv_engine *pEngine,int iPageSize)
+{
+	/* The structure is zeroed. Buffers are sized lazily, once the page size
+	 * of the database is known.
+	 */
+	(void)pEngine;
+	(void)iPageSize;
+	return UNQLITE_OK;
+}
+/*
+ * Exported: xConfig() method.
+ */
+static int bt_kv_config(unqlite_kv_engine *pEngine,int iOp,va_list ap)
+{
+	bt_engine *pBt = (bt_engine *)pEngine;
+	const unqlite_kv_io *pIo = pBt->pIo;
+	unqlite_page *pMeta;
+	int iOrder,rc;
+	switch(iOp){
+	case UNQLITE_KV_CONFIG_KEY_ORDER:
+		iOrder = va_arg(ap,int);
+		if( iOrder != UNQLITE_KV_ORDER_MEMCMP && iOrder != UNQLITE_KV_ORDER_LENGTH ){
+			return UNQLITE_INVALID;
+		}
+		rc = pIo->xGet(pIo->pHandle,BT_META_PAGE,&pMeta);
+		if( rc != UNQLITE_OK ){
+			return rc;
+		}
+		if( bt_get32(pMeta->zData) == BT_MAGIC && pMeta->zData[BT_META_ORDER] != iOrder ){
+			/* The database was created with another key order */
+			pIo->xPageUnref(pMeta);
+			pIo->xErr(pIo->pHandle,"The key order of an existing database cannot be changed");
+			return UNQLITE_LOCKED;
+		}
+		pIo->xPageUnref(pMeta);
+		pBt->iOrder = iOrder;
+		pBt->bOrderSet = 1;
+		return UNQLITE_OK;
+	case UNQLITE_KV_CONFIG_GET_KEY_ORDER: {
+		int *pOrder = va_arg(ap,int *);
+		rc = pIo->xGet(pIo->pHandle,BT_META_PAGE,&pMeta);
+		if( rc != UNQLITE_OK ){
+			return rc;
+		}
+		if( bt_get32(pMeta->zData) == BT_MAGIC ){
+			pBt->iOrder = pMeta->zData[BT_META_ORDER];
+		}
+		pIo->xPageUnref(pMeta);
+		if( pOrder ){
+			*pOrder = pBt->iOrder;
+		}
+		return UNQLITE_OK;
+										  }
+	case UNQLITE_KV_CONFIG_PARTITION: {
+		int iPart = va_arg(ap,int);
+		int nPart = va_arg(ap,int);
+		if( nPart < 1 || iPart < 0 || iPart >= nPart ){
+			return UNQLITE_INVALID;
+		}
+		pBt->iPart = iPart;
+		pBt->nPart = nPart;
+		return UNQLITE_OK;
+									  }
+	case UNQLITE_KV_CONFIG_HASH_FUNC:
+	case UNQLITE_KV_CONFIG_CMP_FUNC:
+		pIo->xErr(pIo->pHandle,"The B+tree storage engine orders keys with UNQLITE_KV_CONFIG_KEY_ORDER");
+		return UNQLITE_NOTIMPLEMENTED;
+	default:
+		return UNQLITE_UNKNOWN;
+	}
+}
+/*
+ * Exported: xRelease() method.
+ */
+static void bt_kv_release(unqlite_kv_engine *pEngine)
+{
+	bt_engine *pBt = (bt_engine *)pEngine;
+	free(pBt->zScratch);
+	free(pBt->aOfft);
+	pBt->zScratch = 0;
+	pBt->aOfft = 0;
+	pBt->nAlloc = 0;
+}
+/*
+ * Exported: xReplace() method.
+ */
+static int bt_kv_replace(unqlite_kv_engine *pEngine,const void *pKey,int nKeyLen,const void *pData,unqlite_int64 nDataLen)
+{
+	return btStore((bt_engine *)pEngine,pKey,nKeyLen,pData,nDataLen);
+}
+/*
+ * Data consumer that accumulates a value in a heap buffer.
+ */
+typedef struct bt_buffer bt_buffer;
+struct bt_buffer
+{
+	unsigned char *zData;
+	sxu64 nUsed;
+};
+static int btBufferConsumer(const void *pData,unsigned int nLen,void *pUserData)
+{
+	bt_buffer *pBuf = (bt_buffer *)pUserData;
+	memcpy(&pBuf->zData[pBuf->nUsed],pData,nLen);
+	pBuf->nUsed += nLen;
+	return UNQLITE_OK;
+}
+/*
+ * Exported: xAppend() method.
+ */
+static int bt_kv_append(unqlite_kv_engine *pEngine,const void *pKey,int nKeyLen,const void *pData,unqlite_int64 nDataLen)
+{
+	bt_engine *pBt = (bt_engine *)pEngine;
+	bt_path aPath[BT_MAX_DEPTH];
+	unqlite_page *pMeta;
+	unsigned char *zCell;
+	bt_buffer sBuf;
+	sxu64 nOld;
+	int nDepth,bFound,rc;
+	pgno iRoot;
+	rc = btOpenMeta(pBt,0,&pMeta);
+	if( rc != UNQLITE_OK ){
+		return rc;
+	}
+	iRoot = (pgno)bt_get64(&pMeta->zData[BT_META_ROOT]);
+	bFound = 0;
+	if( iRoot ){
+		rc = btDescend(pBt,iRoot,(const unsigned char *)pKey,nKeyLen,BT_SEEK_KEY,aPath,&nDepth,&bFound);
+		if( rc != UNQLITE_OK ){
+			pBt->pIo->xPageUnref(pMeta);
+			return rc;
+		}
+		if( !bFound ){
+			btReleasePath(pBt,aPath,nDepth);
+		}
+	}
+	pBt->pIo->xPageUnref(pMeta);
+	if( !bFound ){
+		return btStore(pBt,pKey,nKeyLen,pData,nDataLen);
+	}
+	/* Read the existing value and store the concatenation */
+	zCell = btCellPtr(aPath[nDepth - 1].pPage->zData,aPath[nDepth - 1].iIdx);
+	nOld = bt_get64(&zCell[2]);
+	sBuf.nUsed = 0;
+	sBuf.zData = (unsigned char *)malloc((size_t)(nOld + (sxu64)nDataLen) + 1);
+	if( sBuf.zData == 0 ){
+		btReleasePath(pBt,aPath,nDepth);
+		return UNQLITE_NOMEM;
+	}
+	rc = btConsumeData(pBt,zCell,btBufferConsumer,&sBuf);
+	btReleasePath(pBt,aPath,nDepth);
+	if( rc == UNQLITE_OK ){
+		memcpy(&sBuf.zData[sBuf.nUsed],pData,(size_t)nDataLen);
+		rc = btStore(pBt,pKey,nKeyLen,sBuf.zData,(unqlite_int64)(sBuf.nUsed + (sxu64)nDataLen));
+	}
+	free(sBuf.zData);
+	return rc;
+}
+/*
+ * Return TRUE if scans restricted to a partition (see
+ * UNQLITE_KV_CONFIG_PARTITION) skip the given leaf. Leaves are assigned to
+ * partitions by a multiplicative hash of their page number, so that leaves
+ * interleaved with overflow runs still spread evenly.
+ */
+static int btSkipLeaf(bt_engine *pBt,pgno iLeaf)
+{
+	if( pBt->nPart < 2 ){
+		return 0;
+	}
+	return (int)((((unsigned int)iLeaf * 0x9E3779B1u) >> 8) % (unsigned int)pBt->nPart) != pBt->iPart;
+}
+/*
+ * Point the cursor at the cell iCell of the given leaf, moving to the
+ * neighbouring leaves if the index falls outside of it. A negative iCell
+ * selects the last cell. If bPart is set, leaves outside of the configured
+ * partition are stepped over. The leaf reference is consumed.
+ */
+static int btCursorSettle(bt_cursor *pCur,unqlite_page *pLeaf,int iCell,int bForward,int bPart)
+{
+	const unqlite_kv_io *pIo = pCur->pStore->pIo;
+	unsigned char *zNode;
+	pgno iNext;
+	int n,rc;
+	for(;;){
+		zNode = pLeaf->zData;
+		if( zNode[0] != BT_PAGE_LEAF ){
+			pIo->xPageUnref(pLeaf);
+			pCur->iLeaf = 0;
+			return UNQLITE_CORRUPT;
+		}
+		n = btNodeCount(zNode);
+		if( bPart && btSkipLeaf((bt_engine *)pCur->pStore,pLeaf->iPage) ){
+			n = 0;
+		}
+		if( iCell < 0 ){
+			iCell = n - 1;
+		}
+		if( iCell >= 0 && iCell < n ){
+			pCur->iLeaf = pLeaf->iPage;
+			pCur->iCell = iCell;
+			pIo->xPageUnref(pLeaf);
+			return UNQLITE_OK;
+		}
+		iNext = (pgno)bt_get64(&zNode[bForward ? BT_NODE_RIGHT : BT_NODE_LEFT]);
+		pIo->xPageUnref(pLeaf);
+		if( iNext == 0 ){
+			pCur->iLeaf = 0;
+			return UNQLITE_DONE;
+		}
+		rc = pIo->xGet(pIo->pHandle,iNext,&pLeaf);
+		if( rc != UNQLITE_OK ){
+			pCur->iLeaf = 0;
+			return rc;
+		}
+		iCell = bForward ? 0 : -1;
+	}
+}
+/*
+ * Position the cursor from the root.
+ */
+static int btCursorMove(bt_cursor *pCur,const void *pKey,int nByte,int iWhere,int iPos)
+{
+	bt_engine *pBt = (bt_engine *)pCur->pStore;
+	bt_path aPath[BT_MAX_DEPTH];
+	unqlite_page *pMeta,*pLeaf;
+	int nDepth,bFound,iIdx,rc;
+	pgno iRoot;
+	pCur->iLeaf = 0;
+	pCur->bFirst = 0;
+	rc = btOpenMeta(pBt,0,&pMeta);
+	if( rc != UNQLITE_OK ){
+		return rc;
+	}
+	iRoot = (pgno)bt_get64(&pMeta->zData[BT_META_ROOT]);
+	pBt->pIo->xPageUnref(pMeta);
+	if( iRoot == 0 ){
+		return iWhere == BT_SEEK_KEY ? UNQLITE_NOTFOUND : UNQLITE_DONE;
+	}
+	rc = btDescend(pBt,iRoot,(const unsigned char *)pKey,nByte,iWhere,aPath,&nDepth,&bFound);
+	if( rc != UNQLITE_OK ){
+		return rc;
+	}
+	/* Keep the leaf, release the interior nodes */
+	pLeaf = aPath[nDepth - 1].pPage;
+	iIdx = aPath[nDepth - 1].iIdx;
+	btReleasePath(pBt,aPath,nDepth - 1);
+	if( iWhere == BT_SEEK_FIRST ){
+		return btCursorSettle(pCur,pLeaf,0,1,1);
+	}
+	if( iWhere == BT_SEEK_LAST ){
+		return btCursorSettle(pCur,pLeaf,-1,0,1);
+	}
+	if( bFound ){
+		return btCursorSettle(pCur,pLeaf,iIdx,1,0);
+	}
+	if( iPos == UNQLITE_CURSOR_MATCH_GE ){
+		rc = btCursorSettle(pCur,pLeaf,iIdx,1,0);
+	}else if( iPos == UNQLITE_CURSOR_MATCH_LE ){
+		if( iIdx > 0 ){
+			rc = btCursorSettle(pCur,pLeaf,iIdx - 1,0,0);
+		}else{
+			/* Continue on the last record of the previous leaf */
+			pgno iPrev = (pgno)bt_get64(&pLeaf->zData[BT_NODE_LEFT]);
+			pBt->pIo->xPageUnref(pLeaf);
+			if( iPrev == 0 ){
+				return UNQLITE_NOTFOUND;
+			}
+			rc = pBt->pIo->xGet(pBt->pIo->pHandle,iPrev,&pLeaf);
+			if( rc != UNQLITE_OK ){
+				return rc;
+			}
+			rc = btCursorSettle(pCur,pLeaf,-1,0,0);
+		}
+	}else{
+		pBt->pIo->xPageUnref(pLeaf);
+		return UNQLITE_NOTFOUND;
+	}
+	return rc == UNQLITE_DONE ? UNQLITE_NOTFOUND : rc;
+}
+/*
+ * Like the cursors of the hash engines, a new cursor points to the first
+ * record. It is positioned when first used rather than by xCursorInit(), as
+ * UnQLite creates a cursor while the database is being opened.
+ */
+static void btCursorFirstUse(bt_cursor *pCur)
+{
+	if( pCur->bFirst ){
+		btCursorMove(pCur,0,0,BT_SEEK_FIRST,0);
+	}
+}
+/*
+ * Load the leaf and cell the cursor points to.
+ */
+static int btCursorCell(bt_cursor *pCur,unqlite_page **ppLeaf,unsigned char **pzCell)
+{
+	const unqlite_kv_io *pIo = pCur->pStore->pIo;
+	unqlite_page *pLeaf;
+	int rc;
+	btCursorFirstUse(pCur);
+	if( pCur->iLeaf == 0 ){
+		return UNQLITE_INVALID;
+	}
+	rc = pIo->xGet(pIo->pHandle,pCur->iLeaf,&pLeaf);
+	if( rc != UNQLITE_OK ){
+		return rc;
+	}
+	if( pLeaf->zData[0] != BT_PAGE_LEAF || pCur->iCell >= btNodeCount(pLeaf->zData) ){
+		/* The tree changed under the cursor */
+		pIo->xPageUnref(pLeaf);
+		pCur->iLeaf = 0;
+		return UNQLITE_INVALID;
+	}
+	*ppLeaf = pLeaf;
+	*pzCell = btCellPtr(pLeaf->zData,pCur->iCell);
+	return UNQLITE_OK;
+}
+/*
+ * Exported: xCursorInit() method.
+ */
+static void btCursorInit(unqlite_kv_cursor *pCursor)
+{
+	bt_cursor *pCur = (bt_cursor *)pCursor;
+	pCur->iLeaf = 0;
+	pCur->iCell = 0;
+	pCur->bFirst = 1;
+}
+/*
+ * Exported: xSeek() method.
+ */
+static int btCursorSeek(unqlite_kv_cursor *pCursor,const void *pKey,int nByte,int iPos)
+{
+	return btCursorMove((bt_cursor *)pCursor,pKey,nByte,BT_SEEK_KEY,iPos);
+}
+/*
+ * Exported: xFirst() method.
+ */
+static int btCursorFirst(unqlite_kv_cursor *pCursor)
+{
+	return btCursorMove((bt_cursor *)pCursor,0,0,BT_SEEK_FIRST,0);
+}
+/*
+ * Exported: xLast() method.
+ */
+static int btCursorLast(unqlite_kv_cursor *pCursor)
+{
+	return btCursorMove((bt_cursor *)pCursor,0,0,BT_SEEK_LAST,0);
+}
+/*
+ * Exported: xValid() method.
+ */
+static int btCursorValid(unqlite_kv_cursor *pCursor)
+{
+	btCursorFirstUse((bt_cursor *)pCursor);
+	return ((bt_cursor *)pCursor)->iLeaf != 0;
+}
+/*
+ * Step the cursor forward or backward.
+ */
+static int btCursorStep(bt_cursor *pCur,int bForward)
+{
+	unqlite_page *pLeaf;
+	unsigned char *zCell;
+	int rc;
+	rc = btCursorCell(pCur,&pLeaf,&zCell);
+	if( rc != UNQLITE_OK ){
+		return UNQLITE_DONE;
+	}
+	return btCursorSettle(pCur,pLeaf,bForward ? pCur->iCell + 1 : pCur->iCell - 1,bForward,1);
+}
+/*
+ * Exported: xNext() method.
+ */
+static int btCursorNext(unqlite_kv_cursor *pCursor)
+{
+	return btCursorStep((bt_cursor *)pCursor,1);
+}
+/*
+ * Exported: xPrev() method.
+ */
+static int btCursorPrev(unqlite_kv_cursor *pCursor)
+{
+	bt_cursor *pCur = (bt_cursor *)pCursor;
+	btCursorFirstUse(pCur);
+	if( pCur->iLeaf && pCur->iCell == 0 ){
+		/* btCursorSettle() treats a negative index as "last cell" */
+		unqlite_page *pLeaf;
+		unsigned char *zCell;
+		pgno iPrev;
+		int rc;
+		rc = btCursorCell(pCur,&pLeaf,&zCell);
+		if( rc != UNQLITE_OK ){
+			return UNQLITE_DONE;
+		}
+		iPrev = (pgno)bt_get64(&pLeaf->zData[BT_NODE_LEFT]);
+		pCur->pStore->pIo->xPageUnref(pLeaf);
+		pCur->iLeaf = 0;
+		if( iPrev == 0 ){
+			return UNQLITE_DONE;
+		}
+		rc = pCur->pStore->pIo->xGet(pCur->pStore->pIo->pHandle,iPrev,&pLeaf);
+		if( rc != UNQLITE_OK ){
+			return rc;
+		}
+		return btCursorSettle(pCur,pLeaf,-1,0,1);
+	}
+	return btCursorStep(pCur,0);
+}
+/*
+ * Exported: xDelete() method.
+ * The cursor is left pointing to the record that followed the deleted one.
+ */
+static int btCursorDelete(unqlite_kv_cursor *pCursor)
+{
+	bt_cursor *pCur = (bt_cursor *)pCursor;
+	bt_engine *pBt = (bt_engine *)pCur->pStore;
+	unqlite_page *pLeaf;
+	unsigned char *zCell,*zKey;
+	const unsigned char *zCellKey;
+	int nKey,rc;
+	rc = btCursorCell(pCur,&pLeaf,&zCell);
+	if( rc != UNQLITE_OK ){
+		return rc;
+	}
+	/* Keep a copy of the key, the deletion may free the leaf */
+	nKey = btCellKey(pLeaf->zData,zCell,&zCellKey);
+	zKey = (unsigned char *)malloc((size_t)nKey + 1);
+	if( zKey == 0 ){
+		pBt->pIo->xPageUnref(pLeaf);
+		return UNQLITE_NOMEM;
+	}
+	memcpy(zKey,zCellKey,(size_t)nKey);
+	pBt->pIo->xPageUnref(pLeaf);
+	rc = btDelete(pBt,zKey,nKey);
+	if( rc == UNQLITE_OK ){
+		if( btCursorMove(pCur,zKey,nKey,BT_SEEK_KEY,UNQLITE_CURSOR_MATCH_GE) != UNQLITE_OK ){
+			pCur->iLeaf = 0;
+		}
+	}
+	free(zKey);
+	return rc;
+}
+/*
+ * Exported: xKeyLength() method.
+ */
+static int btCursorKeyLength(unqlite_kv_cursor *pCursor,int *pLen)
+{
+	bt_cursor *pCur = (bt_cursor *)pCursor;
+	unqlite_page *pLeaf;
+	unsigned char *zCell;
+	int rc;
+	rc = btCursorCell(pCur,&pLeaf,&zCell);
+	if( rc != UNQLITE_OK ){
+		return rc;
+	}
+	*pLen = (int)(bt_get16(zCell) & ~BT_CELL_FLAGS);
+	pCur->pStore->pIo->xPageUnref(pLeaf);
+	return UNQLITE_OK;
+}
+/*
+ * Exported: xKey() method.
+ */
+static int btCursorKey(unqlite_kv_cursor *pCursor,int (*xConsumer)(const void *,unsigned int,void *),void *pUserData)
+{
+	bt_cursor *pCur = (bt_cursor *)pCursor;
+	unqlite_page *pLeaf;
+	unsigned char *zCell;
+	int rc;
+	rc = btCursorCell(pCur,&pLeaf,&zCell);
+	if( rc != UNQLITE_OK ){
+		return rc;
+	}
+	rc = xConsumer(&zCell[BT_CELL_HDR],bt_get16(zCell) & ~BT_CELL_FLAGS,pUserData);
+	pCur->pStore->pIo->xPageUnref(pLeaf);
+	return rc != UNQLITE_OK ? UNQLITE_ABORT : UNQLITE_OK;
+}
+/*
+ * Exported: xDataLength() method.
+ */
+static int btCursorDataLength(unqlite_kv_cursor *pCursor,unqlite_int64 *pLen)
+{
+	bt_cursor *pCur = (bt_cursor *)pCursor;
+	unqlite_page *pLeaf;
+	unsigned char *zCell;
+	int rc;
+	rc = btCursorCell(pCur,&pLeaf,&zCell);
+	if( rc != UNQLITE_OK ){
+		return rc;
+	}
+	*pLen = (unqlite_int64)bt_get64(&zCell[2]);
+	pCur->pStore->pIo->xPageUnref(pLeaf);
+	return UNQLITE_OK;
+}
+/*
+ * Exported: xData() method.
+ */
+static int btCursorData(unqlite_kv_cursor *pCursor,int (*xConsumer)(const void *,unsigned int,void *),void *pUserData)
+{
+	bt_cursor *pCur = (bt_cursor *)pCursor;
+	unqlite_page *pLeaf;
+	unsigned char *zCell;
+	int rc;
+	rc = btCursorCell(pCur,&pLeaf,&zCell);
+	if( rc != UNQLITE_OK ){
+		return rc;
+	}
+	rc = btConsumeData((bt_engine *)pCur->pStore,zCell,xConsumer,pUserData);
+	pCur->pStore->pIo->xPageUnref(pLeaf);
+	return rc;
+}
+/*
+ * Exported: xReset() method.
+ */
+static void btCursorReset(unqlite_kv_cursor *pCursor)
+{
+	btCursorFirst(pCursor);
+}
+/*
+ * Export the B+tree storage engine.
+ */
+const unqlite_kv_methods * unqliteExportBtreeKvStorage(void)
+{
+	static const unqlite_kv_methods sBtreeStore = {
+		"btree",                    /* zName */
+		sizeof(bt_engine),          /* szKv */
+		sizeof(bt_cursor),          /* szCursor */
+		1,                          /* iVersion */
+		bt_kv_init,                 /* xInit */
+		bt_kv_release,              /* xRelease */
+		bt_kv_config,               /* xConfig */
+		0,                          /* xOpen */
+		bt_kv_replace,              /* xReplace */
+		bt_kv_append,               /* xAppend */
+		btCursorInit,               /* xCursorInit */
+		btCursorSeek,               /* xSeek */
+		btCursorFirst,              /* xFirst */
+		btCursorLast,               /* xLast */
+		btCursorValid,              /* xValid */
+		btCursorNext,               /* xNext */
+		btCursorPrev,               /* xPrev */
+		btCursorDelete,             /* xDelete */
+		btCursorKeyLength,          /* xKeyLength */
+		btCursorKey,                /* xKey */
+		btCursorDataLength,         /* xDataLength */
+		btCursorData,               /* xData */
+		btCursorReset,              /* xReset */
+		0                           /* xCursorRelease */
+	};
+	return &sBtreeStore;
+}
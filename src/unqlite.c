@@ -461,6 +461,7 @@ typedef sxi64 unqlite_int64;
 #define UNQLITE_CONFIG_KV_ENGINE           4  /* ONE ARGUMENT: const char *zKvName */
 #define UNQLITE_CONFIG_DISABLE_AUTO_COMMIT 5  /* NO ARGUMENTS */
 #define UNQLITE_CONFIG_GET_KV_NAME         6  /* ONE ARGUMENT: const char **pzPtr */
+#define UNQLITE_CONFIG_GET_MMAP_VIEW       7  /* TWO ARGUMENTS: const void **ppMap, unqlite_int64 *pSize */
 /*
  * UnQLite/Jx9 Virtual Machine Configuration Commands.
  *
@@ -506,6 +507,14 @@ typedef sxi64 unqlite_int64;
  */
 #define UNQLITE_KV_CONFIG_HASH_FUNC  1 /* ONE ARGUMENT: unsigned int (*xHash)(const void *,unsigned int) */
 #define UNQLITE_KV_CONFIG_CMP_FUNC   2 /* ONE ARGUMENT: int (*xCmp)(const void *,const void *,unsigned int) */
+#define UNQLITE_KV_CONFIG_KEY_ORDER  3 /* ONE ARGUMENT: int iOrder (UNQLITE_KV_ORDER_MEMCMP or UNQLITE_KV_ORDER_LENGTH) */
+#define UNQLITE_KV_CONFIG_GET_KEY_ORDER 4 /* ONE ARGUMENT: int *pOrder */
+#define UNQLITE_KV_CONFIG_PARTITION  5 /* TWO ARGUMENTS: int iPart, int nPart */
+/*
+ * Key orders for ordered storage engines (i.e. B+tree), see UNQLITE_KV_CONFIG_KEY_ORDER.
+ */
+#define UNQLITE_KV_ORDER_MEMCMP      0 /* Bytewise, shorter keys first when one is a prefix of the other */
+#define UNQLITE_KV_ORDER_LENGTH      1 /* Shorter keys first, then bytewise */
 /*
  * Global Library Configuration Commands.
  *
@@ -3469,6 +3478,8 @@ UNQLITE_PRIVATE const unqlite_vfs * unqliteExportBuiltinVfs(void);
 UNQLITE_PRIVATE const unqlite_kv_methods * unqliteExportMemKvStorage(void);
 /* lhash_kv.c */
 UNQLITE_PRIVATE const unqlite_kv_methods * unqliteExportDiskKvStorage(void);
+/* btree_kv.c */
+const unqlite_kv_methods * unqliteExportBtreeKvStorage(void);
 /* os.c */
 UNQLITE_PRIVATE int unqliteOsRead(unqlite_file *id, void *pBuf, unqlite_int64 amt, unqlite_int64 offset);
 UNQLITE_PRIVATE int unqliteOsWrite(unqlite_file *id, const void *pBuf, unqlite_int64 amt, unqlite_int64 offset);
@@ -3506,7 +3517,10 @@ UNQLITE_PRIVATE int unqlitePagerOpen(
   unsigned int iFlags      /* flags controlling this file */
   );
 UNQLITE_PRIVATE int unqlitePagerRegisterKvEngine(Pager *pPager,unqlite_kv_methods *pMethods);
+UNQLITE_PRIVATE int unqlitePagerSetKvEngine(Pager *pPager,const char *zName);
 UNQLITE_PRIVATE unqlite_kv_engine * unqlitePagerGetKvEngine(unqlite *pDb);
+UNQLITE_PRIVATE int unqlitePagerGetMmapView(Pager *pPager,const void **ppMap,sxi64 *pSize);
+UNQLITE_PRIVATE void unqlitePagerRecordKvConfig(Pager *pPager,int iOp,va_list ap);
 UNQLITE_PRIVATE int unqlitePagerBegin(Pager *pPager);
 UNQLITE_PRIVATE int unqlitePagerCommit(Pager *pPager);
 UNQLITE_PRIVATE int unqlitePagerRollback(Pager *pPager,int bResetKvEngine);
@@ -3868,6 +3882,9 @@ static sxi32 unqliteCoreInitialize(void)
 		/* Default disk key/value storage engine */
 		pMethods = unqliteExportDiskKvStorage(); /* Disk storage */
 		unqlite_lib_config(UNQLITE_LIB_CONFIG_STORAGE_ENGINE,pMethods);
+		/* Ordered disk key/value storage engine */
+		pMethods = unqliteExportBtreeKvStorage(); /* B+tree storage */
+		unqlite_lib_config(UNQLITE_LIB_CONFIG_STORAGE_ENGINE,pMethods);
 		/* Default page size */
 		if( sUnqlMPGlobal.iPageSize < UNQLITE_MIN_PAGE_SIZE ){
 			unqlite_lib_config(UNQLITE_LIB_CONFIG_PAGE_SIZE,UNQLITE_DEFAULT_PAGE_SIZE);
@@ -4263,6 +4280,16 @@ static int unqliteConfigure(unqlite *pDb,int nOp,va_list ap)
 		pDb->iFlags |= UNQLITE_FL_DISABLE_AUTO_COMMIT;
 		break;
 											}
+	case UNQLITE_CONFIG_KV_ENGINE: {
+		/* Switch to another registered KV storage engine */
+		const char *zName = va_arg(ap,const char *);
+		if( zName == 0 ){
+			rc = UNQLITE_INVALID;
+			break;
+		}
+		rc = unqlitePagerSetKvEngine(pDb->sDB.pPager,zName);
+		break;
+									}
 	case UNQLITE_CONFIG_GET_KV_NAME: {
 		/* Name of the underlying KV storage engine */
 		const char **pzPtr = va_arg(ap,const char **);
@@ -4274,6 +4301,21 @@ static int unqliteConfigure(unqlite *pDb,int nOp,va_list ap)
 		}
 		break;
 									 }
+	case UNQLITE_CONFIG_GET_MMAP_VIEW: {
+		/* Read-only memory view of the database file (UNQLITE_OPEN_MMAP) */
+		const void **ppMap = va_arg(ap,const void **);
+		unqlite_int64 *pSize = va_arg(ap,unqlite_int64 *);
+		const void *pMap;
+		sxi64 nSize;
+		rc = unqlitePagerGetMmapView(pDb->sDB.pPager,&pMap,&nSize);
+		if( ppMap ){
+			*ppMap = pMap;
+		}
+		if( pSize ){
+			*pSize = (unqlite_int64)nSize;
+		}
+		break;
+									   }
 	default:
 		/* Unknown configuration option */
 		rc = UNQLITE_UNKNOWN;
@@ -5788,6 +5830,12 @@ int unqlite_kv_config(unqlite *pDb,int iOp,...)
 		 va_start(ap,iOp);
 		 rc = pEngine->pIo->pMethods->xConfig(pEngine,iOp,ap);
 		 va_end(ap);
+		 if( rc == UNQLITE_OK ){
+			 /* Remember the configuration so that it survives a pager reset */
+			 va_start(ap,iOp);
+			 unqlitePagerRecordKvConfig(pDb->sDB.pPager,iOp,ap);
+			 va_end(ap);
+		 }
 	 }
 #if defined(UNQLITE_ENABLE_THREADS)
 	 /* Leave DB mutex */
@@ -48638,6 +48686,8 @@ struct lhash_kv_engine
 	pgno max_split_bucket;        /* Maximum split bucket: MUST BE A POWER OF TWO */
 	pgno nmax_split_nucket;       /* Next maximum split bucket (1 << nMsb): In-memory only */
 	sxu32 nMagic;                 /* Magic number to identify a valid linear hash disk database */
+	pgno iPart;                   /* Buckets visited by cursors: iLogic % nPart == iPart */
+	pgno nPart;                   /* Number of cursor partitions (0 or 1 for the whole database) */
 };
 /*
  * Given a logical bucket number, return the record associated with it.
@@ -51196,6 +51246,18 @@ static int lhash_kv_config(unqlite_kv_engine *pEngine,int op,va_list ap)
 		}
 		break;
 									 }
+	case UNQLITE_KV_CONFIG_PARTITION: {
+		/* Restrict cursors to the buckets of one partition */
+		int iPart = va_arg(ap,int);
+		int nPart = va_arg(ap,int);
+		if( nPart < 1 || iPart < 0 || iPart >= nPart ){
+			rc = UNQLITE_INVALID;
+		}else{
+			pHash->iPart = (pgno)iPart;
+			pHash->nPart = (pgno)nPart;
+		}
+		break;
+									  }
 	default:
 		/* Unknown OP */
 		rc = UNQLITE_UNKNOWN;
@@ -51237,6 +51299,14 @@ static void lhInitCursor(unqlite_kv_cursor *pPtr)
 	 pCur->pRaw = 0;
 	 pCur->is_first = 1;
 }
+/*
+ * Return TRUE if the bucket falls outside the partition cursors are
+ * restricted to (see UNQLITE_KV_CONFIG_PARTITION).
+ */
+static int lhSkipBucket(lhash_kv_engine *pEngine,lhash_bmap_rec *pRec)
+{
+	return pEngine->nPart > 1 && (pRec->iLogic % pEngine->nPart) != pEngine->iPart;
+}
 /*
  * Point to the next page on the database.
  */
@@ -51259,6 +51329,9 @@ static int lhCursorNextPage(lhash_kv_cursor *pPtr)
 		}
 		/* Advance the map cursor */
 		pCur->pRec = pRec->pPrev; /* Not a bug, reverse link */
+		if( lhSkipBucket((lhash_kv_engine *)pCur->pStore,pRec) ){
+			continue;
+		}
 		/* Load the next page on the list */
 		rc = lhLoadPage((lhash_kv_engine *)pCur->pStore,pRec->iReal,0,&pPage,0);
 		if( rc != UNQLITE_OK ){
@@ -51298,6 +51371,9 @@ static int lhCursorPrevPage(lhash_kv_cursor *pPtr)
 		}
 		/* Advance the map cursor */
 		pCur->pRec = pRec->pNext; /* Not a bug, reverse link */
+		if( lhSkipBucket((lhash_kv_engine *)pCur->pStore,pRec) ){
+			continue;
+		}
 		/* Load the previous page on the list */
 		rc = lhLoadPage((lhash_kv_engine *)pCur->pStore,pRec->iReal,0,&pPage,0);
 		if( rc != UNQLITE_OK ){
@@ -55369,6 +55445,12 @@ struct Pager
   sxu32 nSize;                   /* apHash[] size: Must be a power of two  */
   sxu32 nPage;                   /* Total number of page loaded in memory */
   sxu32 nCacheMax;               /* Maximum page to cache*/
+  unsigned int (*xKvHash)(const void *,unsigned int);   /* Hash function installed via unqlite_kv_config() */
+  int (*xKvCmp)(const void *,const void *,unsigned int); /* Compare function installed via unqlite_kv_config() */
+  int iKvOrder;                  /* Key order installed via unqlite_kv_config() */
+  int bKvOrder;                  /* True if iKvOrder was set */
+  int iKvPart;                   /* Cursor partition installed via unqlite_kv_config() */
+  int nKvPart;                   /* Number of cursor partitions, 0 if not set */
 };
 /* Control flags */
 #define PAGER_CTRL_COMMIT_ERR   0x001 /* Commit error */
@@ -57149,6 +57231,66 @@ fail:
 	pPager->pDb->iFlags |= UNQLITE_FL_DISABLE_AUTO_COMMIT;
 	return rc;
 }
+static int pager_kv_config(unqlite_kv_engine *pEngine,int iOp,...)
+{
+	va_list ap;
+	int rc;
+	va_start(ap,iOp);
+	rc = pEngine->pIo->pMethods->xConfig(pEngine,iOp,ap);
+	va_end(ap);
+	return rc;
+}
+/*
+ * Apply the configuration recorded by unqlitePagerRecordKvConfig() to a freshly
+ * initialized KV engine. Otherwise a rollback would silently switch the engine
+ * back to its default hash function or key order and the database would no
+ * longer be readable.
+ */
+static int pager_reapply_kv_config(Pager *pPager)
+{
+	unqlite_kv_engine *pEngine = pPager->pEngine;
+	int rc = UNQLITE_OK;
+	if( pEngine->pIo->pMethods->xConfig == 0 ){
+		return UNQLITE_OK;
+	}
+	if( pPager->xKvHash ){
+		rc = pager_kv_config(pEngine,UNQLITE_KV_CONFIG_HASH_FUNC,pPager->xKvHash);
+	}
+	if( rc == UNQLITE_OK && pPager->xKvCmp ){
+		rc = pager_kv_config(pEngine,UNQLITE_KV_CONFIG_CMP_FUNC,pPager->xKvCmp);
+	}
+	if( rc == UNQLITE_OK && pPager->bKvOrder ){
+		rc = pager_kv_config(pEngine,UNQLITE_KV_CONFIG_KEY_ORDER,pPager->iKvOrder);
+	}
+	if( rc == UNQLITE_OK && pPager->nKvPart > 0 ){
+		rc = pager_kv_config(pEngine,UNQLITE_KV_CONFIG_PARTITION,pPager->iKvPart,pPager->nKvPart);
+	}
+	return rc;
+}
+/*
+ * Record a successful unqlite_kv_config() call.
+ */
+UNQLITE_PRIVATE void unqlitePagerRecordKvConfig(Pager *pPager,int iOp,va_list ap)
+{
+	switch(iOp){
+	case UNQLITE_KV_CONFIG_HASH_FUNC:
+		pPager->xKvHash = va_arg(ap,unsigned int (*)(const void *,unsigned int));
+		break;
+	case UNQLITE_KV_CONFIG_CMP_FUNC:
+		pPager->xKvCmp = va_arg(ap,int (*)(const void *,const void *,unsigned int));
+		break;
+	case UNQLITE_KV_CONFIG_KEY_ORDER:
+		pPager->iKvOrder = va_arg(ap,int);
+		pPager->bKvOrder = 1;
+		break;
+	case UNQLITE_KV_CONFIG_PARTITION:
+		pPager->iKvPart = va_arg(ap,int);
+		pPager->nKvPart = va_arg(ap,int);
+		break;
+	default:
+		break;
+	}
+}
 /*
  * Reset the pager to its initial state. This is caused by
  * a rollback operation.
@@ -57212,6 +57354,11 @@ static int pager_reset_state(Pager *pPager,int bResetKvEngine)
 				return rc;
 			}
 		}
+		/* Restore the user supplied configuration */
+		rc = pager_reapply_kv_config(pPager);
+		if( rc != UNQLITE_OK ){
+			return rc;
+		}
 		if( pIo->pMethods->xOpen ){
 			/* Call the xOpen method */
 			rc = pIo->pMethods->xOpen(pEngine,pPager->dbSize);
@@ -57497,6 +57644,46 @@ static void pager_release_kv_engine(Pager *pPager)
 }
 /* Forward declaration */
 static int pager_kv_io_init(Pager *pPager,unqlite_kv_methods *pMethods,unqlite_kv_io *pIo);
+/*
+ * Return the KV storage engine recorded in the header of an existing
+ * database file, or NULL if there is no such file or its header cannot
+ * be read. The database file is opened and closed again, so that the
+ * right engine can be installed before any page is read.
+ */
+static unqlite_kv_methods * pager_stored_kv_engine(Pager *pPager)
+{
+	unsigned char zRaw[UNQLITE_MIN_PAGE_SIZE];
+	unqlite_kv_methods *pMethods = 0;
+	unqlite_file *pFile;
+	sxi64 n = 0;
+	sxu16 nLen;
+	sxu32 nOfft;
+	int exists = 0;
+	int rc;
+	rc = unqliteOsAccess(pPager->pVfs,pPager->zFilename,UNQLITE_ACCESS_EXISTS,&exists);
+	if( rc != UNQLITE_OK || !exists ){
+		return 0;
+	}
+	rc = unqliteOsOpen(pPager->pVfs,pPager->pAllocator,pPager->zFilename,&pFile,UNQLITE_OPEN_READONLY);
+	if( rc != UNQLITE_OK ){
+		return 0;
+	}
+	rc = unqliteOsFileSize(pFile,&n);
+	if( rc == UNQLITE_OK && n >= UNQLITE_MIN_PAGE_SIZE ){
+		rc = unqliteOsRead(pFile,zRaw,sizeof(zRaw),0);
+		if( rc == UNQLITE_OK && SyMemcmp(UNQLITE_DB_SIG,zRaw,sizeof(UNQLITE_DB_SIG)-1) == 0 ){
+			/* Signature, magic number, creation time, sector and page size */
+			nOfft = sizeof(UNQLITE_DB_SIG) - 1 + 4 * 4;
+			SyBigEndianUnpack16(&zRaw[nOfft],&nLen);
+			nOfft += 2;
+			if( nLen > 0 && nOfft + nLen <= sizeof(zRaw) ){
+				pMethods = unqliteFindKVStore((const char *)&zRaw[nOfft],nLen);
+			}
+		}
+	}
+	unqliteOsCloseFree(pPager->pAllocator,pFile);
+	return pMethods;
+}
 /*
  * Allocate, initialize and register a new KV storage engine
  * within this database instance.
@@ -57516,6 +57703,11 @@ UNQLITE_PRIVATE int unqlitePagerRegisterKvEngine(Pager *pPager,unqlite_kv_method
 		}
 		/* Release the old KV engine */
 		pager_release_kv_engine(pPager);
+		/* Its configuration does not apply to the new engine */
+		pPager->xKvHash = 0;
+		pPager->xKvCmp = 0;
+		pPager->bKvOrder = 0;
+		pPager->nKvPart = 0;
 	}
 	/* Allocate a new KV engine instance */
 	nByte = (sxu32)pMethods->szKv;
@@ -57558,6 +57750,38 @@ fail:
 	SyMemBackendFree(&pDb->sMem,pIo);
 	return rc;
 }
+/*
+ * Install the named KV storage engine in place of the default one.
+ * This is only allowed before any record was stored: the engine of an
+ * existing database is recorded in its header.
+ */
+UNQLITE_PRIVATE int unqlitePagerSetKvEngine(Pager *pPager,const char *zName)
+{
+	unqlite_kv_methods *pMethods;
+	unqlite_kv_cursor *pCur;
+	pMethods = unqliteFindKVStore(zName,SyStrlen(zName));
+	if( pMethods == 0 ){
+		unqliteGenErrorFormat(pPager->pDb,"No such Key/Value storage engine '%s'",zName);
+		return UNQLITE_NOTIMPLEMENTED;
+	}
+	if( pPager->pEngine && pMethods == pPager->pEngine->pIo->pMethods ){
+		/* Already installed */
+		return UNQLITE_OK;
+	}
+	if( pPager->is_mem ){
+		/* Refuse to drop records held by the in-memory engine */
+		pCur = pPager->pDb->sDB.pCursor;
+		if( pCur && pCur->pStore->pIo->pMethods->xFirst(pCur) == UNQLITE_OK
+			&& pCur->pStore->pIo->pMethods->xValid(pCur) ){
+				unqliteGenError(pPager->pDb,"Cannot switch the storage engine of a non-empty database");
+				return UNQLITE_LOCKED;
+		}
+	}else if( pPager->iState != PAGER_OPEN || pPager->dbSize > 0 || pager_stored_kv_engine(pPager) ){
+		unqliteGenError(pPager->pDb,"The storage engine of an existing database cannot be changed");
+		return UNQLITE_LOCKED;
+	}
+	return unqlitePagerRegisterKvEngine(pPager,pMethods);
+}
 /*
  * Return the underlying KV storage engine instance.
  */
@@ -57565,6 +57789,27 @@ UNQLITE_PRIVATE unqlite_kv_engine * unqlitePagerGetKvEngine(unqlite *pDb)
 {
 	return pDb->sDB.pPager->pEngine;
 }
+/*
+ * Return the read-only memory view of the database file, or a NULL pointer
+ * if the file is not memory mapped. The view is obtained together with the
+ * first shared lock and stays valid until the pager is closed.
+ */
+UNQLITE_PRIVATE int unqlitePagerGetMmapView(Pager *pPager,const void **ppMap,sxi64 *pSize)
+{
+	int rc = UNQLITE_OK;
+	if( (pPager->iOpenFlags & UNQLITE_OPEN_MMAP) && !pPager->is_mem ){
+		/* Map the file if not yet done */
+		rc = pager_shared_lock(pPager);
+	}
+	if( rc == UNQLITE_OK && (pPager->iOpenFlags & UNQLITE_OPEN_MMAP) && pPager->pMmap ){
+		*ppMap = pPager->pMmap;
+		*pSize = pPager->dbByteSize;
+	}else{
+		*ppMap = 0;
+		*pSize = 0;
+	}
+	return rc;
+}
 /*
 * Allocate and initialize a new Pager object. The pager should
 * eventually be freed by passing it to unqlitePagerClose().
@@ -57677,6 +57922,15 @@ UNQLITE_PRIVATE int unqlitePagerOpen(
 		/* Append the nul terminator to the journal path */
 		pPager->zJournal[nLen + ( sizeof(UNQLITE_JOURNAL_FILE_SUFFIX) - 1)] = 0;
 	}
+	if( !is_mem ){
+		/* Reopening an existing database: start with the engine recorded in
+		 * its header, as it cannot be swapped once pages have been loaded.
+		 */
+		unqlite_kv_methods *pStored = pager_stored_kv_engine(pPager);
+		if( pStored ){
+			pMethods = pStored;
+		}
+	}
 	/* Finally, register the selected KV engine */
 	rc = unqlitePagerRegisterKvEngine(pPager,pMethods);
 	if( rc != UNQLITE_OK ){
@@ -57686,6 +57940,8 @@ UNQLITE_PRIVATE int unqlitePagerOpen(
 	if( pPager->is_mem ){
 		pPager->iState = PAGER_WRITER_FINISHED;
 		pPager->iLock = EXCLUSIVE_LOCK;
+		/* There is no header to read the page size from */
+		pPager->iPageSize = unqliteGetPageSize();
 	}else{
 		pPager->iState = PAGER_OPEN;
 		pPager->iLock = NO_LOCK;
@@ -393,6 +393,7 @@ typedef sxi64 unqlite_int64;
 #define UNQLITE_CONFIG_KV_ENGINE           4  /* ONE ARGUMENT: const char *zKvName */
 #define UNQLITE_CONFIG_DISABLE_AUTO_COMMIT 5  /* NO ARGUMENTS */
 #define UNQLITE_CONFIG_GET_KV_NAME         6  /* ONE ARGUMENT: const char **pzPtr */
+#define UNQLITE_CONFIG_GET_MMAP_VIEW       7  /* TWO ARGUMENTS: const void **ppMap, unqlite_int64 *pSize */
 /*
  * UnQLite/Jx9 Virtual Machine Configuration Commands.
  *
@@ -438,6 +439,14 @@ typedef sxi64 unqlite_int64;
  */
 #define UNQLITE_KV_CONFIG_HASH_FUNC  1 /* ONE ARGUMENT: unsigned int (*xHash)(const void *,unsigned int) */
 #define UNQLITE_KV_CONFIG_CMP_FUNC   2 /* ONE ARGUMENT: int (*xCmp)(const void *,const void *,unsigned int) */
+#define UNQLITE_KV_CONFIG_KEY_ORDER  3 /* ONE ARGUMENT: int iOrder (UNQLITE_KV_ORDER_MEMCMP or UNQLITE_KV_ORDER_LENGTH) */
+#define UNQLITE_KV_CONFIG_GET_KEY_ORDER 4 /* ONE ARGUMENT: int *pOrder */
+#define UNQLITE_KV_CONFIG_PARTITION  5 /* TWO ARGUMENTS: int iPart, int nPart */
+/*
+ * Key orders for ordered storage engines (i.e. B+tree), see UNQLITE_KV_CONFIG_KEY_ORDER.
+ */
+#define UNQLITE_KV_ORDER_MEMCMP      0 /* Bytewise, shorter keys first when one is a prefix of the other */
+#define UNQLITE_KV_ORDER_LENGTH      1 /* Shorter keys first, then bytewise */
 /*
  * Global Library Configuration Commands.
  *
@@ -1,15 +1,30 @@
 import array
+import asyncio
 import gc
+import io
+import json
+import operator
 import os
+import pickle
 import random
 import sys
 import threading
+import time
+import tracemalloc
 import unittest
 
 
 try:
+    from unqlite import AsyncUnQLite
+    from unqlite import CURSOR_MATCH_GE
+    from unqlite import CURSOR_MATCH_LE
+    from unqlite import UNQLITE_OPEN_CREATE
+    from unqlite import UNQLITE_OPEN_MMAP
+    from unqlite import UNQLITE_OPEN_READONLY
     from unqlite import UnQLite
     from unqlite import UnQLiteError
+    from unqlite import decode_value
+    from unqlite import encode_value
 except ImportError:
     sys.stderr.write('Unable to import `unqlite`. Make sure it is properly '
                      'installed.\n')
@@ -92,6 +107,66 @@ class TestKeyValueStorage(BaseTestCase):
             db.store('k3', memoryview(b'mv\x00data'))
             self.assertEqual(db.fetch('k3'), b'mv\x00data')
 
+    def test_fetch_large_and_empty_values(self):
+        # Large values span several overflow pages, which UnQLite delivers
+        # to the consumer in multiple chunks.
+        large = os.urandom(256 * 1024)
+        for db in (self.db, self.file_db):
+            db['large'] = large
+            db['empty'] = ''
+            self.assertEqual(db.fetch('large'), large)
+            self.assertEqual(db.fetch('empty'), b'')
+
+    def test_fetch_into(self):
+        buf = bytearray(8)
+        for db in (self.db, self.file_db):
+            db['k1'] = 'v1'
+            db['k2'] = 'value-two'
+            self.assertEqual(db.fetch_into('k1', buf), 2)
+            self.assertEqual(buf[:2], b'v1')
+
+            # When the buffer is too small, the full length is returned and
+            # the buffer holds the leading bytes of the value.
+            self.assertEqual(db.fetch_into('k2', buf), 9)
+            self.assertEqual(buf, b'value-tw')
+
+            mv = memoryview(bytearray(16))
+            self.assertEqual(db.fetch_into('k2', mv[4:]), 9)
+            self.assertEqual(bytes(mv[4:13]), b'value-two')
+
+            self.assertRaises(KeyError, db.fetch_into, 'k3', buf)
+            self.assertRaises(BufferError, db.fetch_into, 'k1', b'readonly')
+
+    def test_batch_operations(self):
+        for db in (self.db, self.file_db):
+            # Batches larger than the internal chunk size.
+            n = db.store_many(('k%s' % i, 'v%s' % i) for i in range(3000))
+            self.assertEqual(n, 3000)
+            self.assertEqual(db.store_many({'a': 'A', 'b': 'B'}), 2)
+            self.assertEqual(db['k2999'], b'v2999')
+            self.assertEqual(db['b'], b'B')
+
+            keys = ['k%s' % i for i in range(0, 3000, 2)]
+            values = db.fetch_many(keys)
+            self.assertEqual(values, [b'v%d' % i for i in range(0, 3000, 2)])
+
+            self.assertEqual(db.fetch_many(['a', 'x', 'b']), [b'A', None, b'B'])
+            self.assertEqual(db.fetch_many(['x', 'a'], default=False),
+                             [False, b'A'])
+            self.assertEqual(db.fetch_many([]), [])
+
+            self.assertEqual(db.delete_many(keys + ['x', 'y']), 1500)
+            self.assertFalse(db.exists('k0'))
+            self.assertTrue(db.exists('k1'))
+            self.assertEqual(len(db), 1502)
+
+    def test_store_many_atomic(self):
+        with self.file_db.transaction():
+            self.file_db['k0'] = 'v0'
+        self.assertRaises(UnQLiteError, self.file_db.store_many,
+                          [('k1', 'v1'), ('', 'empty-key'), ('k2', 'v2')])
+        self.assertEqual(list(self.file_db), [('k0', b'v0')])
+
     def test_get_default(self):
         for db in (self.db, self.file_db):
             db['k1'] = 'v1'
@@ -198,6 +273,75 @@ class TestKeyValueStorage(BaseTestCase):
             db['b'] = 'Bb'
             self.assertEqual(len(db), 2)
 
+    def test_len_tracking(self):
+        self.db.close()
+        self.file_db.close()
+        self.db = UnQLite(count_records=True)
+        self.file_db = UnQLite(self._filename, count_records=True)
+        for db in (self.db, self.file_db):
+            self.store_range(10, db)
+            self.assertEqual(len(db), 10)
+            db['k1'] = 'overwritten'
+            db.append('k2', '-appended')
+            db.append('k10', 'new')
+            self.assertEqual(len(db), 11)
+            del db['k0']
+            self.assertRaises(KeyError, db.delete, 'k0')
+            self.assertEqual(len(db), 10)
+
+            db.store_many([('k1', 'x'), ('x1', 'y'), ('x2', 'z')])
+            self.assertEqual(len(db), 12)
+            self.assertEqual(db.delete_many(['x1', 'x2', 'missing']), 2)
+            self.assertEqual(len(db), 10)
+
+            with db.cursor() as cursor:
+                cursor.seek('k5')
+                cursor.delete()
+            self.assertEqual(len(db), 9)
+            self.assertEqual(len(db), len(list(db)))
+
+            # Changes made by Jx9 scripts are not tracked, so the count is
+            # recalculated afterwards.
+            with db.vm('db_create("c"); db_store("c", {"a": 1});') as vm:
+                vm.execute()
+            self.assertEqual(len(db), len(list(db)))
+
+        # Rolling back discards the tracked count.
+        self.file_db.begin()
+        self.file_db['rb'] = 'value'
+        self.file_db.rollback()
+        self.assertEqual(len(self.file_db), len(list(self.file_db)))
+
+    def test_truncate(self):
+        for db in (self.db, self.file_db):
+            self.store_range(10, db)
+            self.assertTrue(db.truncate())
+            self.assertEqual(len(db), 0)
+            self.assertEqual(list(db), [])
+            db['k1'] = 'v1'
+            self.assertEqual(len(db), 1)
+            self.assertEqual(db['k1'], b'v1')
+
+        self.file_db.close()
+        self.file_db.open()
+        self.assertEqual(list(self.file_db), [('k1', b'v1')])
+        self.assertFalse(os.path.exists(self._filename + '.truncate'))
+
+        # The mmap flag does not make a read-write handle read-only.
+        self.file_db.close()
+        db = UnQLite(self._filename, flags=UNQLITE_OPEN_CREATE |
+                     UNQLITE_OPEN_MMAP)
+        self.assertTrue(db.truncate())
+        self.assertEqual(list(db), [])
+        db.close()
+
+        ro_db = UnQLite(self._filename, flags=0x00000001)  # Read-only.
+        self.assertRaises(UnQLiteError, ro_db.truncate)
+        ro_db.close()
+
+        self.db.close()
+        self.assertRaises(UnQLiteError, self.db.truncate)
+
     def test_autocommit(self):
         self.file_db['k1'] = 'v1'
         self.file_db.close()
@@ -283,6 +427,27 @@ class TestTransaction(BaseTestCase):
 
         self.assertRaises(KeyError, lambda: self.file_db['k1'])
 
+    def test_batch_operations_join_transaction(self):
+        db = self.file_db
+        db['x'] = 'x'
+        db.commit()
+        db.begin()
+        db['a'] = '1'
+        db.store_many([('b', '2')])
+        db.delete_many(['x'])
+        db.rollback()
+        self.assertEqual(db.fetch_many(['a', 'b', 'x']), [None, None, b'x'])
+
+        users = db.collection('users')
+        users.create()
+        users.create_index('name')
+        with db.transaction():
+            users.store({'name': 'huey'})
+            users.store_many([{'name': 'mickey'}])
+            db.rollback()
+        self.assertEqual(users.all(), [])
+        self.assertEqual(users.find(name='huey'), [])
+
 
 class TestCursor(BaseTestCase):
     def setUp(self):
@@ -377,6 +542,471 @@ class TestCursor(BaseTestCase):
                 items,
                 ['k0', 'k1', 'k2', 'k3', 'k6', 'k8', 'a0', 'k5'])
 
+    def test_fetch_batch(self):
+        for db in (self.db, self.file_db):
+            expected = sorted(('k%d' % i, str(i).encode('utf-8'))
+                              for i in range(10))
+            with db.cursor() as cursor:
+                batches = []
+                while True:
+                    batch = cursor.fetch_batch(3)
+                    if not batch:
+                        break
+                    self.assertTrue(len(batch) <= 3)
+                    batches.append(batch)
+                self.assertEqual(len(batches), 4)
+                self.assertEqual(sorted(sum(batches, [])), expected)
+
+                # Exhausted until the cursor is repositioned.
+                self.assertEqual(cursor.fetch_batch(3), [])
+                cursor.reset()
+                keys = cursor.fetch_batch(100, values=False)
+                self.assertEqual(sorted(keys), [k for k, _ in expected])
+                cursor.first()
+                values = cursor.fetch_batch(100, keys=False)
+                self.assertEqual(sorted(values), sorted(v for _, v in expected))
+
+                self.assertRaises(ValueError, cursor.fetch_batch, 0)
+                self.assertRaises(ValueError, cursor.fetch_batch, 10, False,
+                                  False)
+
+            for batch_size in (1, 4, 100):
+                self.assertEqual(sorted(db.items(batch_size)), expected)
+                self.assertEqual(sorted(db.keys(batch_size)),
+                                 [k for k, _ in expected])
+                self.assertEqual(sorted(db.values(batch_size)),
+                                 sorted(v for _, v in expected))
+
+    def test_binary_keys_and_large_values(self):
+        large = b'x' * 100000
+        for db in (self.db, self.file_db):
+            db[b'\xff\xfe'] = large
+            with db.cursor() as cursor:
+                cursor.seek(b'\xff\xfe')
+                self.assertEqual(cursor.key(), b'\xff\xfe')
+                self.assertEqual(cursor.value(), large)
+            self.assertEqual(dict(db.items())[b'\xff\xfe'], large)
+
+    def test_fetch_batch_memory(self):
+        # The buffer grown for an oversized batch is not kept by the cursor.
+        db = UnQLite()
+        db['big'] = b'x' * (4 << 20)
+        with db.cursor() as cursor:
+            tracemalloc.start()
+            try:
+                self.assertEqual(len(cursor.fetch_batch(10)), 1)
+                current, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+        self.assertTrue(peak >= 4 << 20)
+        self.assertTrue(current < 1 << 20)
+        db.close()
+
+
+class TestBtreeEngine(BaseTestCase):
+    def setUp(self):
+        super(TestBtreeEngine, self).setUp()
+        self.db.close()
+        self.file_db.close()
+        self.db = UnQLite(kv_engine='btree')
+        self.file_db = UnQLite(self._filename, kv_engine='btree')
+
+    def test_kv_engine(self):
+        for db in (self.db, self.file_db):
+            self.assertEqual(db.kv_engine(), 'btree')
+            self.assertTrue(db.ordered)
+
+        self.assertRaises(NotImplementedError, UnQLite, kv_engine='nope')
+
+    def test_ordering(self):
+        keys = ['k%03d' % i for i in range(500)]
+        random.shuffle(keys)
+        for db in (self.db, self.file_db):
+            with db.transaction():
+                for key in keys:
+                    db[key] = key
+            self.assertEqual([k for k, _ in db], sorted(keys))
+            self.assertEqual(len(db), 500)
+
+            for key in keys[:250]:
+                del db[key]
+            self.assertEqual([k for k, _ in db], sorted(keys[250:]))
+
+            # New cursors are positioned on the first record.
+            with db.cursor() as cursor:
+                self.assertEqual([k for k, _ in cursor], sorted(keys[250:]))
+
+            with db.cursor() as cursor:
+                cursor.last()
+                self.assertEqual(cursor.key(), max(keys[250:]))
+                cursor.previous_entry()
+                self.assertEqual(cursor.key(), sorted(keys[250:])[-2])
+
+            # Shorter keys sort before longer keys sharing a prefix.
+            db.update({'a': '1', 'a\x00': '2', 'ab': '3', 'b': '4'})
+            self.assertEqual([k for k, _ in db][:4], ['a', 'a\x00', 'ab', 'b'])
+
+    def test_seek(self):
+        for db in (self.db, self.file_db):
+            for i in range(0, 100, 10):
+                db['k%03d' % i] = str(i)
+
+            with db.cursor() as cursor:
+                cursor.seek('k025', CURSOR_MATCH_GE)
+                self.assertEqual(cursor.key(), 'k030')
+                cursor.seek('k025', CURSOR_MATCH_LE)
+                self.assertEqual(cursor.key(), 'k020')
+                cursor.seek('k030', CURSOR_MATCH_GE)
+                self.assertEqual(cursor.key(), 'k030')
+                cursor.seek('a', CURSOR_MATCH_GE)
+                self.assertEqual(cursor.key(), 'k000')
+                self.assertRaises(KeyError, cursor.seek, 'a', CURSOR_MATCH_LE)
+                self.assertRaises(KeyError, cursor.seek, 'z', CURSOR_MATCH_GE)
+                self.assertRaises(KeyError, cursor.seek, 'k025')
+
+    def test_match_prefix_and_range(self):
+        for db in (self.db, self.file_db):
+            for i in range(1000):
+                db['%s:%04d' % ('ab'[i % 2], i)] = str(i)
+            db['a'] = 'x'
+            db['b'] = 'y'
+
+            items = list(db.match_prefix('a:000'))
+            self.assertEqual(items, [('a:0000', b'0'), ('a:0002', b'2'),
+                                     ('a:0004', b'4'), ('a:0006', b'6'),
+                                     ('a:0008', b'8')])
+            self.assertEqual(len(list(db.match_prefix('b:'))), 500)
+            self.assertEqual(list(db.match_prefix('c')), [])
+
+            # Bounds need not exist.
+            self.assertEqual([k for k, _ in db.range('a:0995', 'b:0003')],
+                             ['a:0996', 'a:0998', 'b', 'b:0001', 'b:0003'])
+            self.assertEqual([k for k, _ in db.range('a:0995', 'b:0003',
+                                                     False)],
+                             ['a:0996', 'a:0998', 'b', 'b:0001'])
+            self.assertEqual(list(db.range('b:0003', 'a')), [])
+
+    def test_reopen(self):
+        self.store_range(100, self.file_db)
+        self.file_db.close()
+
+        # The engine is recorded in the database header.
+        db = UnQLite(self._filename)
+        self.assertEqual(db.kv_engine(), 'btree')
+        self.assertEqual(len(db), 100)
+        self.assertEqual(db['k42'], b'42')
+        db.close()
+
+        # An existing database cannot be switched to another engine.
+        self.assertRaises(UnQLiteError, UnQLite, self._filename,
+                          kv_engine='hash')
+
+        self.file_db.open()
+        self.file_db.truncate()
+        self.assertEqual(self.file_db.kv_engine(), 'btree')
+        self.assertEqual(list(self.file_db), [])
+
+    def test_existing_hash_database(self):
+        self.file_db.close()
+        db = UnQLite(self._filename)
+        db['k1'] = 'v1'
+        db.close()
+        self.assertRaises(UnQLiteError, UnQLite, self._filename,
+                          kv_engine='btree')
+
+    def test_rollback(self):
+        self.store_range(10, self.file_db)
+        self.file_db.commit()
+        self.file_db.begin()
+        for i in range(5):
+            del self.file_db['k%s' % i]
+        self.file_db['k99'] = 'x' * 10000
+        self.file_db.rollback()
+        self.assertEqual([k for k, _ in self.file_db],
+                         sorted('k%s' % i for i in range(10)))
+
+    def test_large_values(self):
+        for db in (self.db, self.file_db):
+            db['big'] = b'\x01' * 100000
+            db['small'] = 'x'
+            self.assertEqual(db['big'], b'\x01' * 100000)
+            db.append('big', b'\x02')
+            self.assertEqual(len(db['big']), 100001)
+            db['big'] = 'replaced'
+            self.assertEqual(db['big'], b'replaced')
+            self.assertEqual(list(db), [('big', b'replaced'),
+                                        ('small', b'x')])
+
+    def test_delete_all(self):
+        for db in (self.db, self.file_db):
+            self.store_range(2000, db)
+            self.assertEqual(db.flush(), 2000)
+            self.assertEqual(list(db), [])
+            self.store_range(10, db)
+            self.assertEqual(len(list(db)), 10)
+
+    def test_comparator(self):
+        self.assertEqual(self.db.comparator, 'memcmp')
+        self.file_db.close()
+        db = UnQLite(self._filename, kv_engine='btree', comparator='length')
+        self.assertEqual(db.comparator, 'length')
+        for key in ('k10', 'k2', 'k1', 'k100', 'j2', 'k'):
+            db[key] = key
+        self.assertEqual([k for k, _ in db],
+                         ['k', 'j2', 'k1', 'k2', 'k10', 'k100'])
+
+        with db.cursor() as cursor:
+            cursor.seek('k11', CURSOR_MATCH_GE)
+            self.assertEqual(cursor.key(), 'k100')
+            cursor.seek('k3', CURSOR_MATCH_LE)
+            self.assertEqual(cursor.key(), 'k2')
+
+        self.assertEqual([k for k, _ in db.range('k1', 'k10')],
+                         ['k1', 'k2', 'k10'])
+        self.assertEqual([k for k, _ in db.range('k0', 'k99', False)],
+                         ['k1', 'k2', 'k10'])
+        self.assertEqual(sorted(k for k, _ in db.match_prefix('k1')),
+                         ['k1', 'k10', 'k100'])
+
+        # The key order survives a rollback and is recorded in the header.
+        db.commit()
+        db.begin()
+        db['k3'] = 'k3'
+        db.rollback()
+        db['k11'] = 'k11'
+        self.assertEqual([k for k, _ in db],
+                         ['k', 'j2', 'k1', 'k2', 'k10', 'k11', 'k100'])
+        db.close()
+
+        db = UnQLite(self._filename, kv_engine='btree')
+        self.assertEqual(db.comparator, 'length')
+        self.assertEqual(len(db), 7)
+        db.close()
+        self.assertRaises(UnQLiteError, UnQLite, self._filename,
+                          kv_engine='btree', comparator='memcmp')
+
+        self.assertRaises(ValueError, UnQLite, comparator='nope')
+        self.assertRaises(ValueError, UnQLite, comparator='length')
+        self.assertRaises(ValueError, UnQLite, kv_engine='btree',
+                          hash_function='fnv1a')
+
+
+class TestHashFunction(BaseTestCase):
+    def test_hash_functions(self):
+        for hash_function in ('fnv1a', 'murmur3'):
+            for filename in (':mem:', self._filename):
+                db = UnQLite(filename, hash_function=hash_function)
+                self.assertEqual(db.hash_function, hash_function)
+                self.assertTrue(db.comparator is None)
+                self.store_range(1000, db)
+                self.assertEqual(len(db), 1000)
+                self.assertEqual(db['k0'], b'0')
+                self.assertEqual(db['k999'], b'999')
+                del db['k500']
+                self.assertFalse('k500' in db)
+                self.assertEqual(len(list(db)), 999)
+                db.close()
+            os.unlink(self._filename)
+
+        self.assertTrue(self.db.hash_function is None)
+        self.assertRaises(ValueError, UnQLite, hash_function='nope')
+
+    def test_reopen(self):
+        self.file_db.close()
+        db = UnQLite(self._filename, hash_function='murmur3')
+        self.store_range(100, db)
+        db.close()
+
+        db = UnQLite(self._filename, hash_function='murmur3')
+        self.assertEqual(db['k42'], b'42')
+        db.close()
+
+        # The hash function is checked against the database header.
+        for hash_function in (None, 'fnv1a'):
+            db = UnQLite(self._filename, hash_function=hash_function)
+            self.assertRaises(UnQLiteError, db.fetch, 'k42')
+            db.close()
+
+    def test_rollback(self):
+        self.file_db.close()
+        db = UnQLite(self._filename, hash_function='fnv1a')
+        db['k1'] = 'v1'
+        db.commit()
+
+        db.begin()
+        db['k2'] = 'v2'
+        db.rollback()
+        self.assertEqual(list(db), [('k1', b'v1')])
+
+        # The hash function is still used after the engine was reset.
+        db['k3'] = 'v3'
+        db.close()
+        db = UnQLite(self._filename, hash_function='fnv1a')
+        self.assertEqual(sorted(db.keys()), ['k1', 'k3'])
+        db.close()
+
+
+class TestMemoryMap(BaseTestCase):
+    def populate(self, **kwargs):
+        self.file_db.close()
+        db = UnQLite(self._filename, **kwargs)
+        db['small'] = 'hello'
+        db['empty'] = ''
+        db['big'] = b'\x01\x02' * 1000000
+        db.close()
+        return UnQLite(self._filename,
+                       flags=UNQLITE_OPEN_READONLY | UNQLITE_OPEN_MMAP)
+
+    def assertZeroCopy(self, view, zero_copy=True):
+        self.assertTrue(isinstance(view, memoryview))
+        self.assertTrue(view.readonly)
+        self.assertEqual(type(view.obj).__name__ == 'MappedValue', zero_copy)
+
+    def test_fetch_view(self):
+        for kv_engine in ('hash', 'btree'):
+            db = self.populate(kv_engine=kv_engine)
+            view = db.fetch_view('small')
+            self.assertZeroCopy(view)
+            self.assertEqual(view, b'hello')
+            self.assertEqual(db.fetch_view('empty'), b'')
+            self.assertRaises(KeyError, db.fetch_view, 'missing')
+
+            # The btree engine stores large values contiguously.
+            view = db.fetch_view('big')
+            self.assertZeroCopy(view, kv_engine == 'btree')
+            self.assertEqual(len(view), 2000000)
+            self.assertEqual(view[:4], b'\x01\x02\x01\x02')
+            self.assertRaises(TypeError, view.__setitem__, 0, 0)
+
+            with db.cursor() as cursor:
+                cursor.seek('small')
+                view = cursor.value_view()
+                self.assertZeroCopy(view)
+                self.assertEqual(view, b'hello')
+            db.close()
+            os.unlink(self._filename)
+
+    def test_views_released_on_close(self):
+        db = self.populate(kv_engine='btree')
+        view = db.fetch_view('big')
+        other = db.fetch_view('small')
+        db.close()
+        self.assertRaises(ValueError, len, view)
+        self.assertRaises(ValueError, bytes, other)
+
+        # A view whose buffer is still in use keeps the map alive until the
+        # buffer is released.
+        db.open()
+        view = db.fetch_view('big')
+        nested = memoryview(view)
+        db.close()
+        self.assertEqual(nested[:4], b'\x01\x02\x01\x02')
+        self.assertEqual(len(nested), 2000000)
+        nested.release()
+
+        db.open()
+        view = db.fetch_view('small')
+        del db
+        gc.collect()
+        self.assertEqual(view, b'hello')
+
+    def test_views_outlive_collected_cycle(self):
+        db = self.populate(kv_engine='btree')
+        view = db.fetch_view('big')
+        cycle = [db]
+        cycle.append(cycle)
+        del db, cycle
+        gc.collect()
+        self.assertEqual(bytes(view[:5]), b'\x01\x02\x01\x02\x01')
+        view.release()
+
+    def test_no_mmap(self):
+        self.file_db['k1'] = 'v1'
+        view = self.file_db.fetch_view('k1')
+        self.assertZeroCopy(view, False)
+        self.assertEqual(view, b'v1')
+        with self.file_db.cursor() as cursor:
+            cursor.first()
+            self.assertEqual(cursor.value_view(), b'v1')
+
+        self.db['k1'] = 'v1'
+        self.assertEqual(self.db.fetch_view('k1'), b'v1')
+
+
+def scan_keys(items):
+    return sorted(key for key, _ in items)
+
+
+def scan_upper(key, value):
+    return (key, value.upper())
+
+
+def scan_total(acc, key, value):
+    acc[0] += 1
+    acc[1] += len(value)
+    return acc
+
+
+def scan_merge(a, b):
+    return [a[0] + b[0], a[1] + b[1]]
+
+
+class TestParallelScan(BaseTestCase):
+    def populate(self, db):
+        with db.transaction():
+            for i in range(2000):
+                db['k%04d' % i] = b'v' * (i % 700)
+        db.commit()
+
+    def test_parallel_scan(self):
+        for kv_engine in ('hash', 'btree'):
+            self.file_db.close()
+            if os.path.exists(self._filename):
+                os.unlink(self._filename)
+            db = self.file_db = UnQLite(self._filename, kv_engine=kv_engine)
+            self.populate(db)
+            expected = sorted(db.keys())
+
+            parts = list(db.parallel_scan(scan_keys, workers=2,
+                                          partitions=5))
+            self.assertEqual(len(parts), 5)
+            self.assertEqual(sorted(k for part in parts for k in part),
+                             expected)
+
+            # A single partition visits every record.
+            self.assertEqual(list(db.parallel_scan(scan_keys, workers=1,
+                                                   partitions=1)),
+                             [expected])
+
+            results = sorted(db.parallel_map(scan_upper, workers=2))
+            self.assertEqual([k for k, _ in results], expected)
+            self.assertEqual(results[1], ('k0001', b'V'))
+
+            count, size = db.parallel_reduce(scan_total, scan_merge, [0, 0],
+                                             workers=3, partitions=7)
+            self.assertEqual(count, 2000)
+            self.assertEqual(size, sum(len(v) for v in db.values()))
+
+    def test_parallel_scan_mmap(self):
+        self.file_db.close()
+        db = UnQLite(self._filename, hash_function='fnv1a')
+        self.populate(db)
+        db.close()
+
+        db = UnQLite(self._filename, UNQLITE_OPEN_READONLY | UNQLITE_OPEN_MMAP,
+                     hash_function='fnv1a')
+        keys = sorted(k for part in db.parallel_scan(scan_keys, workers=2)
+                      for k in part)
+        self.assertEqual(len(keys), 2000)
+        db.close()
+
+    def test_parallel_scan_errors(self):
+        self.db['k1'] = 'v1'
+        self.assertRaises(UnQLiteError, list,
+                          self.db.parallel_scan(scan_keys, workers=1))
+        self.assertRaises(ValueError, list,
+                          self.file_db.parallel_scan(scan_keys, workers=0))
+
 
 class TestJx9(BaseTestCase):
     def test_vm_reset(self):
@@ -433,6 +1063,50 @@ class TestJx9(BaseTestCase):
                 'k1': {'foo': [1, 2, 3]},
                 'k2': ['v2', ['v3', 'v4']]})
 
+    def test_value_conversion(self):
+        class Str(str): pass
+        class Int(int): pass
+
+        value = {
+            'str': 'a†', 'bytes': b'b', 'int': -(2 ** 40), 'float': 1.5,
+            'true': True, 'false': False, 'none': None,
+            'list': [1, 'two', [3.5, None], {'k': 'v'}, ()],
+            'tuple': ('x', ('y', 'z')),
+            'subclasses': [Str('s'), Int(7)],
+            'invalid_utf8': b'\xff\xfe'}
+        with self.db.vm('$out = $in;') as vm:
+            vm['in'] = [value, value]
+            vm.execute()
+            out = vm['out']
+
+        expected = dict(value, bytes='b', tuple=['x', ['y', 'z']],
+                        subclasses=['s', 7])
+        expected['list'] = [1, 'two', [3.5, None], {'k': 'v'}, []]
+        self.assertEqual(out, [expected, expected])
+        self.assertTrue(isinstance(out[0]['true'], bool))
+
+        # Keys shared by several objects are decoded once.
+        k1, k2 = [sorted(obj)[0] for obj in out]
+        self.assertTrue(k1 is k2)
+
+    def test_raw_json(self):
+        script = ('$out = [{"s": "q\\"\\\\\\n\\u2020", "i": 1, "f": 0.5, '
+                  '"b": false, "n": null, "l": [1, [2]]}, 3];')
+        with self.db.vm(script) as vm:
+            vm.execute()
+            raw = vm.get_value('out', raw=True)
+            self.assertEqual(json.loads(raw.decode('utf8')), vm['out'])
+            self.assertEqual(
+                vm.get_value('out', fields=['l'], raw=True),
+                b'[{"l":[1,[2]]},3]')
+
+        # Invalid UTF-8 is replaced, so the output can always be parsed.
+        with self.db.vm('$out = $in;') as vm:
+            vm['in'] = {b'k\xff': [b'ok\xe2\x82\xac', b'\xed\xa0\x80x']}
+            vm.execute()
+            self.assertEqual(json.loads(vm.get_value('out', raw=True)),
+                             {'k\ufffd': ['ok\u20ac', '\ufffd' * 3 + 'x']})
+
     def test_embedded_nul_string_value(self):
         # Jx9 string values containing NUL bytes round-trip by length.
         with self.db.vm('$out = $in;') as vm:
@@ -462,6 +1136,74 @@ class TestJx9(BaseTestCase):
                 {'username': 'michael', 'color': 'black', '__id': 1},
             ])
 
+    def test_output_streaming(self):
+        script = 'for ($i = 0; $i < 3; $i++) { print $i; } print "\u2020";'
+        with self.db.vm(script) as vm:
+            chunks = []
+            vm.set_output(chunks.append)
+            vm.execute()
+            self.assertEqual(chunks, [b'0', b'1', b'2', b'\xe2\x80\xa0'])
+            self.assertEqual(vm.output(), '')
+
+            vm.reset()
+            buf = io.StringIO()
+            vm.set_output(buf)
+            vm.execute()
+            self.assertEqual(buf.getvalue(), '012\u2020')
+
+            def consume(n):
+                for _ in range(n):
+                    received.append((yield))
+
+            vm.reset()
+            received = []
+            vm.set_output(consume(2))
+            vm.execute()
+            self.assertEqual(received, [b'0', b'1'])
+
+            # Output is buffered again, including after a recompile.
+            vm.reset()
+            vm.set_output(None)
+            vm.execute()
+            self.assertEqual(vm.output(), '012\u2020')
+            vm.compile()
+            vm.execute()
+            self.assertEqual(vm.output(), '012\u2020')
+
+        def fail(chunk):
+            calls.append(chunk)
+            raise ValueError(chunk)
+
+        # Errors raised by the target abort the script.
+        calls = []
+        vm = self.db.vm('print "a"; print "b";')
+        vm.set_output(fail)
+        vm.compile()
+        with self.assertRaises(ValueError):
+            vm.execute()
+        self.assertEqual(calls, [b'a'])
+        self.assertRaises(TypeError, vm.set_output, 1)
+        vm.close()
+
+
+    def test_run(self):
+        vm = self.db.vm('$ret = $a + $b; $out = [$a, $b];')
+        self.assertEqual(vm.run(a=1, b=2), 3)
+        self.assertTrue(vm.need_reset)
+        self.assertEqual(vm.run(a=3, b=4.5), 7.5)
+        self.assertEqual(vm.run('out', a='x', b=[1, {'k': None}]),
+                         ['x', [1, {'k': None}]])
+        self.assertEqual(vm.run('out', a=None, b=b'y'), [None, 'y'])
+        self.assertTrue(vm.run(None, a=1, b=1) is None)
+        self.assertEqual(vm['ret'], 2)
+        self.assertRaises(KeyError, vm.run, 'missing')
+
+        # Variables are re-bound after the script is re-compiled.
+        vm.compile()
+        self.assertFalse(vm.need_reset)
+        self.assertEqual(vm.run(a=2, b=2), 4)
+        vm.close()
+
 
 class TestCursorSilentError(BaseTestCase):
     def test_double_iteration_miscount(self):
@@ -580,6 +1322,381 @@ class TestUtils(BaseTestCase):
         self.assertEqual(len(rs), 10)
 
 
+class TestReadCache(BaseTestCase):
+    def test_read_cache(self):
+        db = UnQLite(cache_size=3)
+        self.assertTrue(self.db.cache_stats() is None)
+        db['k1'] = 'v1'
+        db['k2'] = 'v2'
+        self.assertEqual(db['k1'], b'v1')
+        self.assertEqual(db.get('k1'), b'v1')
+        self.assertRaises(KeyError, db.fetch, 'missing')
+        self.assertFalse('missing' in db)
+        self.assertFalse(db.exists('missing'))
+        self.assertEqual(db.cache_stats(), {'hits': 4, 'misses': 1,
+                                            'evictions': 0, 'entries': 3,
+                                            'bytes': 15})
+
+        # Writes through the handle keep the cache current.
+        db.append('k1', '-a')
+        self.assertEqual(db['k1'], b'v1-a')
+        db['missing'] = 'found'
+        self.assertEqual(db['missing'], b'found')
+        del db['k2']
+        self.assertFalse('k2' in db)
+        db['k3'] = 'v3'
+        db.store_many([('k1', 'v1-b'), ('k3', 'v3-b')])
+        self.assertEqual(db['k1'], b'v1-b')
+        self.assertEqual(db['k3'], b'v3-b')
+
+        with db.cursor() as cursor:
+            cursor.seek('k3')
+            cursor.delete()
+        self.assertRaises(KeyError, db.fetch, 'k3')
+        db.flush()
+        self.assertRaises(KeyError, db.fetch, 'k1')
+        self.assertTrue(db.cache_stats()['evictions'] > 0)
+
+        # Jx9 scripts may write to the database, so they empty the cache.
+        db['k1'] = 'v1'
+        self.assertEqual(db['k1'], b'v1')
+        with db.vm('$x = 1;') as vm:
+            vm.execute()
+        self.assertEqual(db.cache_stats()['entries'], 0)
+        self.assertEqual(db['k1'], b'v1')
+        db.close()
+
+    def test_cache_bytes(self):
+        db = UnQLite(cache_size=100, cache_bytes=10)
+        db['k1'] = 'v' * 20  # Too large to be cached.
+        db['k2'] = 'v2'
+        db['k3'] = 'v3'
+        db['k4'] = 'v4'
+        self.assertEqual(db['k1'], b'v' * 20)
+        stats = db.cache_stats()
+        self.assertEqual((stats['entries'], stats['bytes']), (2, 8))
+        db.clear_cache()
+        self.assertEqual(db.cache_stats()['entries'], 0)
+        db.close()
+
+    def test_rollback(self):
+        db = self.file_db
+        self.file_db = UnQLite(self._filename, cache_size=10)
+        db.close()
+        db = self.file_db
+        db['k1'] = 'v1'
+        db.commit()
+        db.begin()
+        db['k1'] = 'v1-1'
+        self.assertEqual(db['k1'], b'v1-1')
+        db.rollback()
+        self.assertEqual(db['k1'], b'v1')
+
+
+class TestCodec(BaseTestCase):
+    def test_msgpack(self):
+        values = [None, True, False, 0, 127, 128, 2 ** 16, 2 ** 64 - 1, -1,
+                  -33, -2 ** 63, 1.5, '', 'x' * 40, '\u00e9' * 300, b'',
+                  b'\x00' * 300, [], list(range(20)), {},
+                  {'k%s' % i: [i, None] for i in range(20)}]
+        for value in values:
+            data = encode_value(value, 'msgpack')
+            self.assertEqual(decode_value(data, 'msgpack'), value)
+
+        # Encoding follows the msgpack specification.
+        self.assertEqual(encode_value({'a': [1, -1, None, True, b'x']},
+                                      'msgpack'),
+                         b'\x81\xa1a\x95\x01\xff\xc0\xc3\xc4\x01x')
+        self.assertEqual(decode_value(encode_value((1, 2), 'msgpack'),
+                                      'msgpack'), [1, 2])
+
+        self.assertRaises(TypeError, encode_value, object(), 'msgpack')
+        self.assertRaises(OverflowError, encode_value, 2 ** 64, 'msgpack')
+        nested = []
+        nested.append(nested)
+        self.assertRaises(ValueError, encode_value, nested, 'msgpack')
+        for data in (b'\x92\x01', b'\xc1', b'\x01\x02'):
+            self.assertRaises(ValueError, decode_value, data, 'msgpack')
+        self.assertRaises(ValueError, encode_value, 1, 'struct')
+
+    def test_key_value(self):
+        db = UnQLite(codec='msgpack')
+        self.assertEqual(db.codec, 'msgpack')
+        db['k1'] = {'name': 'huey', 'tags': ['cat']}
+        db['k2'] = 2
+        db.store_many([('k3', None), ('k4', 1.5)])
+        self.assertEqual(db['k1'], {'name': 'huey', 'tags': ['cat']})
+        self.assertEqual(db.fetch_many(['k2', 'k3', 'kx'], 'missing'),
+                         [2, None, 'missing'])
+        self.assertEqual(list(db.items()), [
+            ('k1', {'name': 'huey', 'tags': ['cat']}),
+            ('k2', 2),
+            ('k3', None),
+            ('k4', 1.5)])
+        with db.cursor() as cursor:
+            cursor.seek('k4')
+            self.assertEqual(cursor.value(), 1.5)
+
+        # Raw access returns the serialized value.
+        self.assertEqual(db.fetch_view('k2').tobytes(), b'\x02')
+        self.assertRaises(ValueError, db.append, 'k2', b'x')
+
+        with db.write_buffer():
+            db['k5'] = [1, 2]
+            self.assertEqual(db['k5'], [1, 2])
+            self.assertRaises(ValueError, db.append, 'k5', b'x')
+        self.assertEqual(db['k5'], [1, 2])
+        db.close()
+
+    def test_pickle(self):
+        db = UnQLite(codec='pickle')
+        db['k1'] = {'values': {1, 2}, 'point': (1.5, 2.5)}
+        self.assertEqual(db['k1'], {'values': {1, 2}, 'point': (1.5, 2.5)})
+
+        # Out-of-band buffers are stored after the pickle stream.
+        data = bytearray(b'\xff' * 1000)
+        db['k2'] = [pickle.PickleBuffer(data), 'x']
+        value = db['k2']
+        self.assertEqual(bytes(value[0]), bytes(data))
+        self.assertTrue(value[0].readonly)
+        self.assertEqual(value[1], 'x')
+        self.assertEqual(list(db.values())[1][1], 'x')
+        db.close()
+
+    def test_collection_indexes(self):
+        db = UnQLite(codec='msgpack')
+        users = db.collection('users')
+        users.create()
+        users.create_index('name')
+        users.store([{'name': 'huey'}, {'name': 'mickey'}])
+        self.assertEqual([row['name'] for row in users.find(name='huey')],
+                         ['huey'])
+        db.close()
+
+
+class TestMetrics(BaseTestCase):
+    def test_metrics(self):
+        self.assertTrue(self.db.stats() is None)
+        db = self.file_db
+        self.file_db = UnQLite(self._filename, metrics=True)
+        db.close()
+        db = self.file_db
+
+        db['k1'] = 'v1'
+        db.append('k1', '-a')
+        self.assertEqual(db['k1'], b'v1-a')
+        self.assertFalse('k2' in db)
+        self.assertEqual(db.get('k2'), None)
+        self.assertEqual(db.fetch_many(['k1', 'k2']), [b'v1-a', None])
+        db.store_many([('k2', 'v2'), ('k3', 'v3')])
+        del db['k3']
+        with db.cursor() as cursor:
+            cursor.seek('k2')
+            self.assertEqual(cursor.value(), b'v2')
+
+        stats = db.stats()
+        ops = stats['operations']
+        for name, count in (('store', 1), ('append', 1), ('fetch', 2),
+                            ('exists', 1), ('fetch_many', 1),
+                            ('store_many', 1), ('delete', 1), ('begin', 1),
+                            ('commit', 1), ('cursor_seek', 1),
+                            ('rollback', 0)):
+            self.assertEqual(ops[name]['count'], count, name)
+        fetch = ops['fetch']
+        self.assertEqual(fetch['errors'], 0)
+        self.assertEqual(sum(n for _, n in fetch['histogram']), 2)
+        self.assertTrue(fetch['max_ns'] <= fetch['total_ns'])
+        self.assertTrue(fetch['p50_ns'] <= fetch['p99_ns'])
+        self.assertEqual((stats['hits'], stats['misses']), (2, 3))
+        self.assertEqual(stats['bytes_written'], 16)
+        self.assertEqual(stats['status_codes'], {'NOTFOUND': 1})
+
+        db.reset_stats()
+        self.assertEqual(db.stats()['operations']['store']['count'], 0)
+
+        accum = []
+        db.on_operation(lambda *args: accum.append(args))
+        db['k4'] = 'v4'
+        self.assertRaises(KeyError, db.fetch, 'k5')
+        self.assertEqual([(op, status) for op, _, status in accum],
+                         [('store', 0), ('fetch', -6)])
+        db.on_operation(None)
+        db['k5'] = 'v5'
+        self.assertEqual(len(accum), 2)
+
+    def test_vm(self):
+        db = UnQLite(metrics=True)
+        with db.vm('$ret = 1;') as vm:
+            vm.execute()
+        ops = db.stats()['operations']
+        self.assertEqual(ops['compile']['count'], 1)
+        self.assertEqual(ops['execute']['count'], 1)
+        db.close()
+
+
+class TestVMProfiler(BaseTestCase):
+    def test_profile(self):
+        db = UnQLite(vm_cache_size=4)
+        profiler = db.profile_vms()
+        users = db.collection('users')
+        users.create()
+        users.store([{'name': 'huey'}, {'name': 'mickey'}])
+        self.assertEqual(len(users.filter(lambda r: r['name'] == 'huey')), 1)
+        users.all()
+        users.all()
+        with db.vm('print "hello"; $ret = 1;') as vm:
+            vm.execute()
+            self.assertEqual(vm.output(), 'hello')
+            self.assertEqual(vm['ret'], 1)
+
+        stats = dict((data['script'], data) for data in profiler.stats())
+        data = stats['$ret = db_fetch_all($collection);']
+        self.assertEqual((data['runs'], data['compiles']), (2, 1))
+        self.assertEqual(data['total_ns'], data['compile_ns'] +
+                         data['bind_ns'] + data['execute_ns'] +
+                         data['extract_ns'])
+        self.assertEqual(len(data['hash']), 12)
+        data = stats['$ret = db_fetch_all($collection, _filter_fn)']
+        self.assertEqual(data['callbacks'], 2)
+        self.assertTrue(0 < data['callback_ns'] <= data['execute_ns'])
+        self.assertEqual(stats['print "hello"; $ret = 1;']['output_bytes'], 5)
+        totals = [data['total_ns'] for data in profiler.stats()]
+        self.assertEqual(totals, sorted(totals, reverse=True))
+
+        profiler.close()
+        users.all()
+        data = [d for d in profiler.stats()
+                if d['script'] == '$ret = db_fetch_all($collection);'][0]
+        self.assertEqual(data['runs'], 2)
+        profiler.reset()
+        self.assertEqual(profiler.stats(), [])
+        db.close()
+
+    def test_slow(self):
+        db = UnQLite()
+        slow = []
+        db.profile_vms(slow_ms=0, on_slow=slow.append)
+        with db.vm('$ret = 1;') as vm:
+            vm.execute()
+        self.assertEqual(len(slow), 1)
+        self.assertEqual(slow[0]['script'], '$ret = 1;')
+        self.assertTrue(slow[0]['execute_ns'] > 0)
+        db.close()
+
+
+class TestWriteBuffer(BaseTestCase):
+    def test_write_buffer(self):
+        db = self.file_db
+        db['k1'] = 'v1'
+        db['k2'] = 'v2'
+        db.commit()
+        with db.write_buffer(max_ops=100) as buf:
+            db['k1'] = 'v1-1'
+            db.append('k2', '-a')
+            db.append('k3', 'v3')
+            db.delete('k1')
+            db.store('k4', 'v4')
+            self.assertRaises(KeyError, db.delete, 'k1')
+            self.assertRaises(KeyError, db.delete, 'missing')
+            self.assertEqual(len(buf), 5)
+
+            # Reads through the database see the queued writes.
+            self.assertFalse('k1' in db)
+            self.assertRaises(KeyError, db.fetch, 'k1')
+            self.assertEqual(db['k2'], b'v2-a')
+            self.assertEqual(db['k3'], b'v3')
+            self.assertEqual(db.get('k4'), b'v4')
+
+            # Other handles do not see them until they are flushed.
+            other = UnQLite(self._filename)
+            self.assertEqual(other['k1'], b'v1')
+            self.assertFalse('k4' in other)
+            other.close()
+
+            self.assertEqual(buf.flush(), 4)
+            self.assertEqual(len(buf), 0)
+            self.assertEqual(buf.flush(), 0)
+
+        self.assertTrue(buf.closed)
+        self.assertRaises(UnQLiteError, buf.store, 'k5', 'v5')
+        db['k5'] = 'v5'  # Written directly.
+        self.assertEqual(dict(db), {'k2': b'v2-a', 'k3': b'v3',
+                                    'k4': b'v4', 'k5': b'v5'})
+        self.assertEqual(len(db), 4)
+
+    def test_flush_triggers(self):
+        db = self.file_db
+        events = []
+        buf = db.write_buffer(max_ops=3)
+        db['k1'] = 'v1'
+        buf.on_commit(events.append)
+        db['k2'] = 'v2'
+        self.assertEqual(events, [])
+        db['k3'] = 'v3'
+        self.assertEqual(events, [None])
+        self.assertEqual(len(buf), 0)
+
+        # Nothing is queued, so the callback runs immediately.
+        buf.on_commit(events.append)
+        self.assertEqual(events, [None, None])
+
+        # Operations reading the database directly flush first.
+        db['k4'] = 'v4'
+        self.assertEqual(sorted(db.keys()), ['k1', 'k2', 'k3', 'k4'])
+        self.assertEqual(len(buf), 0)
+        self.assertRaises(UnQLiteError, db.write_buffer)
+        buf.close()
+
+        buf = db.write_buffer(max_delay_ms=10)
+        db['k5'] = 'v5'
+        buf.on_commit(events.append)
+        for i in range(100):
+            if len(events) == 3:
+                break
+            time.sleep(0.01)
+        self.assertEqual(events, [None, None, None])
+        other = UnQLite(self._filename)
+        self.assertEqual(other['k5'], b'v5')
+        other.close()
+
+        # Closing the database flushes and detaches the buffer.
+        db['k6'] = 'v6'
+        db.close()
+        self.assertTrue(buf.closed)
+        db.open()
+        self.assertEqual(db['k6'], b'v6')
+
+    def test_rollback(self):
+        db = self.file_db
+        db['k0'] = 'v0'
+        db.commit()
+        events = []
+        buf = db.write_buffer(max_ops=100, max_delay_ms=10)
+
+        # Writes in a transaction are committed or rolled back with it.
+        with self.assertRaises(ValueError):
+            with db.transaction():
+                db['k1'] = 'v1'
+                db.delete('k0')
+                self.assertEqual(len(buf), 0)
+                time.sleep(0.05)
+                raise ValueError
+        with db.transaction():
+            db['k2'] = 'v2'
+
+        # Rolling back discards the queued writes.
+        db['k3'] = 'v3'
+        buf.on_commit(events.append)
+        db.rollback()
+        self.assertEqual(len(buf), 0)
+        self.assertTrue(isinstance(events[0], UnQLiteError))
+        buf.close()
+
+        db.close()
+        db.open()
+        self.assertEqual(dict(db), {'k0': b'v0', 'k2': b'v2'})
+
+
 class TestMultiThreaded(BaseTestCase):
     def test_mt(self):
         # Multiple writers or reserved locks are not allowed, so we have to do
@@ -605,6 +1722,159 @@ class TestMultiThreaded(BaseTestCase):
         for t in threads: t.start()
         for t in threads: t.join()
 
+    def test_close_while_reading(self):
+        db = self.file_db
+        keys = ['k%d' % i for i in range(500)]
+        db.store_many((key, 'v' * 4096) for key in keys)
+        barrier = threading.Barrier(5)
+        errors = []
+
+        def read():
+            barrier.wait()
+            try:
+                while True:
+                    db.fetch_many(keys)
+            except UnQLiteError as exc:
+                errors.append(exc)
+
+        threads = [threading.Thread(target=read) for i in range(4)]
+        for t in threads: t.start()
+        barrier.wait()
+        self.assertTrue(db.close())
+        for t in threads: t.join()
+        self.assertEqual(len(errors), 4)
+
+    def test_iterate_while_writing(self):
+        db = self.file_db
+        db.store_many(('k%04d' % i, 'v%d' % i) for i in range(1000))
+        done = threading.Event()
+
+        def write():
+            i = 0
+            while not done.is_set():
+                db.store('x%04d' % (i % 100), 'x' * 512)
+                db.delete('x%04d' % (i % 100))
+                i += 1
+
+        t = threading.Thread(target=write)
+        t.start()
+        try:
+            for i in range(20):
+                keys = [key for key, _ in db.items() if key[0] == 'k']
+                self.assertEqual(len(keys), 1000)
+        finally:
+            done.set()
+            t.join()
+
+
+class TestAsync(BaseTestCase):
+    def setUp(self):
+        super(TestAsync, self).setUp()
+        self.file_db.close()
+
+    def test_key_value(self):
+        async def run(db):
+            await asyncio.gather(*[db.store('k%03d' % i, 'v%d' % i)
+                                   for i in range(200)])
+            values = await asyncio.gather(*[db.fetch('k%03d' % i)
+                                            for i in range(200)])
+            self.assertEqual(values, [b'v%d' % i for i in range(200)])
+
+            with self.assertRaises(KeyError):
+                await db.fetch('missing')
+            with self.assertRaises(KeyError):
+                await db.delete('missing')
+            self.assertEqual(await db.get('missing', 'x'), 'x')
+
+            await db.append('k000', '-a')
+            self.assertEqual(await db.fetch('k000'), b'v0-a')
+            await db.delete('k001')
+            self.assertFalse(await db.exists('k001'))
+            self.assertTrue(await db.exists('k002'))
+
+            keys = [key async for key in db.keys(batch_size=7)]
+            self.assertEqual(sorted(keys), ['k%03d' % i for i in range(200)
+                                            if i != 1])
+            items = [item async for item in db]
+            self.assertEqual(len(items), 199)
+            self.assertEqual(await db.run(len), 199)
+            await db.close()
+
+        asyncio.run(run(AsyncUnQLite()))
+        asyncio.run(run(AsyncUnQLite(self._filename)))
+
+        # Writes were committed by the I/O thread.
+        db = UnQLite(self._filename)
+        self.assertEqual(len(db), 199)
+        db.close()
+
+    def test_transaction(self):
+        async def run():
+            async with AsyncUnQLite(self._filename) as db:
+                async with db.transaction():
+                    await db.store('k1', 'v1')
+                try:
+                    async with db.transaction():
+                        await db.store('k2', 'v2')
+                        raise ValueError('rollback')
+                except ValueError:
+                    pass
+                self.assertTrue(await db.exists('k1'))
+                self.assertFalse(await db.exists('k2'))
+            self.assertRaises(UnQLiteError, db.fetch, 'k1')
+
+        asyncio.run(run())
+
+    def test_transaction_isolation(self):
+        async def run():
+            async with AsyncUnQLite(self._filename) as db:
+                started = asyncio.Event()
+
+                async def other():
+                    await started.wait()
+                    await db.store('other', '1')
+                    return await db.exists('k1')
+
+                async def child():
+                    await db.store('child', '1')
+
+                # Tasks created before the transaction are not part of it,
+                # so their operations wait until it is rolled back.
+                task = asyncio.create_task(other())
+                try:
+                    async with db.transaction():
+                        await db.store('k1', 'v1')
+                        started.set()
+                        await asyncio.sleep(0.05)
+                        self.assertFalse(task.done())
+                        await asyncio.create_task(child())
+                        raise ValueError('rollback')
+                except ValueError:
+                    pass
+                self.assertFalse(await task)
+                self.assertEqual(await db.fetch('other'), b'1')
+                self.assertFalse(await db.exists('k1'))
+                self.assertFalse(await db.exists('child'))
+
+        asyncio.run(run())
+
+    def test_collection(self):
+        async def run():
+            async with AsyncUnQLite() as db:
+                users = db.collection('users')
+                await users.create()
+                await users.store([{'name': 'u%d' % i} for i in range(250)])
+                self.assertEqual(await users.fetch(1),
+                                 {'name': 'u1', '__id': 1})
+                records = [record async for record in users]
+                self.assertEqual([r['name'] for r in records],
+                                 ['u%d' % i for i in range(250)])
+                records = [r async for r in users.iterator(batch_size=100,
+                                                           fields=('name',))]
+                self.assertEqual(records[-1], {'name': 'u249', '__id': 249})
+
+        asyncio.run(run())
+
 
 class TestCollection(BaseTestCase):
     def test_basic_crud_mem(self):
@@ -786,6 +2056,14 @@ class TestCollection(BaseTestCase):
         for x in range(10):
             self.assertEqual([r['k'] for r in it], list(range(10)))
 
+        # Rows are fetched in batches; results do not depend on batch size.
+        for batch_size in (1, 3, 5, 10, 11):
+            it = reg.iterator(batch_size=batch_size)
+            self.assertEqual([r['k'] for r in it], list(range(10)))
+            self.assertEqual([r['k'] for r in it], list(range(10)))
+
+        self.assertRaises(ValueError, reg.iterator, 0)
+
     def test_independent_iterators(self):
         reg = self.db.collection('reg')
         self.assertTrue(reg.create())
@@ -845,6 +2123,210 @@ class TestCollection(BaseTestCase):
             {'__id': 5, 'k6': 'v6', 'data': 6},
             {'__id': 8, 'k9': 'v9', 'data': 9}])
 
+    def test_where(self):
+        people = self.db.collection('people')
+        self.assertTrue(people.create())
+        people.store_many([
+            {'name': 'huey', 'age': 14, 'status': 'active'},
+            {'name': 'mickey', 'age': 10.0, 'status': 'inactive'},
+            {'name': 'zaizee', 'age': '10', 'status': 'active'},
+            {'name': 'beanie', 'status': True},
+            {'name': '1'}])
+
+        def ids(**lookups):
+            return [row['__id'] for row in people.where(**lookups)]
+
+        self.assertEqual(ids(), [0, 1, 2, 3, 4])
+        self.assertEqual(ids(status='active'), [0, 2])
+        self.assertEqual(ids(status='active', age__gt=10), [0])
+        self.assertEqual(ids(age=10), [1])
+        self.assertEqual(ids(age__lte=10), [1])
+        self.assertEqual(ids(age__ne=10), [0, 2, 3, 4])
+        self.assertEqual(ids(age__isnull=True), [3, 4])
+        self.assertEqual(ids(age__isnull=False), [0, 1, 2])
+        self.assertEqual(ids(name=1), [])
+        self.assertEqual(ids(name='1'), [4])
+        self.assertEqual(ids(status=True), [3])
+        self.assertEqual(ids(status__in=['active', 'gone']), [0, 2])
+        self.assertEqual(ids(name__in=('mickey', 'beanie')), [1, 3])
+        self.assertEqual(ids(name='nobody'), [])
+
+    def test_projection(self):
+        people = self.db.collection('people')
+        self.assertTrue(people.create())
+        people.store_many([
+            {'name': 'huey', 'age': 14, 'meta': {'k': [1, 2]}},
+            {'name': 'mickey', 'meta': None},
+            ['not', 'an', 'object']])
+
+        self.assertEqual(people.fetch(0, fields=['name', 'age']),
+                         {'__id': 0, 'name': 'huey', 'age': 14})
+        self.assertEqual(people.fetch(1, fields=['age']), {'__id': 1})
+        self.assertEqual(people.fetch(0, fields=[]), {'__id': 0})
+
+        expected = [
+            {'__id': 0, 'name': 'huey'},
+            {'__id': 1, 'name': 'mickey'},
+            ['not', 'an', 'object']]
+        self.assertEqual(people.all(fields=['name']), expected)
+        self.assertEqual(list(people.iterator(2, fields=['name'])), expected)
+        self.assertEqual(people.filter(lambda r: 'age' in r, fields=['meta']),
+                         [{'__id': 0, 'meta': {'k': [1, 2]}}])
+
+        with self.db.vm('$x = db_fetch_by_id("people", 0);') as vm:
+            vm.execute()
+            self.assertEqual(vm.get_value('x', fields=['age']),
+                             {'__id': 0, 'age': 14})
+
+    def test_indexes(self):
+        docs = self.file_db.collection('docs')
+        self.assertTrue(docs.create())
+        docs.store_many([
+            {'ext': 'a', 'tenant': 1, 'score': 1.5},
+            {'ext': 'b', 'tenant': 2, 'score': 3},
+            {'ext': 'c', 'tenant': 1, 'score': 'x'},
+            {'tenant': 2.0}])
+
+        self.assertEqual(docs.indexes(), [])
+        self.assertTrue(docs.create_index('ext'))
+        self.assertTrue(docs.create_index('tenant'))
+        self.assertFalse(docs.create_index('tenant'))
+        self.assertEqual(docs.indexes(), ['ext', 'tenant'])
+
+        def ids(**lookups):
+            return [row['__id'] for row in docs.find(**lookups)]
+
+        self.assertEqual(ids(ext='b'), [1])
+        self.assertEqual(ids(ext='z'), [])
+        self.assertEqual(ids(tenant=2), [1, 3])
+        self.assertEqual(ids(tenant='2'), [])
+        self.assertEqual(ids(tenant=1, ext='c'), [2])
+        self.assertEqual(ids(ext__in=['a', 'c', 'z']), [0, 2])
+        self.assertEqual(ids(tenant__gte=2), [1, 3])
+        self.assertEqual(ids(ext__lt='c'), [0, 1])
+        self.assertRaises(ValueError, docs.find, score=3)
+        self.assertRaises(ValueError, docs.find, tenant__gt=None)
+
+        # Writes through the collection keep the indexes up-to-date.
+        self.assertEqual(docs.store({'ext': 'd', 'tenant': 3}), 4)
+        self.assertEqual(ids(tenant__gt=2), [4])
+        self.assertEqual(docs.store_many([{'ext': 'e'}, {'ext': 'f'}]),
+                         range(5, 7))
+        self.assertEqual(ids(ext__in=['e', 'f']), [5, 6])
+
+        self.assertTrue(docs.update(1, {'ext': 'b2', 'tenant': 2}))
+        self.assertEqual(ids(ext='b'), [])
+        self.assertEqual(ids(ext='b2'), [1])
+        self.assertTrue(docs.delete(3))
+        self.assertEqual(ids(tenant=2), [1])
+
+        self.assertTrue(docs.drop_index('ext'))
+        self.assertFalse(docs.drop_index('ext'))
+        self.assertEqual(docs.indexes(), ['tenant'])
+        self.assertRaises(ValueError, docs.find, ext='a')
+
+        self.assertTrue(docs.drop())
+        self.assertEqual(docs.indexes(), [])
+        self.assertEqual(list(self.file_db.keys()), [])
+
+    def test_index_lookups(self):
+        values = [-2 ** 53 - 1, -2 ** 53, -1.5, -1, -0.0, 0, 0.5, 1, 1.0, 2,
+                  2 ** 53, 2 ** 53 + 1, '', 'a', 'a\x00', 'a\x01b', 'ab', 'b',
+                  None, True, False]
+        ops = {'lt': operator.lt, 'lte': operator.le, 'gt': operator.gt,
+               'gte': operator.ge}
+
+        def comparable(a, b):
+            if isinstance(a, str) or isinstance(b, str):
+                return isinstance(a, str) and isinstance(b, str)
+            return not isinstance(a, (bool, type(None))) and \
+                not isinstance(b, (bool, type(None)))
+
+        for db in (self.file_db, UnQLite(kv_engine='btree')):
+            docs = db.collection('docs')
+            docs.create()
+            docs.create_index('v')
+            docs.store_many([{'v': value} for value in values])
+
+            def ids(**lookups):
+                return sorted(row['__id'] for row in docs.find(**lookups))
+
+            for i, value in enumerate(values):
+                expected = [j for j, other in enumerate(values)
+                            if other is value or (comparable(other, value)
+                                                  and other == value)]
+                self.assertEqual(ids(v=value), expected)
+                if isinstance(value, bool) or value is None:
+                    continue
+                for op, fn in ops.items():
+                    expected = [j for j, other in enumerate(values)
+                                if comparable(other, value) and
+                                fn(other, value)]
+                    self.assertEqual(ids(**{'v__' + op: value}), expected)
+
+            # Only the entries of the updated record change.
+            docs.update(1, {'v': 'z'})
+            self.assertEqual(ids(v__gt='b'), [1])
+            self.assertEqual(ids(v=-2 ** 53), [])
+            docs.drop_index('v')
+            self.assertEqual([key for key in db.keys()
+                              if '\x00idx' in str(key)], [])
+
+    def test_index_lookups_fetch(self):
+        # Without an ordered engine, equality lookups fetch the matching
+        # tokens' entries instead of walking the other keys.
+        self.file_db.close()
+        self.file_db = db = UnQLite(self._filename, metrics=True)
+        db.store_many(('k%04d' % i, 'v') for i in range(1000))
+        docs = db.collection('docs')
+        docs.create()
+        docs.create_index('v')
+        docs.store_many([{'v': i % 3} for i in range(30)])
+
+        db.reset_stats()
+        self.assertEqual(len(docs.find(v=1)), 10)
+        self.assertEqual(len(docs.find(v__in=[0, 2, 3])), 20)
+        self.assertEqual(len(docs.find(v__gte=1)), 20)
+        ops = db.stats()['operations']
+        self.assertEqual(ops['cursor_read']['count'], 0)
+        self.assertEqual(ops['cursor_seek']['count'], 0)
+        self.assertEqual(ops['fetch']['count'], 7)
+
+    def test_index_cache(self):
+        db = self.file_db
+        docs = db.collection('docs')
+        docs.create()
+        docs.store({'k': 1})
+        self.assertEqual(docs.indexes(), [])
+        db.commit()
+
+        # Indexes created through one Collection are used by the others.
+        with db.transaction():
+            db.collection('docs').create_index('k')
+            docs.store({'k': 1})
+            self.assertEqual(len(docs.find(k=1)), 2)
+            db.rollback()
+        self.assertEqual(docs.indexes(), [])
+        self.assertRaises(ValueError, docs.find, k=1)
+
+    def test_store_many(self):
+        users = self.file_db.collection('users')
+        self.assertTrue(users.create())
+        users.store({'name': 'u0'})
+
+        ids = users.store_many(({'name': 'u%d' % i} for i in range(1, 26)),
+                               chunk_size=10)
+        self.assertEqual(ids, range(1, 26))
+        self.assertEqual(len(users), 26)
+        self.assertEqual(users.fetch(25), {'name': 'u25', '__id': 25})
+        self.assertEqual([r['__id'] for r in users.all()], list(range(26)))
+
+        self.assertEqual(users.store_many([]), range(0))
+        self.assertRaises(ValueError, users.store_many, [{}], chunk_size=0)
+
+        missing = self.file_db.collection('missing')
+        self.assertRaises(ValueError, missing.store_many, [{'k': 'v'}])
+
     def test_odd_values_mem(self):
         self._test_odd_values(self.db)
 
@@ -896,5 +2378,84 @@ class TestCollection(BaseTestCase):
         self.assertTrue(isinstance(res['f'], int))
 
 
+class TestCollectionVMCache(BaseTestCase):
+    def setUp(self):
+        super(TestCollectionVMCache, self).setUp()
+        self.db = UnQLite(vm_cache_size=4)
+
+    def test_vm_cache(self):
+        users = self.db.collection('users')
+        self.assertTrue(users.create())
+        for i in range(10):
+            self.assertEqual(users.store({'name': 'u%d' % i}), i)
+        self.assertEqual(len(users), 10)
+        self.assertEqual(users.fetch(3), {'name': 'u3', '__id': 3})
+        self.assertEqual(users.fetch(99), None)
+        self.assertEqual(len(users.all()), 10)
+
+        # Writes made outside the collection are visible to cached VMs.
+        with self.db.vm('db_store("users", {"name": "ext"});') as vm:
+            vm.execute()
+        self.assertEqual(len(users), 11)
+        self.assertEqual(users.last_record_id(), 10)
+
+        other = self.db.collection('other')
+        other.create()
+        other.store({'k': 1})
+        self.assertEqual(len(other), 1)
+        self.assertEqual(len(users), 11)
+
+        self.assertTrue(users.drop())
+        self.assertFalse(users.exists())
+        self.assertRaises(ValueError, users.store, {'name': 'x'})
+
+        self.db.clear_vm_cache()
+        self.assertEqual(other.all(), [{'k': 1, '__id': 0}])
+
+    def test_close_reopen(self):
+        users = self.db.collection('users')
+        users.create()
+        users.store({'name': 'huey'})
+        self.db.close()
+        self.db.open()
+        users.create()
+        self.assertEqual(len(users), 0)
+        self.assertEqual(users.store({'name': 'mickey'}), 0)
+
+    def test_record_cursor(self):
+        users = self.db.collection('users')
+        users.create()
+        users.store([{'name': 'huey'}, {'name': 'mickey'}])
+        for i in range(3):
+            self.assertEqual(users.fetch_current(),
+                             {'name': 'huey', '__id': 0})
+            self.assertEqual(users.current_record_id(), 0)
+
+    def test_kv_writes(self):
+        profiler = self.db.profile_vms()
+        users = self.db.collection('users')
+        users.create()
+        users.store({'name': 'huey'})
+
+        def compiles():
+            for data in profiler.stats():
+                if data['script'] == '$ret = db_fetch_all($collection);':
+                    return data['compiles']
+
+        # Writes to keys that do not belong to the collection keep the
+        # cached VM.
+        self.assertEqual(len(users.all()), 1)
+        self.db['k1'] = 'v1'
+        self.db['usersx'] = 'v1'
+        self.db.delete('k1')
+        self.assertEqual(len(users.all()), 1)
+        self.assertEqual(compiles(), 1)
+
+        # Writes to the records of the collection invalidate it.
+        self.db.delete('users_0')
+        self.assertEqual(users.all(), [])
+        self.assertEqual(compiles(), 2)
+
+
 if __name__ == '__main__':
     unittest.main(argv=sys.argv)
@@ -10,21 +10,99 @@
 #
 # Thanks to buaabyl for pyUnQLite, whose source-code this library is based on.
 # ASCII art designed by "pils".
+cimport cython
 from cpython.buffer cimport PyBUF_SIMPLE
+from cpython.buffer cimport PyBUF_WRITABLE
 from cpython.buffer cimport PyObject_CheckBuffer
 from cpython.buffer cimport PyObject_GetBuffer
+from cpython.buffer cimport PyBuffer_FillInfo
 from cpython.buffer cimport PyBuffer_Release
 from cpython.buffer cimport Py_buffer
 from cpython.bytes cimport PyBytes_Check
 from cpython.bytes cimport PyBytes_AS_STRING
 from cpython.bytes cimport PyBytes_GET_SIZE
+from cpython.dict cimport PyDict_Check
+from cpython.conversion cimport PyOS_double_to_string
+from cpython.float cimport PyFloat_Check
+from cpython.list cimport PyList_Check
+from cpython.list cimport PyList_New
+from cpython.list cimport PyList_SET_ITEM
+from cpython.long cimport PyLong_Check
 from cpython.mem cimport PyMem_Free
 from cpython.mem cimport PyMem_Malloc
+from cpython.mem cimport PyMem_RawMalloc
+from cpython.mem cimport PyMem_RawFree
+from cpython.mem cimport PyMem_RawRealloc
+from cpython.ref cimport PyObject
+from cpython.pystate cimport PyThreadState
+from cpython.ref cimport Py_INCREF
+from cpython.tuple cimport PyTuple_Check
+from cpython.unicode cimport PyUnicode_AsUTF8AndSize
 from cpython.unicode cimport PyUnicode_Check
+from cpython.unicode cimport PyUnicode_CheckExact
 from cpython.unicode cimport PyUnicode_AsUTF8String
 from cpython.unicode cimport PyUnicode_DecodeUTF8
-
+from libc.math cimport isinf
+from libc.math cimport isnan
+from libc.stdio cimport snprintf
+from libc.string cimport memcmp
+from libc.string cimport memcpy
+from libc.string cimport memset
+from libc.string cimport strlen
+
+cdef extern from "Python.h":
+    cdef int Py_DTSF_ADD_DOT_0
+    PyThreadState *PyEval_SaveThread()
+    void PyEval_RestoreThread(PyThreadState *)
+
+# Monotonic clock used to time operations when metrics are enabled.
+cdef extern from *:
+    """
+    #ifdef _WIN32
+    #include <windows.h>
+    static unsigned long long unqlite_clock_ns(void) {
+        static LARGE_INTEGER freq;
+        LARGE_INTEGER now;
+        if (!freq.QuadPart) QueryPerformanceFrequency(&freq);
+        QueryPerformanceCounter(&now);
+        return (unsigned long long)(now.QuadPart / freq.QuadPart) *
+            1000000000ULL + (unsigned long long)(now.QuadPart %
+            freq.QuadPart) * 1000000000ULL / freq.QuadPart;
+    }
+    #else
+    #include <time.h>
+    static unsigned long long unqlite_clock_ns(void) {
+        struct timespec ts;
+        clock_gettime(CLOCK_MONOTONIC, &ts);
+        return (unsigned long long)ts.tv_sec * 1000000000ULL + ts.tv_nsec;
+    }
+    #endif
+    """
+    unsigned long long unqlite_clock_ns() nogil
+
+import asyncio
+import codecs
+import contextvars
+import copy
+import functools
+import hashlib
+import inspect
+import io
+import json
+import logging
+import multiprocessing
+import operator
+import os
+import pickle
+import queue
+import struct
 import sys
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from itertools import islice
+from types import GeneratorType
 try:
     from os import fsencode
 except ImportError:
@@ -36,6 +114,8 @@ except ImportError:
         _fsencoding = _getfsencoding()
     fsencode = lambda s: s.encode(_fsencoding)
 
+logger = logging.getLogger('unqlite')
+
 cdef extern from "src/unqlite.h" nogil:
     struct unqlite
     struct unqlite_kv_cursor
@@ -64,6 +144,7 @@ cdef extern from "src/unqlite.h" nogil:
     cdef int unqlite_kv_store(unqlite *pDb, const void *pKey, int nKeyLen, const void *pData, unqlite_int64 nDataLen)
     cdef int unqlite_kv_append(unqlite *pDb, const void *pKey, int nKeyLen, const void *pData, unqlite_int64 nDataLen)
     cdef int unqlite_kv_fetch(unqlite *pDb, const void *pKey, int nKeyLen, void *pBuf, unqlite_int64 *pSize)
+    cdef int unqlite_kv_fetch_callback(unqlite *pDb, const void *pKey, int nKeyLen, int (*xConsumer)(const void *, unsigned int, void *) noexcept nogil, void *pUserData)
     cdef int unqlite_kv_delete(unqlite *pDb, const void *pKey, int nKeyLen)
     cdef int unqlite_kv_config(unqlite *pDb, int iOp, ...)
 
@@ -78,6 +159,8 @@ cdef extern from "src/unqlite.h" nogil:
     cdef int unqlite_kv_cursor_prev_entry(unqlite_kv_cursor *pCursor)
     cdef int unqlite_kv_cursor_key(unqlite_kv_cursor *pCursor,void *pBuf,int *pnByte)
     cdef int unqlite_kv_cursor_data(unqlite_kv_cursor *pCursor,void *pBuf,unqlite_int64 *pnData)
+    cdef int unqlite_kv_cursor_key_callback(unqlite_kv_cursor *pCursor,int (*xConsumer)(const void *,unsigned int,void *) noexcept nogil,void *pUserData)
+    cdef int unqlite_kv_cursor_data_callback(unqlite_kv_cursor *pCursor,int (*xConsumer)(const void *,unsigned int,void *) noexcept nogil,void *pUserData)
     cdef int unqlite_kv_cursor_delete_entry(unqlite_kv_cursor *pCursor)
     cdef int unqlite_kv_cursor_reset(unqlite_kv_cursor *pCursor)
 
@@ -165,6 +248,7 @@ cdef extern from "src/unqlite.h" nogil:
     # Library info.
     cdef const char * unqlite_lib_version()
     cdef int unqlite_lib_config(int nConfigOp, ...)
+    cdef int unqlite_lib_is_threadsafe()
 
     # Constant values (http://unqlite.org/c_api_const.html).
     cdef int SXRET_OK = 0
@@ -236,6 +320,7 @@ cdef extern from "src/unqlite.h" nogil:
     cdef int UNQLITE_CONFIG_KV_ENGINE = 4
     cdef int UNQLITE_CONFIG_DISABLE_AUTO_COMMIT = 5
     cdef int UNQLITE_CONFIG_GET_KV_NAME = 6
+    cdef int UNQLITE_CONFIG_GET_MMAP_VIEW = 7
 
     # unqlite_lib_config flags.
     cdef int UNQLITE_LIB_CONFIG_THREAD_LEVEL_SINGLE = 4
@@ -252,6 +337,17 @@ cdef extern from "src/unqlite.h" nogil:
     cdef int UNQLITE_OPEN_IN_MEMORY = 0x00000080
     cdef int UNQLITE_OPEN_MMAP = 0x00000100
 
+    # Storage engine config commands.
+    cdef int UNQLITE_KV_CONFIG_HASH_FUNC = 1
+    cdef int UNQLITE_KV_CONFIG_CMP_FUNC = 2
+    cdef int UNQLITE_KV_CONFIG_KEY_ORDER = 3
+    cdef int UNQLITE_KV_CONFIG_GET_KEY_ORDER = 4
+    cdef int UNQLITE_KV_CONFIG_PARTITION = 5
+
+    # Key orders of ordered storage engines.
+    cdef int UNQLITE_KV_ORDER_MEMCMP = 0
+    cdef int UNQLITE_KV_ORDER_LENGTH = 1
+
     # Cursor seek flags.
     cdef int UNQLITE_CURSOR_MATCH_EXACT = 1
     cdef int UNQLITE_CURSOR_MATCH_LE = 2
@@ -309,6 +405,60 @@ cdef inline unicode decode(key):
     return str(key)
 
 
+cdef inline int utf8_sequence_length(const unsigned char *p,
+                                     int nbytes) noexcept nogil:
+    # Length of the valid UTF-8 sequence starting with the non-ASCII byte at
+    # p, or 0 if it is invalid (including overlong forms and surrogates).
+    cdef unsigned char c = p[0], lo = 0x80, hi = 0xbf
+    cdef int i, n
+    if 0xc2 <= c <= 0xdf:
+        n = 2
+    elif 0xe0 <= c <= 0xef:
+        n = 3
+        if c == 0xe0:
+            lo = 0xa0
+        elif c == 0xed:
+            hi = 0x9f
+    elif 0xf0 <= c <= 0xf4:
+        n = 4
+        if c == 0xf0:
+            lo = 0x90
+        elif c == 0xf4:
+            hi = 0x8f
+    else:
+        return 0
+    if n > nbytes or not (lo <= p[1] <= hi):
+        return 0
+    for i in range(2, n):
+        if not (0x80 <= p[i] <= 0xbf):
+            return 0
+    return n
+
+
+cdef inline bint utf8_valid(const char *buf, Py_ssize_t nbytes) noexcept nogil:
+    cdef Py_ssize_t i = 0
+    cdef int n
+    while i < nbytes:
+        if <unsigned char>buf[i] < 0x80:
+            i += 1
+            continue
+        n = utf8_sequence_length(<const unsigned char *>buf + i,
+                                 <int>min(nbytes - i, 4))
+        if n == 0:
+            return False
+        i += n
+    return True
+
+
+cdef inline decode_key(const char *buf, Py_ssize_t nbytes):
+    # Keys are returned as text where possible, falling back to bytes. They
+    # are validated first, as raising and catching UnicodeDecodeError for
+    # each binary key is slow.
+    if utf8_valid(buf, nbytes):
+        return PyUnicode_DecodeUTF8(buf, nbytes, NULL)
+    return buf[:nbytes]
+
+
 cdef inline bytes encode(key):
     if PyUnicode_Check(key):
         return PyUnicode_AsUTF8String(key)
@@ -331,6 +481,616 @@ cdef inline bytes encode(key):
     return PyUnicode_AsUTF8String(str(key))
 
 
+# Destination for data delivered by UnQLite's consumer callbacks. UnQLite
+# may hand over a single value in several chunks (e.g. one per overflow page),
+# so the consumer appends to the buffer. A buffer that is not `growable` wraps
+# caller-owned memory: data beyond its capacity is dropped, but still counted
+# in `total`.
+cdef struct kv_buffer:
+    char *data
+    Py_ssize_t size
+    Py_ssize_t capacity
+    Py_ssize_t total
+    bint growable
+    bint nomem
+
+
+cdef inline void kv_buffer_init(kv_buffer *buf, char *data,
+                                Py_ssize_t capacity, bint growable) noexcept nogil:
+    buf.data = data
+    buf.size = 0
+    buf.capacity = capacity
+    buf.total = 0
+    buf.growable = growable
+    buf.nomem = False
+
+
+cdef int kv_buffer_consumer(const void *data, unsigned int nbytes,
+                            void *user_data) noexcept nogil:
+    cdef kv_buffer *buf = <kv_buffer *>user_data
+    cdef Py_ssize_t ncopy = nbytes
+    cdef Py_ssize_t new_capacity
+    cdef char *new_data
+
+    buf.total += nbytes
+    if buf.size + ncopy > buf.capacity:
+        if buf.growable:
+            # The first chunk is usually the whole value, so size the initial
+            # allocation exactly and only over-allocate when appending.
+            new_capacity = buf.size + ncopy
+            if buf.capacity:
+                new_capacity = max(new_capacity, 2 * buf.capacity)
+            new_data = <char *>PyMem_RawRealloc(buf.data, new_capacity)
+            if not new_data:
+                buf.nomem = True
+                return UNQLITE_ABORT
+            buf.data = new_data
+            buf.capacity = new_capacity
+        else:
+            ncopy = buf.capacity - buf.size
+    if ncopy > 0:
+        memcpy(buf.data + buf.size, data, ncopy)
+        buf.size += ncopy
+    return UNQLITE_OK
+
+
+# Locates a value inside the memory map of a read-only database. A value whose
+# chunks follow each other in the map (a value stored in a single page, or in
+# a run of pages by the btree engine) can be exposed without copying;
+# otherwise the chunks, which all point into the map, are gathered into `buf`.
+cdef struct kv_view:
+    const char *map_start
+    const char *map_end
+    const char *data
+    Py_ssize_t size
+    bint gathered
+    kv_buffer buf
+
+
+cdef int kv_view_consumer(const void *data, unsigned int nbytes,
+                          void *user_data) noexcept nogil:
+    cdef kv_view *view = <kv_view *>user_data
+    cdef const char *p = <const char *>data
+
+    if p < view.map_start or p + nbytes > view.map_end:
+        return UNQLITE_ABORT
+    if view.gathered:
+        return kv_buffer_consumer(data, nbytes, &view.buf)
+    elif view.data == NULL:
+        view.data = p
+        view.size = nbytes
+    elif p == view.data + view.size:
+        view.size += nbytes
+    else:
+        view.gathered = True
+        if kv_buffer_consumer(view.data, <unsigned int>view.size,
+                              &view.buf) != UNQLITE_OK:
+            return UNQLITE_ABORT
+        return kv_buffer_consumer(data, nbytes, &view.buf)
+    return UNQLITE_OK
+
+
+cdef inline bint kv_exists(unqlite *database, const char *key,
+                           int nkey) noexcept nogil:
+    cdef unqlite_int64 nbytes = 0
+    return unqlite_kv_fetch(database, key, nkey, NULL, &nbytes) == UNQLITE_OK
+
+
+# A single key/value pair of a batch operation. The pointers borrow from
+# `bytes` objects that the caller keeps alive for the duration of the batch.
+cdef struct kv_item:
+    const char *key
+    int nkey
+    const char *value
+    unqlite_int64 nvalue
+    int rc
+
+
+# Number of items encoded and handed to UnQLite per GIL release in the batch
+# APIs, which bounds the memory used by arbitrarily long input iterables.
+cdef enum:
+    BATCH_SIZE = 1024
+
+# Largest scratch buffer a cursor keeps between calls. A larger buffer, grown
+# for an oversized batch or value, is released once it has been used.
+cdef enum:
+    CURSOR_ARENA_RETAIN = 1 << 20
+
+
+cdef int kv_store_batch(unqlite *database, kv_item *batch, Py_ssize_t n,
+                        bint track, Py_ssize_t *inserted) noexcept nogil:
+    """
+    Store a batch of items, stopping at the first error. When `track` is set,
+    the number of keys that did not previously exist is reported.
+    """
+    cdef Py_ssize_t i
+    cdef bint found = False
+    cdef int ret = UNQLITE_OK
+
+    inserted[0] = 0
+    for i in range(n):
+        if track:
+            found = kv_exists(database, batch[i].key, batch[i].nkey)
+        ret = unqlite_kv_store(database, batch[i].key, batch[i].nkey,
+                               batch[i].value, batch[i].nvalue)
+        if ret != UNQLITE_OK:
+            break
+        elif track and not found:
+            inserted[0] += 1
+    return ret
+
+
+cdef int kv_delete_batch(unqlite *database, kv_item *batch, Py_ssize_t n,
+                         Py_ssize_t *deleted) noexcept nogil:
+    """
+    Delete a batch of keys, ignoring keys that do not exist and stopping at
+    the first error. The number of keys deleted is reported.
+    """
+    cdef Py_ssize_t i
+    cdef int ret = UNQLITE_OK
+
+    deleted[0] = 0
+    for i in range(n):
+        ret = unqlite_kv_delete(database, batch[i].key, batch[i].nkey)
+        if ret == UNQLITE_OK:
+            deleted[0] += 1
+        elif ret == UNQLITE_NOTFOUND:
+            ret = UNQLITE_OK
+        else:
+            break
+    return ret
+
+
+# Cached Jx9 VMs are recompiled after this many executions. UnQLite keeps
+# every record a VM has loaded in a per-VM cache, which would otherwise grow
+# without bound.
+cdef enum:
+    VM_CACHE_MAX_USES = 1000
+
+
+# Hash functions that can be used by the hash-based storage engines in place
+# of UnQLite's default (DJB2). The function used to create a file-based
+# database must also be used to open it.
+ctypedef unsigned int (*kv_hash_fn)(const void *, unsigned int) noexcept nogil
+
+
+cdef unsigned int hash_fnv1a(const void *data, unsigned int nbytes) noexcept nogil:
+    # 32-bit FNV-1a.
+    cdef const unsigned char *p = <const unsigned char *>data
+    cdef unsigned int h = 2166136261U
+    cdef unsigned int i
+    for i in range(nbytes):
+        h = (h ^ p[i]) * 16777619U
+    return h
+
+
+cdef inline unsigned int rotl32(unsigned int x, int r) noexcept nogil:
+    return (x << r) | (x >> (32 - r))
+
+
+cdef unsigned int hash_murmur3(const void *data, unsigned int nbytes) noexcept nogil:
+    # MurmurHash3 (x86, 32-bit), seed 0.
+    cdef const unsigned char *p = <const unsigned char *>data
+    cdef unsigned int nblocks = nbytes // 4
+    cdef unsigned int h = 0, k, i
+    cdef unsigned int c1 = 0xcc9e2d51U, c2 = 0x1b873593U
+    for i in range(nblocks):
+        k = (p[4 * i] | (p[4 * i + 1] << 8) | (p[4 * i + 2] << 16) |
+             (<unsigned int>p[4 * i + 3] << 24))
+        k = rotl32(k * c1, 15) * c2
+        h = rotl32(h ^ k, 13) * 5 + 0xe6546b64U
+    p += 4 * nblocks
+    k = 0
+    i = nbytes & 3
+    if i == 3:
+        k ^= p[2] << 16
+    if i >= 2:
+        k ^= p[1] << 8
+    if i >= 1:
+        k ^= p[0]
+        h ^= rotl32(k * c1, 15) * c2
+    h ^= nbytes
+    h ^= h >> 16
+    h *= 0x85ebca6bU
+    h ^= h >> 13
+    h *= 0xc2b2ae35U
+    h ^= h >> 16
+    return h
+
+
+cdef dict KEY_ORDERS = {
+    'memcmp': UNQLITE_KV_ORDER_MEMCMP,
+    'length': UNQLITE_KV_ORDER_LENGTH,
+}
+
+
+cdef kv_hash_fn get_hash_function(name) except? NULL:
+    if name == 'fnv1a':
+        return hash_fnv1a
+    elif name == 'murmur3':
+        return hash_murmur3
+    raise ValueError('Unrecognized hash function "%s", expected one of: '
+                     'fnv1a, murmur3.' % name)
+
+
+cdef inline int compare_keys(bytes a, bytes b, bint length_first):
+    # Mirrors the ordering of the btree storage engine.
+    if length_first and len(a) != len(b):
+        return -1 if len(a) < len(b) else 1
+    return -1 if a < b else (1 if a > b else 0)
+
+
+# Value codecs, selected with UnQLite(codec=...). Values are serialized when
+# they are stored and deserialized when they are read back by fetch(),
+# fetch_many() and cursors. Without a codec, values are stored as bytes.
+cdef enum:
+    CODEC_NONE = 0
+    CODEC_MSGPACK = 1
+    CODEC_PICKLE = 2
+
+cdef dict CODECS = {
+    'msgpack': CODEC_MSGPACK,
+    'pickle': CODEC_PICKLE,
+}
+
+# Containers nested deeper than this are rejected by the msgpack codec,
+# rather than overflowing the C stack.
+cdef int MP_MAX_DEPTH = 512
+
+# Pickled values that have out-of-band buffers start with this byte (pickles
+# always start with 0x80), followed by the number of buffers as a 32-bit
+# integer, and the lengths of the pickle stream and of each buffer as 64-bit
+# integers. The pickle stream and the buffers follow.
+cdef unsigned char PICKLE_OOB = 0x01
+
+
+cdef int codec_id(codec) except -1:
+    if codec is None:
+        return CODEC_NONE
+    elif codec not in CODECS:
+        raise ValueError('Unrecognized codec "%s", expected one of: '
+                         'msgpack, pickle.' % codec)
+    return CODECS[codec]
+
+
+cdef inline bytes codec_encode(int codec, value):
+    if codec == CODEC_MSGPACK:
+        return mp_dumps(value)
+    elif codec == CODEC_PICKLE:
+        return pickle_dumps(value)
+    return encode(value)
+
+
+cdef inline codec_decode(int codec, bytes data):
+    if codec == CODEC_MSGPACK:
+        return mp_loads(data, len(data))
+    elif codec == CODEC_PICKLE:
+        return pickle_loads(data)
+    return data
+
+
+cdef inline codec_decode_buf(int codec, const char *data, Py_ssize_t nbytes):
+    # msgpack values are decoded in place, without copying them into a
+    # `bytes` object first.
+    if codec == CODEC_MSGPACK:
+        return mp_loads(data, nbytes)
+    return codec_decode(codec, data[:nbytes])
+
+
+def encode_value(value, codec):
+    """Serialize a value with the given codec ("msgpack" or "pickle")."""
+    return codec_encode(codec_id(codec), value)
+
+
+def decode_value(data, codec):
+    """Deserialize a value that was serialized with the given codec."""
+    return codec_decode(codec_id(codec), encode(data))
+
+
+# msgpack codec. Supports nil, booleans, integers of up to 64 bits, floats,
+# str, bytes (and other buffers), lists, tuples and dicts. Tuples are decoded
+# as lists.
+cdef int mp_write(kv_buffer *buf, const void *data, Py_ssize_t nbytes) \
+        except -1:
+    kv_buffer_consumer(data, <unsigned int>nbytes, buf)
+    if buf.nomem:
+        raise MemoryError
+    return 0
+
+
+cdef int mp_write_header(kv_buffer *buf, unsigned char marker,
+                         unsigned long long value, int nbytes) except -1:
+    # Marker byte, followed by the low `nbytes` of `value` in big-endian
+    # order.
+    cdef unsigned char header[9]
+    cdef int i
+    header[0] = marker
+    for i in range(nbytes):
+        header[nbytes - i] = (value >> (8 * i)) & 0xff
+    return mp_write(buf, header, nbytes + 1)
+
+
+cdef int mp_write_size(kv_buffer *buf, Py_ssize_t n, unsigned char fix,
+                       Py_ssize_t nfix, unsigned char m8, unsigned char m16,
+                       unsigned char m32) except -1:
+    # Header of a str, bin, array or map. Types without a "fix" or 8-bit
+    # form pass zero for `nfix` or `m8`.
+    if n < nfix:
+        return mp_write_header(buf, fix | n, 0, 0)
+    elif m8 and n < 0x100:
+        return mp_write_header(buf, m8, n, 1)
+    elif n < 0x10000:
+        return mp_write_header(buf, m16, n, 2)
+    elif n <= 0xffffffff:
+        return mp_write_header(buf, m32, n, 4)
+    raise ValueError('Value is too large to encode.')
+
+
+cdef int mp_pack(kv_buffer *buf, obj, int depth) except -1:
+    cdef unsigned long long u
+    cdef long long n
+    cdef double d
+    cdef const char *s
+    cdef Py_ssize_t size
+    cdef Py_buffer view
+
+    if depth > MP_MAX_DEPTH:
+        raise ValueError('Value is nested too deeply to encode.')
+
+    if obj is None:
+        return mp_write_header(buf, 0xc0, 0, 0)
+    elif obj is True:
+        return mp_write_header(buf, 0xc3, 0, 0)
+    elif obj is False:
+        return mp_write_header(buf, 0xc2, 0, 0)
+    elif PyLong_Check(obj):
+        if obj >= 0:
+            u = obj
+            if u < 0x80:
+                return mp_write_header(buf, <unsigned char>u, 0, 0)
+            elif u < 0x100:
+                return mp_write_header(buf, 0xcc, u, 1)
+            elif u < 0x10000:
+                return mp_write_header(buf, 0xcd, u, 2)
+            elif u <= 0xffffffff:
+                return mp_write_header(buf, 0xce, u, 4)
+            return mp_write_header(buf, 0xcf, u, 8)
+        n = obj
+        if n >= -32:
+            return mp_write_header(buf, <unsigned char>(n & 0xff), 0, 0)
+        elif n >= -0x80:
+            return mp_write_header(buf, 0xd0, <unsigned long long>n, 1)
+        elif n >= -0x8000:
+            return mp_write_header(buf, 0xd1, <unsigned long long>n, 2)
+        elif n >= -0x80000000:
+            return mp_write_header(buf, 0xd2, <unsigned long long>n, 4)
+        return mp_write_header(buf, 0xd3, <unsigned long long>n, 8)
+    elif PyFloat_Check(obj):
+        d = obj
+        memcpy(&u, &d, 8)
+        return mp_write_header(buf, 0xcb, u, 8)
+    elif PyUnicode_Check(obj):
+        s = PyUnicode_AsUTF8AndSize(obj, &size)
+        mp_write_size(buf, size, 0xa0, 32, 0xd9, 0xda, 0xdb)
+        return mp_write(buf, s, size)
+    elif PyBytes_Check(obj):
+        size = PyBytes_GET_SIZE(obj)
+        mp_write_size(buf, size, 0, 0, 0xc4, 0xc5, 0xc6)
+        return mp_write(buf, PyBytes_AS_STRING(obj), size)
+    elif PyList_Check(obj) or PyTuple_Check(obj):
+        mp_write_size(buf, len(obj), 0x90, 16, 0, 0xdc, 0xdd)
+        for item in obj:
+            mp_pack(buf, item, depth + 1)
+        return 0
+    elif PyDict_Check(obj):
+        mp_write_size(buf, len(obj), 0x80, 16, 0, 0xde, 0xdf)
+        for key, value in (<dict>obj).items():
+            mp_pack(buf, key, depth + 1)
+            mp_pack(buf, value, depth + 1)
+        return 0
+    elif PyObject_CheckBuffer(obj):
+        PyObject_GetBuffer(obj, &view, PyBUF_SIMPLE)
+        try:
+            mp_write_size(buf, view.len, 0, 0, 0xc4, 0xc5, 0xc6)
+            return mp_write(buf, view.buf, view.len)
+        finally:
+            PyBuffer_Release(&view)
+    raise TypeError('Cannot encode values of type %s with the msgpack '
+                    'codec.' % type(obj).__name__)
+
+
+cdef bytes mp_dumps(value):
+    cdef kv_buffer buf
+    kv_buffer_init(&buf, <char *>PyMem_RawMalloc(64), 64, True)
+    if not buf.data:
+        raise MemoryError
+    try:
+        mp_pack(&buf, value, 0)
+        return buf.data[:buf.size]
+    finally:
+        PyMem_RawFree(buf.data)
+
+
+cdef struct mp_reader:
+    const unsigned char *data
+    Py_ssize_t size
+    Py_ssize_t pos
+
+
+cdef const unsigned char *mp_read(mp_reader *r, Py_ssize_t n) except NULL:
+    cdef const unsigned char *p = r.data + r.pos
+    if n > r.size - r.pos:
+        raise ValueError('Truncated msgpack data.')
+    r.pos += n
+    return p
+
+
+cdef unsigned long long mp_read_uint(mp_reader *r, int nbytes) except? 0:
+    cdef const unsigned char *p = mp_read(r, nbytes)
+    cdef unsigned long long value = 0
+    cdef int i
+    for i in range(nbytes):
+        value = (value << 8) | p[i]
+    return value
+
+
+cdef mp_unpack(mp_reader *r, int depth):
+    cdef unsigned char marker
+    cdef unsigned long long u
+    cdef unsigned int u32
+    cdef Py_ssize_t i, n
+    cdef int nbytes
+    cdef double d
+    cdef float f
+    cdef const unsigned char *p
+    cdef list items
+    cdef dict mapping
+
+    if depth > MP_MAX_DEPTH:
+        raise ValueError('msgpack data is nested too deeply to decode.')
+
+    marker = mp_read(r, 1)[0]
+    if marker < 0x80:
+        return marker
+    elif marker >= 0xe0:
+        return <int>marker - 0x100
+    elif marker == 0xc0:
+        return None
+    elif marker == 0xc2:
+        return False
+    elif marker == 0xc3:
+        return True
+    elif 0xcc <= marker <= 0xcf:
+        return mp_read_uint(r, 1 << (marker - 0xcc))
+    elif 0xd0 <= marker <= 0xd3:
+        nbytes = 1 << (marker - 0xd0)
+        u = mp_read_uint(r, nbytes)
+        if nbytes < 8 and u >> (8 * nbytes - 1):
+            return <long long>u - (<long long>1 << (8 * nbytes))
+        return <long long>u
+    elif marker == 0xca:
+        u32 = <unsigned int>mp_read_uint(r, 4)
+        memcpy(&f, &u32, 4)
+        return f
+    elif marker == 0xcb:
+        u = mp_read_uint(r, 8)
+        memcpy(&d, &u, 8)
+        return d
+
+    if marker < 0x90:
+        n = marker & 0x0f
+    elif marker < 0xa0:
+        n = marker & 0x0f
+    elif marker < 0xc0:
+        n = marker & 0x1f
+    elif 0xc4 <= marker <= 0xc6:
+        n = mp_read_uint(r, 1 << (marker - 0xc4))
+    elif 0xd9 <= marker <= 0xdb:
+        n = mp_read_uint(r, 1 << (marker - 0xd9))
+    elif 0xdc <= marker <= 0xdf:
+        n = mp_read_uint(r, 2 << (marker & 1))
+    else:
+        raise ValueError('Unsupported msgpack type 0x%02x.' % marker)
+
+    if 0xa0 <= marker < 0xc0 or 0xd9 <= marker <= 0xdb:
+        p = mp_read(r, n)
+        return PyUnicode_DecodeUTF8(<const char *>p, n, NULL)
+    elif 0xc4 <= marker <= 0xc6:
+        p = mp_read(r, n)
+        return (<const char *>p)[:n]
+
+    # Every element takes at least one byte, which bounds the size of the
+    # container before it is allocated.
+    if n > r.size - r.pos:
+        raise ValueError('Truncated msgpack data.')
+    if 0x90 <= marker < 0xa0 or marker == 0xdc or marker == 0xdd:
+        items = [None] * n
+        for i in range(n):
+            items[i] = mp_unpack(r, depth + 1)
+        return items
+    mapping = {}
+    for i in range(n):
+        key = mp_unpack(r, depth + 1)
+        mapping[key] = mp_unpack(r, depth + 1)
+    return mapping
+
+
+cdef mp_loads(const char *data, Py_ssize_t nbytes):
+    cdef mp_reader r
+    r.data = <const unsigned char *>data
+    r.size = nbytes
+    r.pos = 0
+    value = mp_unpack(&r, 0)
+    if r.pos != r.size:
+        raise ValueError('Unexpected data after msgpack value.')
+    return value
+
+
+# pickle codec. Values are pickled with protocol 5, and buffers that support
+# out-of-band serialization (e.g. NumPy arrays) are stored after the pickle
+# stream rather than copied into it. They are unpickled from read-only views
+# of the fetched value.
+def _pickle_buffer(list buffers, buf):
+    # Returning True serializes a buffer in-band, which is required for
+    # buffers that are not contiguous.
+    try:
+        buffers.append(buf.raw())
+    except BufferError:
+        return True
+    return False
+
+
+cdef bytes pickle_dumps(value):
+    cdef list buffers = []
+    cdef bytes data = pickle.dumps(
+        value, protocol=5,
+        buffer_callback=functools.partial(_pickle_buffer, buffers))
+    if not buffers:
+        return data
+    lengths = [len(data)] + [buf.nbytes for buf in buffers]
+    header = struct.pack('<BI%dQ' % len(lengths), PICKLE_OOB, len(buffers),
+                         *lengths)
+    return b''.join([header, data] + buffers)
+
+
+cdef pickle_loads(bytes data):
+    cdef list buffers = []
+    cdef Py_ssize_t pos
+
+    if not data or (<const unsigned char *>data)[0] != PICKLE_OOB:
+        return pickle.loads(data)
+    count, = struct.unpack_from('<I', data, 1)
+    lengths = struct.unpack_from('<%dQ' % (count + 1), data, 5)
+    pos = 5 + 8 * (count + 1)
+    view = memoryview(data)
+    stream = view[pos:pos + lengths[0]]
+    pos += lengths[0]
+    for length in lengths[1:]:
+        buffers.append(view[pos:pos + length])
+        pos += length
+    if pos != len(data):
+        raise ValueError('Corrupt pickled value.')
+    return pickle.loads(stream, buffers=buffers)
+
+
+# Cursor.seek() flags.
+CURSOR_MATCH_EXACT = UNQLITE_CURSOR_MATCH_EXACT
+CURSOR_MATCH_LE = UNQLITE_CURSOR_MATCH_LE
+CURSOR_MATCH_GE = UNQLITE_CURSOR_MATCH_GE
+
+# unqlite_open() flags, exported under their C names.
+globals().update(
+    UNQLITE_OPEN_READONLY=UNQLITE_OPEN_READONLY,
+    UNQLITE_OPEN_READWRITE=UNQLITE_OPEN_READWRITE,
+    UNQLITE_OPEN_CREATE=UNQLITE_OPEN_CREATE,
+    UNQLITE_OPEN_EXCLUSIVE=UNQLITE_OPEN_EXCLUSIVE,
+    UNQLITE_OPEN_TEMP_DB=UNQLITE_OPEN_TEMP_DB,
+    UNQLITE_OPEN_NOMUTEX=UNQLITE_OPEN_NOMUTEX,
+    UNQLITE_OPEN_OMIT_JOURNALING=UNQLITE_OPEN_OMIT_JOURNALING,
+    UNQLITE_OPEN_IN_MEMORY=UNQLITE_OPEN_IN_MEMORY,
+    UNQLITE_OPEN_MMAP=UNQLITE_OPEN_MMAP)
+
+
 cdef dict EXC_MAP = {
     UNQLITE_NOMEM: MemoryError,
     UNQLITE_NOTIMPLEMENTED: NotImplementedError,
@@ -349,6 +1109,294 @@ class UnQLiteError(Exception):
         return '<UnQLiteError %s: %s>' % (self.errno, self.error_message)
 
 
+cdef class MappedFile(object):
+    """
+    Read-only memory map of a database opened with UNQLITE_OPEN_MMAP. The map
+    belongs to the database handle and is released by unqlite_close().
+    """
+    # Set when the database is closed: no new views may be created. Views do
+    # not reference the UnQLite object, so cannot compare its generation.
+    cdef bint closed
+    cdef const char *start
+    cdef const char *end
+    # Number of buffers currently exported by MappedValue objects. If the
+    # database is closed while some are outstanding, closing the handle (and
+    # unmapping the file) is deferred until the last one is released.
+    cdef Py_ssize_t exports
+    cdef unqlite *detached
+
+    def __cinit__(self, UnQLite unqlite):
+        cdef const void *start = NULL
+        cdef unqlite_int64 size = 0
+        # Held by views, so no reference to the UnQLite object is kept.
+        self.closed = False
+        unqlite.check_call(unqlite_config(
+            unqlite.database, UNQLITE_CONFIG_GET_MMAP_VIEW, &start, &size))
+        self.start = <const char *>start
+        self.end = self.start + size
+        self.exports = 0
+        self.detached = NULL
+
+    def __dealloc__(self):
+        if self.detached:
+            unqlite_close(self.detached)
+
+    cdef release_export(self):
+        self.exports -= 1
+        if self.exports == 0 and self.detached:
+            unqlite_close(self.detached)
+            self.detached = NULL
+
+
+cdef class MappedValue(object):
+    """
+    Exports a value stored in a memory mapped database through the buffer
+    protocol. Wrapped in a memoryview by UnQLite.fetch_view().
+    """
+    cdef MappedFile mapping
+    cdef const char *data
+    cdef Py_ssize_t size
+
+    def __getbuffer__(self, Py_buffer *buffer, int flags):
+        if self.mapping.closed:
+            raise UnQLiteError('Value view is no longer valid: the database '
+                               'has been closed.')
+        PyBuffer_FillInfo(buffer, self, <void *>self.data, self.size, 1,
+                          flags)
+        self.mapping.exports += 1
+
+    def __releasebuffer__(self, Py_buffer *buffer):
+        self.mapping.release_export()
+
+
+cdef object cache_absent = object()
+
+
+cdef class ValueCache(object):
+    """
+    LRU cache of the values read through a database handle, bounded by the
+    number of entries and, optionally, by the total size of the keys and
+    values. A value of None records a key known not to exist.
+    """
+    cdef object entries
+    cdef readonly Py_ssize_t max_entries
+    cdef readonly Py_ssize_t max_bytes
+    cdef readonly Py_ssize_t nbytes
+    cdef readonly Py_ssize_t hits
+    cdef readonly Py_ssize_t misses
+    cdef readonly Py_ssize_t evictions
+
+    def __init__(self, Py_ssize_t max_entries, Py_ssize_t max_bytes=0):
+        self.entries = OrderedDict()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.nbytes = self.hits = self.misses = self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    cdef inline Py_ssize_t entry_size(self, bytes key, value):
+        return len(key) + (0 if value is None else len(<bytes>value))
+
+    cdef lookup(self, bytes key):
+        # Returns the cached value, None for a missing key, or cache_absent.
+        value = self.entries.get(key, cache_absent)
+        if value is cache_absent:
+            self.misses += 1
+        else:
+            self.entries.move_to_end(key)
+            self.hits += 1
+        return value
+
+    cdef put(self, bytes key, value):
+        cdef Py_ssize_t size = self.entry_size(key, value)
+        cdef bytes evicted
+        self.discard(key)
+        if self.max_bytes and size > self.max_bytes:
+            return
+        self.entries[key] = value
+        self.nbytes += size
+        while len(self.entries) > self.max_entries or \
+                (self.max_bytes and self.nbytes > self.max_bytes):
+            evicted, value = self.entries.popitem(last=False)
+            self.nbytes -= self.entry_size(evicted, value)
+            self.evictions += 1
+
+    cdef discard(self, bytes key):
+        value = self.entries.pop(key, cache_absent)
+        if value is not cache_absent:
+            self.nbytes -= self.entry_size(key, value)
+
+    cdef clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self.entries),
+            'bytes': self.nbytes,
+        }
+
+
+# Operations timed by Metrics.
+cdef enum:
+    MET_STORE = 0
+    MET_FETCH = 1
+    MET_APPEND = 2
+    MET_DELETE = 3
+    MET_EXISTS = 4
+    MET_STORE_MANY = 5
+    MET_FETCH_MANY = 6
+    MET_DELETE_MANY = 7
+    MET_BEGIN = 8
+    MET_COMMIT = 9
+    MET_ROLLBACK = 10
+    MET_CURSOR_SEEK = 11
+    MET_CURSOR_READ = 12
+    MET_COMPILE = 13
+    MET_EXECUTE = 14
+    MET_NOPS = 15
+    # Latency histogram buckets: bucket i counts latencies below 2**i ns.
+    MET_NBUCKETS = 40
+
+cdef tuple METRIC_NAMES = (
+    'store', 'fetch', 'append', 'delete', 'exists', 'store_many',
+    'fetch_many', 'delete_many', 'begin', 'commit', 'rollback', 'cursor_seek',
+    'cursor_read', 'compile', 'execute')
+
+cdef dict ERROR_NAMES = {
+    UNQLITE_NOMEM: 'NOMEM',
+    UNQLITE_ABORT: 'ABORT',
+    UNQLITE_IOERR: 'IOERR',
+    UNQLITE_CORRUPT: 'CORRUPT',
+    UNQLITE_LOCKED: 'LOCKED',
+    UNQLITE_BUSY: 'BUSY',
+    UNQLITE_DONE: 'DONE',
+    UNQLITE_PERM: 'PERM',
+    UNQLITE_NOTIMPLEMENTED: 'NOTIMPLEMENTED',
+    UNQLITE_NOTFOUND: 'NOTFOUND',
+    UNQLITE_NOOP: 'NOOP',
+    UNQLITE_INVALID: 'INVALID',
+    UNQLITE_EOF: 'EOF',
+    UNQLITE_UNKNOWN: 'UNKNOWN',
+    UNQLITE_LIMIT: 'LIMIT',
+    UNQLITE_EXISTS: 'EXISTS',
+    UNQLITE_EMPTY: 'EMPTY',
+    UNQLITE_COMPILE_ERR: 'COMPILE_ERR',
+    UNQLITE_VM_ERR: 'VM_ERR',
+    UNQLITE_FULL: 'FULL',
+    UNQLITE_CANTOPEN: 'CANTOPEN',
+    UNQLITE_READ_ONLY: 'READ_ONLY',
+    UNQLITE_LOCKERR: 'LOCKERR',
+}
+
+
+cdef struct op_stats:
+    unsigned long long count
+    unsigned long long errors
+    unsigned long long total_ns
+    unsigned long long max_ns
+    unsigned long long buckets[MET_NBUCKETS]
+
+
+cdef class Metrics(object):
+    """
+    Operation counters and latency histograms of a database handle. Updates
+    are made while holding the GIL, after UnQLite has returned.
+    """
+    cdef op_stats ops[MET_NOPS]
+    cdef readonly unsigned long long hits
+    cdef readonly unsigned long long misses
+    cdef readonly unsigned long long bytes_read
+    cdef readonly unsigned long long bytes_written
+    # Number of times each non-OK status was seen by check_call().
+    cdef dict status_counts
+    # Called as hook(operation, elapsed_ns, status) after every operation.
+    cdef object hook
+
+    def __init__(self):
+        self.hook = None
+        self.reset()
+
+    cdef reset(self):
+        memset(self.ops, 0, sizeof(self.ops))
+        self.hits = self.misses = 0
+        self.bytes_read = self.bytes_written = 0
+        self.status_counts = {}
+
+    cdef record(self, int op, unsigned long long start, int rc,
+                Py_ssize_t nread=0, Py_ssize_t nwritten=0):
+        cdef unsigned long long elapsed = unqlite_clock_ns() - start
+        cdef op_stats *stats = &self.ops[op]
+        cdef int bucket = 0
+
+        while bucket < MET_NBUCKETS - 1 and elapsed >> bucket:
+            bucket += 1
+        stats.count += 1
+        stats.total_ns += elapsed
+        if elapsed > stats.max_ns:
+            stats.max_ns = elapsed
+        stats.buckets[bucket] += 1
+        if rc == UNQLITE_OK:
+            if op == MET_FETCH or op == MET_EXISTS:
+                self.hits += 1
+        elif rc == UNQLITE_NOTFOUND and \
+                (op == MET_FETCH or op == MET_EXISTS):
+            self.misses += 1
+        else:
+            stats.errors += 1
+        self.bytes_read += nread
+        self.bytes_written += nwritten
+        if self.hook is not None:
+            self.hook(METRIC_NAMES[op], elapsed, rc)
+
+    cdef status(self, int rc):
+        name = ERROR_NAMES.get(rc, rc)
+        self.status_counts[name] = self.status_counts.get(name, 0) + 1
+
+    def stats(self):
+        cdef op_stats *stats
+        cdef dict operations = {}
+        cdef list histogram
+        cdef unsigned long long seen
+        cdef int i, op
+
+        for op in range(MET_NOPS):
+            stats = &self.ops[op]
+            histogram = [(1 << i, stats.buckets[i])
+                         for i in range(MET_NBUCKETS) if stats.buckets[i]]
+            operations[METRIC_NAMES[op]] = data = {
+                'count': stats.count,
+                'errors': stats.errors,
+                'total_ns': stats.total_ns,
+                'max_ns': stats.max_ns,
+                'histogram': histogram,
+            }
+            # Percentiles are reported as the upper bound of their bucket.
+            for name, fraction in (('p50_ns', 0.5), ('p99_ns', 0.99)):
+                seen = 0
+                data[name] = 0
+                for bound, n in histogram:
+                    seen += n
+                    if seen >= fraction * stats.count:
+                        data[name] = bound
+                        break
+        return {
+            'operations': operations,
+            'hits': self.hits,
+            'misses': self.misses,
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'status_codes': dict(self.status_counts),
+        }
+
+
+# The cycle collector must not clear `mapping` before __dealloc__ runs, or a
+# handle with outstanding views would be closed, unmapping the file.
+@cython.no_gc_clear
 cdef class UnQLite(object):
     """
     UnQLite database wrapper.
@@ -360,24 +1408,125 @@ cdef class UnQLite(object):
     cdef readonly bytes encoded_filename
     cdef readonly int flags
     cdef bint open_database
+    # Storage engine requested at open time (None for the default).
+    cdef bytes encoded_kv_engine
+    # Hash function used by the hash-based storage engines (None for the
+    # default), and key order requested for the ordered engines.
+    cdef readonly object hash_function
+    cdef object requested_comparator
+    # True if the storage engine keeps keys in sorted order, in which case
+    # range and prefix scans can seek instead of scanning every record.
+    cdef readonly bint ordered
+    # Key order of an ordered storage engine: "memcmp" or "length".
+    cdef readonly object comparator
     # Incremented on close() so cursors/VMs can detect a stale handle, even
     # if the database is subsequently reopened.
     cdef unsigned int generation
+    # Compiled Jx9 VMs used by Collection, keyed by script, in LRU order.
+    cdef object vm_cache
+    cdef readonly int vm_cache_size
+    # Incremented by any operation that may modify the database, so that a
+    # value read with the GIL released is only cached if nothing was written
+    # in the meantime.
+    cdef unsigned long long epoch
+    # Jx9 VMs keep in-memory copies of the collections they have loaded, so a
+    # cached VM is only re-used if vm_epoch has not changed since it last
+    # ran. It is incremented by Jx9 writes, rollbacks, and key/value writes
+    # to a key that may hold the header ("<name>") or a record
+    # ("<name>_<id>") of one of the collections in vm_collections.
+    cdef unsigned long long vm_epoch
+    cdef set vm_collections
+    # Indexed fields of each collection, keyed by name, cached by
+    # Collection. Cleared when a transaction is rolled back.
+    cdef dict index_fields
+    # Number of records, maintained by the key/value methods once it has been
+    # counted if count_records is set, so that len() is constant-time. Writes
+    # with an unknown effect on the number of records (Jx9 scripts,
+    # rollbacks) invalidate it. While the count is valid, writes check
+    # whether the key exists and hold the GIL, so that the check and the
+    # write happen atomically with respect to other threads.
+    cdef readonly bint count_records
+    cdef Py_ssize_t record_count
+    cdef bint count_valid
+    # Memory map used by fetch_view() when opened with UNQLITE_OPEN_MMAP, and
+    # weak references to the views handed out over it, which are released on
+    # close. Dead references are pruned when the list reaches views_limit.
+    cdef MappedFile mapping
+    cdef list views
+    cdef Py_ssize_t views_limit
+    # Write buffer attached by write_buffer(). While set, store(), append()
+    # and delete() are queued in it, fetch() and exists() see the queued
+    # writes, and other operations flush it first.
+    cdef BufferedWriter writer
+    # Read-through cache of fetched values, if enabled with cache_size.
+    cdef ValueCache cache
+    # Codec used to serialize values, and its name (None if values are
+    # stored as bytes).
+    cdef int codec_id
+    cdef readonly object codec
+    # Operation counters and latencies, if enabled with metrics=True.
+    cdef Metrics metrics
+    # Jx9 VM profiler attached by profile_vms().
+    cdef VMProfiler profiler
+    # Set between begin() and commit() or rollback().
+    cdef bint in_transaction
+    # Storage calls release the GIL if the handle is thread-safe. The number
+    # of calls in progress is counted, and `idle` is notified when the last
+    # one finishes, so that cursors and close() can wait for them.
+    cdef bint release_gil
+    cdef Py_ssize_t inflight
+    cdef object idle
+    cdef Py_ssize_t idle_waiters
 
     def __cinit__(self):
         self.database = <unqlite *>0
         self.is_memory = False
         self.is_open = False
+        self.ordered = False
         self.generation = 0
+        self.vm_cache = OrderedDict()
+        self.vm_cache_size = 0
+        self.epoch = 0
+        self.vm_epoch = 0
+        self.vm_collections = set()
+        self.index_fields = {}
+        self.record_count = 0
+        self.count_valid = False
+        self.mapping = None
+        self.views = []
+        self.views_limit = 64
+        self.writer = None
+        self.cache = None
+        self.codec_id = CODEC_NONE
+        self.codec = None
+        self.metrics = None
+        self.profiler = None
+        self.in_transaction = False
+        self.release_gil = False
+        self.inflight = 0
+        self.idle = threading.Condition()
+        self.idle_waiters = 0
 
     def __dealloc__(self):
         if self.is_open:
-            unqlite_close(self.database)
+            if self.mapping is not None and self.mapping.exports:
+                self.mapping.closed = True
+                self.mapping.detached = self.database
+            else:
+                unqlite_close(self.database)
 
     def __init__(self, filename=':mem:', flags=UNQLITE_OPEN_CREATE,
-                 open_database=True, thread_safe=True):
+                 open_database=True, thread_safe=True, vm_cache_size=0,
+                 kv_engine=None, hash_function=None, comparator=None,
+                 cache_size=0, cache_bytes=0, codec=None, metrics=False,
+                 count_records=False):
         if thread_safe:
             unqlite_lib_config(UNQLITE_LIB_CONFIG_THREAD_LEVEL_MULTI)
+        # The mutex that makes releasing the GIL safe is only used if the
+        # library was built with threads and the handle is not opened with
+        # UNQLITE_OPEN_NOMUTEX.
+        self.release_gil = (thread_safe and unqlite_lib_is_threadsafe() and
+                            not (flags & UNQLITE_OPEN_NOMUTEX))
         self.filename = filename
         if isinstance(filename, unicode):
             self.encoded_filename = fsencode(filename)
@@ -385,6 +1534,26 @@ cdef class UnQLite(object):
             self.encoded_filename = encode(filename)
         self.flags = flags
         self.is_memory = self.encoded_filename == b':mem:'
+        self.vm_cache_size = vm_cache_size
+        self.encoded_kv_engine = None if kv_engine is None else \
+            encode(kv_engine)
+        if hash_function is not None:
+            get_hash_function(hash_function)  # Validate.
+        if comparator is not None and comparator not in KEY_ORDERS:
+            raise ValueError('Unrecognized comparator "%s", expected one of: '
+                             '%s.' % (comparator, ', '.join(KEY_ORDERS)))
+        self.hash_function = hash_function
+        self.requested_comparator = comparator
+        if cache_size < 0 or cache_bytes < 0:
+            raise ValueError('cache_size and cache_bytes must not be '
+                             'negative.')
+        elif cache_size:
+            self.cache = ValueCache(cache_size, cache_bytes)
+        self.codec_id = codec_id(codec)
+        self.codec = codec
+        if metrics:
+            self.metrics = Metrics()
+        self.count_records = count_records
         self.open_database = open_database
         if self.open_database:
             self.open()
@@ -401,21 +1570,102 @@ cdef class UnQLite(object):
             self.flags))
 
         self.is_open = True
+        try:
+            self._configure_storage()
+        except:
+            self.close()
+            raise
+        # In-memory and temporary databases always start out empty.
+        self.record_count = 0
+        self.count_valid = self.count_records and self._is_private()
         return True
 
+    cdef _configure_storage(self):
+        # Storage engine options must be applied before the first record is
+        # read or written.
+        cdef int order
+
+        if self.encoded_kv_engine is not None:
+            self.check_call(unqlite_config(
+                self.database, UNQLITE_CONFIG_KV_ENGINE,
+                <const char *>self.encoded_kv_engine))
+        self.ordered = self.kv_engine() == 'btree'
+        self.comparator = None
+
+        if self.hash_function is not None:
+            if self.ordered:
+                raise ValueError('Hash functions are not used by ordered '
+                                 'storage engines.')
+            self.check_call(unqlite_kv_config(
+                self.database, UNQLITE_KV_CONFIG_HASH_FUNC,
+                get_hash_function(self.hash_function)))
+
+        if self.ordered:
+            if self.requested_comparator is not None:
+                self.check_call(unqlite_kv_config(
+                    self.database, UNQLITE_KV_CONFIG_KEY_ORDER,
+                    <int>KEY_ORDERS[self.requested_comparator]))
+            self.check_call(unqlite_kv_config(
+                self.database, UNQLITE_KV_CONFIG_GET_KEY_ORDER, &order))
+            self.comparator = 'length' if order == UNQLITE_KV_ORDER_LENGTH \
+                else 'memcmp'
+        elif self.requested_comparator not in (None, 'memcmp'):
+            raise ValueError('Key comparators other than "memcmp" require an '
+                             'ordered storage engine.')
+
+    cdef bint _is_private(self):
+        # Database is not backed by a file that other handles could open.
+        return self.is_memory or \
+            self.flags & (UNQLITE_OPEN_IN_MEMORY | UNQLITE_OPEN_TEMP_DB)
+
     def close(self):
         """Close database connection."""
         cdef int ret
 
         if not self.is_open: return False
 
-        # unqlite_close() releases the handle (and all of its outstanding
-        # cursors and VMs) even on error, so mark the connection closed
-        # before raising.
-        ret = unqlite_close(self.database)
+        if self.writer is not None:
+            self.writer.close()
+
+        # Views that cannot be released because their buffer is still in use
+        # (e.g. by a NumPy array) keep the memory map, and with it the
+        # database handle, alive until they are released.
+        for ref in self.views:
+            view = ref()
+            if view is not None:
+                try:
+                    view.release()
+                except BufferError:
+                    pass
+        self.views = []
+
+        # Wait for calls made by other threads without the GIL. None can
+        # start while this thread holds the GIL.
+        self._wait_idle()
+        if not self.is_open:
+            return False
+
+        if self.mapping is not None:
+            self.mapping.closed = True
+        if self.mapping is not None and self.mapping.exports:
+            self.mapping.detached = self.database
+            ret = UNQLITE_OK
+        else:
+            # unqlite_close() releases the handle (and all of its outstanding
+            # cursors and VMs) even on error, so mark the connection closed
+            # before raising.
+            ret = unqlite_close(self.database)
+        self.mapping = None
         self.is_open = False
         self.database = <unqlite *>0
         self.generation += 1
+        self.count_valid = False
+        self.in_transaction = False
+        self.vm_cache.clear()
+        self.vm_collections.clear()
+        self.index_fields.clear()
+        if self.cache is not None:
+            self.cache.clear()
         self.check_call(ret)
         return True
 
@@ -439,83 +1689,359 @@ cdef class UnQLite(object):
             raise NotImplementedError('Error disabling autocommit.')
         return True
 
+    # The key/value methods below release the GIL while UnQLite does its
+    # work. The encoded key and value are held in local `bytes` references
+    # for the duration of the call, so the raw pointers handed to UnQLite
+    # remain valid. UnQLite serializes access to the handle with its own
+    # per-database mutex, which is only used by thread-safe handles, so
+    # other handles keep the GIL. Nothing between _begin_call() and
+    # _end_call() may touch a Python object.
+    #
+    # The mutex does not cover cursors or Jx9 VMs, so those keep the GIL and
+    # call _wait_idle() first: once the calls in progress have finished, no
+    # other can start until the GIL is given up.
+
+    cdef inline PyThreadState *_begin_call(self) noexcept:
+        self.inflight += 1
+        # While a thread waits for the handle to go idle, calls keep the GIL
+        # so that a busy writer cannot starve it.
+        if self.release_gil and not self.idle_waiters:
+            return PyEval_SaveThread()
+        return NULL
+
+    cdef inline void _end_call(self, PyThreadState *state) noexcept:
+        if state != NULL:
+            PyEval_RestoreThread(state)
+        self.inflight -= 1
+        if self.idle_waiters and not self.inflight:
+            self._notify_idle()
+
+    cdef void _notify_idle(self) noexcept:
+        with self.idle:
+            self.idle.notify_all()
+
+    cdef inline int _wait_idle(self) except -1:
+        if self.inflight:
+            self.idle_waiters += 1
+            try:
+                with self.idle:
+                    while self.inflight:
+                        self.idle.wait()
+            finally:
+                self.idle_waiters -= 1
+        return 0
+
     cpdef store(self, key, value):
         """Store key/value."""
-        cdef bytes encoded_key = encode(key)
-        cdef bytes encoded_value = encode(value)
+        self._store_raw(key, codec_encode(self.codec_id, value))
 
-        self.check_call(unqlite_kv_store(
-            self.database,
-            <const char *>encoded_key,
-            len(encoded_key),
-            <const char *>encoded_value,
-            len(encoded_value)))
+    cdef _store_raw(self, key, bytes value):
+        # Stores a value that has already been serialized.
+        if self.writer is not None:
+            self.writer._queue(encode(key), WB_STORE, value)
+        else:
+            self._store(encode(key), value)
+
+    cdef _store(self, bytes encoded_key, bytes encoded_value):
+        cdef int nkey = len(encoded_key)
+        cdef unqlite_int64 nvalue = len(encoded_value)
+        cdef const char *k = encoded_key
+        cdef const char *v = encoded_value
+        cdef unsigned long long start = 0
+        cdef bint found
+        cdef int ret
+        cdef PyThreadState *state
+
+        if self.metrics is not None:
+            start = unqlite_clock_ns()
+        self.epoch += 1
+        if self.vm_collections:
+            self._touch_collection(encoded_key)
+        if self.count_valid:
+            found = kv_exists(self.database, k, nkey)
+            ret = unqlite_kv_store(self.database, k, nkey, v, nvalue)
+            if ret == UNQLITE_OK and not found:
+                self.record_count += 1
+        else:
+            state = self._begin_call()
+            ret = unqlite_kv_store(self.database, k, nkey, v, nvalue)
+            self._end_call(state)
+        if self.cache is not None:
+            if ret == UNQLITE_OK:
+                self.cache.put(encoded_key, encoded_value)
+            else:
+                self.cache.discard(encoded_key)
+        if self.metrics is not None:
+            self.metrics.record(MET_STORE, start, ret, 0, nkey + nvalue)
+        self.check_call(ret)
 
     cpdef fetch(self, key):
         """Retrieve value at given key. Raises `KeyError` if key not found."""
-        cdef char *buf = <char *>0
-        cdef unqlite_int64 buf_size = 0
+        return codec_decode(self.codec_id, self._fetch_raw(key))
+
+    cdef bytes _fetch_raw(self, key):
+        # Retrieves a value without deserializing it.
+        if self.writer is not None:
+            return self.writer._fetch(encode(key))
+        return self._fetch(encode(key))
+
+    cdef _fetch(self, bytes encoded_key):
+        cdef int nkey = len(encoded_key)
+        cdef const char *k = encoded_key
+        cdef kv_buffer buf
+        cdef unsigned long long epoch = self.epoch
+        cdef unsigned long long start = 0
+        cdef bytes value
+        cdef int ret
+        cdef PyThreadState *state
+
+        if self.metrics is not None:
+            start = unqlite_clock_ns()
+        if self.cache is not None:
+            cached = self.cache.lookup(encoded_key)
+            if cached is None:
+                if self.metrics is not None:
+                    self.metrics.record(MET_FETCH, start, UNQLITE_NOTFOUND)
+                raise KeyError('key not found')
+            elif cached is not cache_absent:
+                if self.metrics is not None:
+                    self.metrics.record(MET_FETCH, start, UNQLITE_OK,
+                                        len(<bytes>cached))
+                return cached
+
+        # A single lookup streams the value into a buffer sized by the
+        # consumer, rather than probing for the size and fetching again.
+        kv_buffer_init(&buf, NULL, 0, True)
+        try:
+            state = self._begin_call()
+            ret = unqlite_kv_fetch_callback(self.database, k, nkey,
+                                            kv_buffer_consumer, &buf)
+            self._end_call(state)
+            if buf.nomem:
+                raise MemoryError
+            if self.metrics is not None:
+                self.metrics.record(MET_FETCH, start, ret, buf.size)
+            # Another thread may have written while the GIL was released,
+            # in which case the value read is not cached.
+            if ret == UNQLITE_NOTFOUND and self.cache is not None and \
+                    self.epoch == epoch:
+                self.cache.put(encoded_key, None)
+            self.check_call(ret)
+            value = buf.data[:buf.size]
+            if self.cache is not None and self.epoch == epoch:
+                self.cache.put(encoded_key, value)
+            return value
+        finally:
+            PyMem_RawFree(buf.data)
+
+    cpdef fetch_into(self, key, buf):
+        """
+        Read the value at the given key into the writable buffer `buf`,
+        returning the length of the value. If the return value exceeds the
+        size of the buffer, only the leading bytes were copied. Raises
+        `KeyError` if key not found.
+        """
         cdef bytes encoded_key = encode(key)
+        cdef int nkey = len(encoded_key)
+        cdef const char *k = encoded_key
+        cdef kv_buffer dest
+        cdef Py_buffer view
+        cdef int ret
+        cdef PyThreadState *state
 
-        self.check_call(unqlite_kv_fetch(
-            self.database,
-            <const char *>encoded_key,
-            len(encoded_key),
-            <void *>0,
-            &buf_size))
+        self._flush_writes()
+        PyObject_GetBuffer(buf, &view, PyBUF_WRITABLE)
+        try:
+            kv_buffer_init(&dest, <char *>view.buf, view.len, False)
+            state = self._begin_call()
+            ret = unqlite_kv_fetch_callback(self.database, k, nkey,
+                                            kv_buffer_consumer, &dest)
+            self._end_call(state)
+            self.check_call(ret)
+            return dest.total
+        finally:
+            PyBuffer_Release(&view)
 
+    def fetch_view(self, key):
+        """
+        Retrieve the value at the given key as a read-only `memoryview`.
+        Raises `KeyError` if key not found.
+
+        When the database was opened with UNQLITE_OPEN_MMAP, values that are
+        stored contiguously in the file are not copied: the view points into
+        the memory map. Views are released when the database is closed.
+        """
+        cdef bytes encoded_key = encode(key)
+        cdef int nkey = len(encoded_key)
+        cdef const char *k = encoded_key
+        cdef kv_view view
+        cdef int ret
+        cdef PyThreadState *state
+
+        self._flush_writes()
+        if not self._init_view(&view):
+            return memoryview(self._fetch(encoded_key))
         try:
-            buf = <char *>PyMem_Malloc(buf_size)
-            if not buf:
-                raise MemoryError
-            self.check_call(unqlite_kv_fetch(
-                self.database,
-                <const char *>encoded_key,
-                len(encoded_key),
-                <void *>buf,
-                &buf_size))
-            value = buf[:buf_size]
-            return value
+            state = self._begin_call()
+            ret = unqlite_kv_fetch_callback(self.database, k, nkey,
+                                            kv_view_consumer, &view)
+            self._end_call(state)
+            return self._finish_view(&view, ret)
         finally:
-            PyMem_Free(buf)
+            PyMem_RawFree(view.buf.data)
+
+    cdef bint _init_view(self, kv_view *view) except -1:
+        if not (self.flags & UNQLITE_OPEN_MMAP):
+            return False
+        if self.mapping is None:
+            self.mapping = MappedFile(self)
+        if not self.mapping.start:
+            return False
+        view.map_start = self.mapping.start
+        view.map_end = self.mapping.end
+        view.data = NULL
+        view.size = 0
+        view.gathered = False
+        kv_buffer_init(&view.buf, NULL, 0, True)
+        return True
+
+    cdef _finish_view(self, kv_view *view, int ret):
+        cdef MappedValue value
+
+        if view.buf.nomem:
+            raise MemoryError
+        self.check_call(ret)
+        if view.gathered:
+            return memoryview(view.buf.data[:view.buf.size])
+        elif view.data == NULL:
+            return memoryview(b'')
+        value = MappedValue.__new__(MappedValue)
+        value.mapping = self.mapping
+        value.data = view.data
+        value.size = view.size
+        result = memoryview(value)
+        if len(self.views) >= self.views_limit:
+            self.views = [ref for ref in self.views if ref() is not None]
+            self.views_limit = max(64, 2 * len(self.views))
+        self.views.append(weakref.ref(result))
+        return result
 
     cpdef delete(self, key):
         """Delete the value stored at the given key."""
-        cdef bytes encoded_key = encode(key)
+        if self.writer is not None:
+            self.writer.delete(key)
+        else:
+            self._delete(encode(key))
 
-        self.check_call(unqlite_kv_delete(
-            self.database, <char *>encoded_key, len(encoded_key)))
+    cdef _delete(self, bytes encoded_key):
+        cdef int nkey = len(encoded_key)
+        cdef const char *k = encoded_key
+        cdef unsigned long long start = 0
+        cdef int ret
+        cdef PyThreadState *state
+
+        if self.metrics is not None:
+            start = unqlite_clock_ns()
+        self.epoch += 1
+        if self.vm_collections:
+            self._touch_collection(encoded_key)
+        if self.count_valid:
+            ret = unqlite_kv_delete(self.database, k, nkey)
+            if ret == UNQLITE_OK:
+                self.record_count -= 1
+        else:
+            state = self._begin_call()
+            ret = unqlite_kv_delete(self.database, k, nkey)
+            self._end_call(state)
+        if self.cache is not None:
+            if ret == UNQLITE_OK:
+                self.cache.put(encoded_key, None)
+            else:
+                self.cache.discard(encoded_key)
+        if self.metrics is not None:
+            self.metrics.record(MET_DELETE, start, ret)
+        self.check_call(ret)
 
     cpdef append(self, key, value):
         """Append to the value stored in the given key."""
-        cdef bytes encoded_key = encode(key)
-        cdef bytes encoded_value = encode(value)
-
-        self.check_call(unqlite_kv_append(
-            self.database,
-            <const char *>encoded_key,
-            len(encoded_key),
-            <const char *>encoded_value,
-            len(encoded_value)))
+        if self.codec_id != CODEC_NONE:
+            raise ValueError('Values cannot be appended to when a codec is '
+                             'used.')
+        self._append_raw(key, encode(value))
+
+    cdef _append_raw(self, key, bytes value):
+        if self.writer is not None:
+            self.writer._queue(encode(key), WB_APPEND, value)
+        else:
+            self._append(encode(key), value)
+
+    cdef _append(self, bytes encoded_key, bytes encoded_value):
+        cdef int nkey = len(encoded_key)
+        cdef unqlite_int64 nvalue = len(encoded_value)
+        cdef const char *k = encoded_key
+        cdef const char *v = encoded_value
+        cdef unsigned long long start = 0
+        cdef bint found
+        cdef int ret
+        cdef PyThreadState *state
+
+        if self.metrics is not None:
+            start = unqlite_clock_ns()
+        self.epoch += 1
+        if self.vm_collections:
+            self._touch_collection(encoded_key)
+        if self.count_valid:
+            found = kv_exists(self.database, k, nkey)
+            ret = unqlite_kv_append(self.database, k, nkey, v, nvalue)
+            if ret == UNQLITE_OK and not found:
+                self.record_count += 1
+        else:
+            state = self._begin_call()
+            ret = unqlite_kv_append(self.database, k, nkey, v, nvalue)
+            self._end_call(state)
+        if self.cache is not None:
+            self.cache.discard(encoded_key)
+        if self.metrics is not None:
+            self.metrics.record(MET_APPEND, start, ret, 0, nkey + nvalue)
+        self.check_call(ret)
 
     cpdef exists(self, key):
-        cdef bytes encoded_key = encode(key)
-        cdef char *buf = <char *>0
+        if self.writer is not None:
+            return self.writer.exists(key)
+        return self._exists(encode(key))
+
+    cdef bint _exists(self, bytes encoded_key) except -1:
+        cdef int nkey = len(encoded_key)
+        cdef const char *k = encoded_key
         cdef unqlite_int64 buf_size = 0
+        cdef unsigned long long epoch = self.epoch
+        cdef unsigned long long start = 0
         cdef int ret
-
-        ret = unqlite_kv_fetch(
-            self.database,
-            <const char *>encoded_key,
-            len(encoded_key),
-            <void *>0,
-            &buf_size)
+        cdef PyThreadState *state
+
+        if self.metrics is not None:
+            start = unqlite_clock_ns()
+        if self.cache is not None:
+            cached = self.cache.lookup(encoded_key)
+            if cached is not cache_absent:
+                if self.metrics is not None:
+                    self.metrics.record(
+                        MET_EXISTS, start,
+                        UNQLITE_NOTFOUND if cached is None else UNQLITE_OK)
+                return cached is not None
+
+        state = self._begin_call()
+        ret = unqlite_kv_fetch(self.database, k, nkey, <void *>0,
+                               &buf_size)
+        self._end_call(state)
+        if self.metrics is not None:
+            self.metrics.record(MET_EXISTS, start, ret)
         if ret == UNQLITE_NOTFOUND:
+            if self.cache is not None and self.epoch == epoch:
+                self.cache.put(encoded_key, None)
             return False
-        elif ret == UNQLITE_OK:
-            return True
-
-        raise self._build_exception_for_error(ret)
+        self.check_call(ret)
+        return True
 
     def get(self, key, default=None):
         """
@@ -545,6 +2071,8 @@ cdef class UnQLite(object):
         if the result is other than `UNQLITE_OK`.
         """
         if result != UNQLITE_OK:
+            if self.metrics is not None:
+                self.metrics.status(result)
             raise self._build_exception_for_error(result)
 
     cdef _build_exception_for_error(self, int status):
@@ -581,31 +2109,79 @@ cdef class UnQLite(object):
 
         return zBuf[:size]
 
+    cdef int _flush_writes(self) except -1:
+        if self.writer is not None:
+            self.writer.flush()
+        return 0
+
+    cdef int _transaction_call(self, int op):
+        # Begin, commit or rollback without flushing the write buffer.
+        # Returns the UnQLite status.
+        cdef unsigned long long start = 0
+        cdef int ret
+        cdef PyThreadState *state
+        if self.metrics is not None:
+            start = unqlite_clock_ns()
+        state = self._begin_call()
+        if op == MET_BEGIN:
+            ret = unqlite_begin(self.database)
+        elif op == MET_COMMIT:
+            ret = unqlite_commit(self.database)
+        else:
+            ret = unqlite_rollback(self.database)
+        self._end_call(state)
+        if self.metrics is not None:
+            self.metrics.record(op, start, ret)
+        return ret
+
     cpdef begin(self):
         """Begin a new transaction. Only works for file-based databases."""
         if self.is_memory: return False
-
-        self.check_call(unqlite_begin(self.database))
+        self._flush_writes()
+        self.check_call(self._transaction_call(MET_BEGIN))
+        self.in_transaction = True
         return True
 
     cpdef commit(self):
         """Commit current transaction. Only works for file-based databases."""
         if self.is_memory: return False
-
-        self.check_call(unqlite_commit(self.database))
+        self._flush_writes()
+        self.in_transaction = False
+        self.check_call(self._transaction_call(MET_COMMIT))
         return True
 
     cpdef rollback(self):
         """Rollback current transaction. Only works for file-based databases."""
         if self.is_memory: return False
-
-        self.check_call(unqlite_rollback(self.database))
+        if self.writer is not None:
+            self.writer._discard()
+
+        self.epoch += 1
+        self.vm_epoch += 1
+        self.index_fields.clear()
+        self.count_valid = False
+        if self.cache is not None:
+            self.cache.clear()
+        self.in_transaction = False
+        self.check_call(self._transaction_call(MET_ROLLBACK))
         return True
 
     def transaction(self):
         """Create context manager for wrapping a transaction."""
         return Transaction(self)
 
+    cdef Transaction _atomic(self):
+        # Transaction for a multi-step operation, which joins the caller's
+        # transaction if one is open rather than committing it.
+        return Transaction(self, True)
+
+    def write_buffer(self, int max_ops=1000, max_delay_ms=None):
+        """
+        Buffer writes made through this handle and commit them in groups.
+        See `BufferedWriter`.
+        """
+        return BufferedWriter(self, max_ops, max_delay_ms)
+
     def commit_on_success(self, fn):
         def wrapper(*args, **kwargs):
             with self.transaction():
@@ -614,6 +2190,7 @@ cdef class UnQLite(object):
 
     def cursor(self):
         """Create a cursor for iterating through the database."""
+        self._flush_writes()
         return Cursor(self)
 
     def vm(self, code):
@@ -624,40 +2201,328 @@ cdef class UnQLite(object):
         """Create a wrapper for working with Jx9 collections."""
         return Collection(self, name)
 
+    cdef VM _checkout_vm(self, script):
+        """
+        Return a compiled VM for the given script, re-using a cached VM if one
+        is available and still current. The VM is removed from the cache
+        while in use, and must be handed back with `_checkin_vm()`.
+        """
+        cdef VM vm = self.vm_cache.pop(script, None)
+        if vm is not None:
+            if vm.vm and vm.generation == self.generation and \
+                    vm.epoch == self.vm_epoch:
+                vm.reset()
+                return vm
+            vm.close()
+
+        vm = VM(self, script)
+        vm.managed = True
+        vm.compile()
+        return vm
+
+    cdef _checkin_vm(self, script, VM vm, bint wrote, bint reuse=True):
+        """
+        Return a VM obtained from `_checkout_vm()`, indicating whether the
+        script may have modified the database.
+        """
+        cdef VM evicted
+
+        vm._finish_run()
+        if wrote:
+            self.epoch += 1
+            self.vm_epoch += 1
+            self.count_valid = False
+            if self.cache is not None:
+                self.cache.clear()
+        vm.uses += 1
+        if not reuse or self.vm_cache_size <= 0 or \
+                vm.uses >= VM_CACHE_MAX_USES or \
+                not self.is_open or vm.generation != self.generation:
+            vm.close()
+            return
+
+        vm.epoch = self.vm_epoch
+        self.vm_cache[script] = vm
+        while len(self.vm_cache) > self.vm_cache_size:
+            _, evicted = self.vm_cache.popitem(last=False)
+            evicted.close()
+
+    def clear_vm_cache(self):
+        """Release all cached Jx9 VMs."""
+        cdef VM vm
+        for vm in self.vm_cache.values():
+            vm.close()
+        self.vm_cache.clear()
+        self.vm_collections.clear()
+
+    cdef _touch_collection(self, bytes encoded_key):
+        # Invalidates the cached VMs if the key may belong to a collection
+        # one of them has loaded.
+        cdef bytes name
+        for name in self.vm_collections:
+            if encoded_key.startswith(name) and (
+                    len(encoded_key) == len(name) or
+                    encoded_key[len(name):len(name) + 1] == b'_'):
+                self.vm_epoch += 1
+                return
+
     cpdef update(self, dict values):
-        for key in values:
-            self.store(key, values[key])
+        self._flush_writes()
+        self._store_batch(values.items())
+
+    cdef Py_ssize_t _store_batch(self, items, bint raw=False) except -1:
+        """
+        Store an iterable of (key, value) pairs, releasing the GIL once per
+        chunk of `BATCH_SIZE` items. Stops at the first error. Values are
+        serialized with the codec unless `raw` is set.
+        """
+        cdef kv_item *batch
+        cdef list refs = []
+        cdef bytes encoded_key, encoded_value
+        cdef Py_ssize_t n, inserted, nbytes, total = 0
+        cdef unsigned long long start = 0
+        cdef int ret = UNQLITE_OK
+        cdef PyThreadState *state
+
+        it = iter(items)
+        batch = <kv_item *>PyMem_Malloc(BATCH_SIZE * sizeof(kv_item))
+        if not batch:
+            raise MemoryError
+        try:
+            while True:
+                n = nbytes = 0
+                del refs[:]
+                if self.metrics is not None:
+                    start = unqlite_clock_ns()
+                for key, value in it:
+                    encoded_key = encode(key)
+                    if raw:
+                        encoded_value = value
+                    else:
+                        encoded_value = codec_encode(self.codec_id, value)
+                    if self.cache is not None:
+                        self.cache.discard(encoded_key)
+                    refs.append(encoded_key)
+                    refs.append(encoded_value)
+                    if self.vm_collections:
+                        self._touch_collection(encoded_key)
+                    batch[n].nkey = len(encoded_key)
+                    batch[n].key = encoded_key
+                    batch[n].nvalue = len(encoded_value)
+                    batch[n].value = encoded_value
+                    nbytes += batch[n].nkey + batch[n].nvalue
+                    n += 1
+                    if n == BATCH_SIZE:
+                        break
+                if n == 0:
+                    break
+
+                self.epoch += 1
+                if self.count_valid:
+                    ret = kv_store_batch(self.database, batch, n, True,
+                                         &inserted)
+                    self.record_count += inserted
+                else:
+                    state = self._begin_call()
+                    ret = kv_store_batch(self.database, batch, n, False,
+                                         &inserted)
+                    self._end_call(state)
+                if self.metrics is not None:
+                    self.metrics.record(MET_STORE_MANY, start, ret, 0, nbytes)
+                self.check_call(ret)
+                total += n
+                if n < BATCH_SIZE:
+                    break
+        finally:
+            PyMem_Free(batch)
+        return total
+
+    def store_many(self, items):
+        """
+        Store an iterable of (key, value) pairs, or a dict, in a single
+        transaction. Returns the number of items stored.
+        """
+        if isinstance(items, dict):
+            items = items.items()
+        self._flush_writes()
+        with self._atomic():
+            return self._store_batch(items)
+
+    def fetch_many(self, keys, default=None):
+        """
+        Retrieve the values for an iterable of keys, returning a list in the
+        same order. Missing keys are reported using the `default` value.
+        """
+        cdef kv_item *batch
+        cdef kv_buffer *bufs
+        cdef list refs = []
+        cdef list accum = []
+        cdef bytes encoded_key
+        cdef Py_ssize_t i, n, nfound, nbytes
+        cdef unsigned long long start = 0
+        cdef PyThreadState *state
+
+        self._flush_writes()
+        it = iter(keys)
+        batch = <kv_item *>PyMem_Malloc(BATCH_SIZE * sizeof(kv_item))
+        bufs = <kv_buffer *>PyMem_Malloc(BATCH_SIZE * sizeof(kv_buffer))
+        if not batch or not bufs:
+            PyMem_Free(batch)
+            PyMem_Free(bufs)
+            raise MemoryError
+        for i in range(BATCH_SIZE):
+            kv_buffer_init(&bufs[i], NULL, 0, True)
+
+        try:
+            while True:
+                n = 0
+                del refs[:]
+                for key in it:
+                    encoded_key = encode(key)
+                    refs.append(encoded_key)
+                    batch[n].nkey = len(encoded_key)
+                    batch[n].key = encoded_key
+                    n += 1
+                    if n == BATCH_SIZE:
+                        break
+                if n == 0:
+                    break
+
+                if self.metrics is not None:
+                    start = unqlite_clock_ns()
+                state = self._begin_call()
+                for i in range(n):
+                    bufs[i].size = bufs[i].total = 0
+                    batch[i].rc = unqlite_kv_fetch_callback(
+                        self.database,
+                        batch[i].key, batch[i].nkey,
+                        kv_buffer_consumer, &bufs[i])
+                self._end_call(state)
+                if self.metrics is not None:
+                    nfound = nbytes = 0
+                    for i in range(n):
+                        if batch[i].rc == UNQLITE_OK:
+                            nfound += 1
+                            nbytes += bufs[i].size
+                    self.metrics.record(MET_FETCH_MANY, start, UNQLITE_OK,
+                                        nbytes)
+                    self.metrics.hits += nfound
+                    self.metrics.misses += n - nfound
+
+                for i in range(n):
+                    if bufs[i].nomem:
+                        raise MemoryError
+                    elif batch[i].rc == UNQLITE_OK:
+                        accum.append(codec_decode_buf(
+                            self.codec_id, bufs[i].data, bufs[i].size))
+                    elif batch[i].rc == UNQLITE_NOTFOUND:
+                        accum.append(default)
+                    else:
+                        raise self._build_exception_for_error(batch[i].rc)
+                if n < BATCH_SIZE:
+                    break
+        finally:
+            # Buffers are re-used across chunks and only released here.
+            for i in range(BATCH_SIZE):
+                PyMem_RawFree(bufs[i].data)
+            PyMem_Free(bufs)
+            PyMem_Free(batch)
+        return accum
+
+    def delete_many(self, keys):
+        """
+        Delete an iterable of keys in a single transaction. Keys that do not
+        exist are ignored. Returns the number of keys that were deleted.
+        """
+        cdef kv_item *batch
+        cdef list refs = []
+        cdef bytes encoded_key
+        cdef Py_ssize_t n, ndeleted, deleted = 0
+        cdef unsigned long long start = 0
+        cdef int ret = UNQLITE_OK
+        cdef PyThreadState *state
+
+        self._flush_writes()
+        it = iter(keys)
+        batch = <kv_item *>PyMem_Malloc(BATCH_SIZE * sizeof(kv_item))
+        if not batch:
+            raise MemoryError
+        try:
+            with self._atomic():
+                while True:
+                    n = 0
+                    del refs[:]
+                    for key in it:
+                        encoded_key = encode(key)
+                        if self.cache is not None:
+                            self.cache.discard(encoded_key)
+                        refs.append(encoded_key)
+                        if self.vm_collections:
+                            self._touch_collection(encoded_key)
+                        batch[n].nkey = len(encoded_key)
+                        batch[n].key = encoded_key
+                        n += 1
+                        if n == BATCH_SIZE:
+                            break
+                    if n == 0:
+                        break
+
+                    if self.metrics is not None:
+                        start = unqlite_clock_ns()
+                    self.epoch += 1
+                    if self.count_valid:
+                        ret = kv_delete_batch(self.database, batch, n, &ndeleted)
+                        self.record_count -= ndeleted
+                    else:
+                        state = self._begin_call()
+                        ret = kv_delete_batch(self.database, batch, n,
+                                              &ndeleted)
+                        self._end_call(state)
+                    deleted += ndeleted
+                    if self.metrics is not None:
+                        self.metrics.record(MET_DELETE_MANY, start, ret)
+                    self.check_call(ret)
+                    if n < BATCH_SIZE:
+                        break
+        finally:
+            PyMem_Free(batch)
+        return deleted
 
-    def keys(self):
-        """Efficiently iterate through the database's keys."""
+    def keys(self, int batch_size=100):
+        """
+        Efficiently iterate through the database's keys. Value pages are not
+        read.
+        """
         cdef Cursor cursor
+        cdef list batch
         with self.cursor() as cursor:
-            while cursor.is_valid():
-                yield cursor.key()
-                try:
-                    cursor.next_entry()
-                except StopIteration:
+            while True:
+                batch = cursor.fetch_batch(batch_size, True, False)
+                if not batch:
                     break
+                yield from batch
 
-    def values(self):
+    def values(self, int batch_size=100):
         """Efficiently iterate through the database's values."""
         cdef Cursor cursor
+        cdef list batch
         with self.cursor() as cursor:
-            while cursor.is_valid():
-                yield cursor.value()
-                try:
-                    cursor.next_entry()
-                except StopIteration:
+            while True:
+                batch = cursor.fetch_batch(batch_size, False, True)
+                if not batch:
                     break
+                yield from batch
 
-    def items(self):
+    def items(self, int batch_size=100):
         """Efficiently iterate through the database's key/value pairs."""
         cdef Cursor cursor
-        cdef tuple item
-
+        cdef list batch
         with self.cursor() as cursor:
-            for item in cursor:
-                yield item
+            while True:
+                batch = cursor.fetch_batch(batch_size, True, True)
+                if not batch:
+                    break
+                yield from batch
 
     def __iter__(self):
         cursor = self.cursor()
@@ -670,22 +2535,45 @@ cdef class UnQLite(object):
         prefix.
 
         Note: the default UnQLite storage engines are hash-based and do not
-        store keys in sorted order, so this performs an O(n) scan.
+        store keys in sorted order, so this performs an O(n) scan. With the
+        ordered "btree" engine, only the matching records are visited, unless
+        keys are ordered by length.
         """
         cdef Cursor cursor
         cdef bytes encoded_prefix = encode(prefix)
         cdef tuple item
 
         with self.cursor() as cursor:
-            for item in cursor:
-                if encode(item[0]).startswith(encoded_prefix):
-                    yield item
+            if not (self.ordered and self.comparator == 'memcmp'):
+                for item in cursor:
+                    if encode(item[0]).startswith(encoded_prefix):
+                        yield item
+                return
+
+            try:
+                cursor.seek(encoded_prefix, UNQLITE_CURSOR_MATCH_GE)
+            except KeyError:
+                return
+            for item in cursor:
+                if not encode(item[0]).startswith(encoded_prefix):
+                    return
+                yield item
 
     def range(self, start_key, end_key,
                 bint include_end_key=True):
+        """
+        Iterate over the records from `start_key` up to `end_key`.
+
+        With the default hash-based storage engines, iteration starts at
+        `start_key`, which must exist, and continues in storage order until
+        `end_key` is reached. With the ordered "btree" engine, the keys
+        between the two bounds are returned in sorted order and neither key
+        needs to exist.
+        """
         cdef Cursor cursor = self.cursor()
         try:
-            cursor.seek(start_key)
+            cursor.seek(start_key, UNQLITE_CURSOR_MATCH_GE if self.ordered
+                        else UNQLITE_CURSOR_MATCH_EXACT)
         except KeyError:
             pass
         else:
@@ -695,18 +2583,104 @@ cdef class UnQLite(object):
             except StopIteration:
                 return
 
+    def parallel_scan(self, fn, workers=None, partitions=None):
+        """
+        Scan the whole database in parallel using a pool of worker processes.
+
+        The key-space is split into `partitions` disjoint partitions (by
+        default four per worker) and, for each one, `fn` is called in a worker
+        process with an iterator over its (key, value) pairs. The return
+        values of `fn` are yielded as the partitions complete, in no
+        particular order.
+
+        Each worker opens its own read-only handle on the database file, so
+        only committed data is visible, and `fn` and its return value must be
+        picklable if processes are not started by forking.
+        """
+        return self._parallel(_SCAN_FN, fn, None, workers, partitions)
+
+    def parallel_map(self, fn, workers=None, partitions=None):
+        """
+        Call `fn(key, value)` for every record, in parallel using a pool of
+        worker processes, and yield the results. Results are sent back one
+        partition at a time, so they are not ordered. See `parallel_scan()`.
+        """
+        cdef list results
+        for results in self._parallel(_SCAN_MAP, fn, None, workers,
+                                      partitions):
+            yield from results
+
+    def parallel_reduce(self, fn, combine, initial, workers=None,
+                        partitions=None):
+        """
+        Reduce the database in parallel using a pool of worker processes.
+        Every partition is reduced with `acc = fn(acc, key, value)`, starting
+        from a copy of `initial`, and the per-partition results are merged
+        with `combine(acc1, acc2)`. See `parallel_scan()`.
+        """
+        return functools.reduce(combine, self._parallel(
+            _SCAN_REDUCE, fn, initial, workers, partitions))
+
+    def _parallel(self, mode, fn, initial, workers, partitions):
+        if not self.is_open:
+            raise UnQLiteError('Database is not open.')
+        elif self._is_private():
+            raise UnQLiteError('Parallel scans require a file-backed '
+                               'database.')
+        self._flush_writes()
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if partitions is None:
+            partitions = workers * 4
+        if workers < 1 or partitions < 1:
+            raise ValueError('workers and partitions must be positive.')
+
+        # Workers receive the callable when they start, so that functions
+        # which cannot be pickled can still be used when forking.
+        initargs = (self.filename,
+                    UNQLITE_OPEN_READONLY | (self.flags & UNQLITE_OPEN_MMAP),
+                    self.kv_engine() if self.ordered else None,
+                    self.hash_function, self.codec, mode, fn, initial)
+        with multiprocessing.Pool(min(workers, partitions), _scan_init,
+                                  initargs) as pool:
+            yield from pool.imap_unordered(
+                _scan_partition,
+                [(i, partitions) for i in range(partitions)])
+
+    cdef _set_partition(self, int part, int nparts):
+        # Restrict cursors to one partition of the key-space.
+        self.check_call(unqlite_kv_config(
+            self.database, UNQLITE_KV_CONFIG_PARTITION, part, nparts))
+
     def __len__(self):
         """
         Return the total number of records in the database.
 
-        Note: this operation is O(n) and requires iterating through the
-        entire key-space.
+        Note: this is O(n) and iterates through the entire key-space. With
+        `count_records`, only the first call is, and the count is maintained
+        by the key/value methods until a Jx9 script or a rollback modifies
+        the database.
         """
-        cdef Cursor cursor
-        cdef long count = 0
-        with self.cursor() as cursor:
-            for item in cursor:
+        self._flush_writes()
+        if not self.count_valid:
+            self.record_count = self._count_records()
+            self.count_valid = self.count_records
+        return self.record_count
+
+    cdef Py_ssize_t _count_records(self) except -1:
+        cdef unqlite_kv_cursor *cursor
+        cdef Py_ssize_t count = 0
+
+        self.check_call(unqlite_kv_cursor_init(self.database, &cursor))
+        try:
+            self._wait_idle()
+            unqlite_kv_cursor_first_entry(cursor)
+            while unqlite_kv_cursor_valid_entry(cursor):
                 count += 1
+                if unqlite_kv_cursor_next_entry(cursor) != UNQLITE_OK:
+                    break
+        finally:
+            unqlite_kv_cursor_release(self.database, cursor)
         return count
 
     def flush(self):
@@ -714,7 +2688,7 @@ cdef class UnQLite(object):
         Remove all records from the database.
 
         Note: this operation is O(n) and requires iterating through the
-        entire key-space.
+        entire key-space. See `truncate()` for a faster alternative.
         """
         cdef Cursor cursor
         cdef long i = 0
@@ -722,8 +2696,97 @@ cdef class UnQLite(object):
             while cursor.is_valid():
                 cursor.delete()
                 i += 1
+        if self.cache is not None:
+            self.cache.clear()
+        self.record_count = 0
+        self.count_valid = self.count_records
         return i
 
+    def truncate(self):
+        """
+        Remove all records by replacing the database with an empty one,
+        rather than deleting records one at a time. The database is closed
+        and re-opened, so open cursors, VMs and transactions are invalidated.
+        File-based databases must not be open through any other handle.
+        """
+        cdef list moved = []
+
+        if not self.is_open:
+            raise UnQLiteError('Database is not open.')
+        elif self.flags & UNQLITE_OPEN_READONLY:
+            raise UnQLiteError('Cannot truncate a read-only database.')
+
+        # The storage engine is re-selected from `kv_engine` on open. Closing
+        # flushes any write buffer. The old files are moved aside rather than
+        # removed, so they can be restored if the empty database cannot be
+        # created.
+        self.close()
+        try:
+            if not self._is_private():
+                for filename in (self.encoded_filename,
+                                 self.encoded_filename + b'_unqlite_journal'):
+                    if os.path.exists(filename):
+                        os.replace(filename, filename + b'.truncate')
+                        moved.append(filename)
+            self.open()
+        except BaseException:
+            if self.is_open:
+                self.close()
+            for filename in moved:
+                os.replace(filename + b'.truncate', filename)
+            if not self.is_open:
+                self.open()
+            raise
+        for filename in moved:
+            os.unlink(filename + b'.truncate')
+        return True
+
+    def cache_stats(self):
+        """
+        Return a dict of statistics for the read cache (hits, misses,
+        evictions, entries and bytes), or None if it is not enabled.
+        """
+        if self.cache is None:
+            return None
+        return self.cache.stats()
+
+    def clear_cache(self):
+        """Empty the read cache, e.g. after another process wrote."""
+        if self.cache is not None:
+            self.cache.clear()
+
+    def profile_vms(self, slow_ms=None, on_slow=None):
+        """
+        Profile the Jx9 VMs run on this database, logging runs that take at
+        least `slow_ms` milliseconds. See `VMProfiler`.
+        """
+        return VMProfiler(self, slow_ms, on_slow)
+
+    def stats(self):
+        """
+        Return a dict of operation counts, latency histograms, lookup hits
+        and misses, bytes read and written, and the error statuses returned
+        by UnQLite, or None if metrics are not enabled.
+        """
+        if self.metrics is None:
+            return None
+        return self.metrics.stats()
+
+    def reset_stats(self):
+        """Reset the metrics collected so far."""
+        if self.metrics is not None:
+            self.metrics.reset()
+
+    def on_operation(self, fn):
+        """
+        Call `fn(operation, elapsed_ns, status)` after every timed operation,
+        enabling metrics if needed. Pass None to remove the hook.
+        """
+        if self.metrics is None:
+            self.metrics = Metrics()
+        self.metrics.hook = fn
+        return fn
+
     def set_max_page_cache(self, int npages):
         """
         Suggest the maximum number of raw pages to cache in memory.
@@ -759,18 +2822,60 @@ cdef class UnQLite(object):
         return unqlite_lib_version()
 
 
+# Worker state for parallel scans: the read-only handle opened by each worker
+# process and the work it performs on every partition.
+cdef int _SCAN_FN = 0
+cdef int _SCAN_MAP = 1
+cdef int _SCAN_REDUCE = 2
+cdef object _scan_state = None
+
+
+def _scan_init(filename, flags, kv_engine, hash_function, codec, mode, fn,
+               initial):
+    global _scan_state
+    db = UnQLite(filename, flags, kv_engine=kv_engine,
+                 hash_function=hash_function, codec=codec)
+    _scan_state = (db, mode, fn, initial)
+
+
+def _scan_partition(args):
+    cdef UnQLite db
+    cdef int mode
+    db, mode, fn, initial = _scan_state
+    db._set_partition(args[0], args[1])
+    items = db.items()
+    if mode == _SCAN_FN:
+        return fn(items)
+    elif mode == _SCAN_MAP:
+        return [fn(key, value) for key, value in items]
+    acc = copy.deepcopy(initial)
+    for key, value in items:
+        acc = fn(acc, key, value)
+    return acc
+
+
 cdef class Transaction(object):
     """Expose transaction as a context manager."""
     cdef UnQLite unqlite
+    # A nested transaction joins one that is already open, leaving it to the
+    # owner to commit or roll back.
+    cdef bint nested
+    cdef bint joined
 
-    def __init__(self, unqlite):
+    def __init__(self, unqlite, nested=False):
         self.unqlite = unqlite
+        self.nested = nested
+        self.joined = False
 
     def __enter__(self):
-        self.unqlite.begin()
+        self.joined = self.nested and self.unqlite.in_transaction
+        if not self.joined:
+            self.unqlite.begin()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.joined:
+            return
         if exc_type:
             self.unqlite.rollback()
         else:
@@ -781,21 +2886,286 @@ cdef class Transaction(object):
                 raise
 
 
+# Writes queued by a BufferedWriter.
+cdef enum:
+    WB_STORE = 0
+    WB_APPEND = 1
+    WB_DELETE = 2
+
+
+cdef class BufferedWriter(object):
+    """
+    Write-behind buffer. Stores, appends and deletes made through the
+    database are queued, and written in a single transaction once `max_ops`
+    writes have been queued or `max_delay_ms` milliseconds after the first
+    one, or when `flush()` is called. Only the last write to a key is kept.
+    """
+    cdef readonly UnQLite unqlite
+    cdef readonly int max_ops
+    cdef readonly object max_delay_ms
+    cdef readonly bint closed
+    # Encoded key -> (WB_* operation, encoded value), and number of writes
+    # queued since the last flush.
+    cdef dict pending
+    cdef Py_ssize_t nops
+    # Callbacks waiting for the queued writes to be committed.
+    cdef list callbacks
+    cdef object lock
+    cdef object timer
+    # Failure of a flush started by the timer, raised by the next call.
+    cdef object error
+
+    def __init__(self, UnQLite unqlite, int max_ops=1000, max_delay_ms=None):
+        if max_ops < 1:
+            raise ValueError('max_ops must be at least 1.')
+        if not unqlite.is_open:
+            raise UnQLiteError('Database is not open.')
+        elif unqlite.writer is not None:
+            raise UnQLiteError('Database already has a write buffer.')
+        self.unqlite = unqlite
+        self.max_ops = max_ops
+        self.max_delay_ms = max_delay_ms
+        self.closed = False
+        self.pending = {}
+        self.nops = 0
+        self.callbacks = []
+        self.lock = threading.RLock()
+        self.timer = None
+        self.error = None
+        unqlite.writer = self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return self.nops
+
+    cdef check_error(self):
+        cdef object error
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    cdef _queue(self, bytes key, int op, bytes value):
+        cdef tuple prev
+        with self.lock:
+            if self.closed:
+                raise UnQLiteError('Write buffer is closed.')
+            self.check_error()
+            if self.unqlite.in_transaction:
+                # Writes made in an explicit transaction are committed or
+                # rolled back with it, so are not buffered.
+                if op == WB_STORE:
+                    self.unqlite._store(key, value)
+                elif op == WB_APPEND:
+                    self.unqlite._append(key, value)
+                else:
+                    self.unqlite._delete(key)
+                return
+            prev = self.pending.get(key)
+            if op == WB_APPEND and prev is not None:
+                if prev[0] == WB_DELETE:
+                    op = WB_STORE
+                else:
+                    op = prev[0]
+                    value = prev[1] + value
+            self.pending[key] = (op, value)
+            self.nops += 1
+            self.unqlite.epoch += 1
+            if self.nops >= self.max_ops:
+                self.flush()
+            elif self.timer is None and self.max_delay_ms is not None:
+                self.timer = threading.Timer(self.max_delay_ms / 1000.,
+                                             self._timed_flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def store(self, key, value):
+        self._queue(encode(key), WB_STORE,
+                    codec_encode(self.unqlite.codec_id, value))
+
+    def append(self, key, value):
+        if self.unqlite.codec_id != CODEC_NONE:
+            raise ValueError('Values cannot be appended to when a codec is '
+                             'used.')
+        self._queue(encode(key), WB_APPEND, encode(value))
+
+    def delete(self, key):
+        """Queue a delete. Raises `KeyError` if the key does not exist."""
+        cdef bytes encoded_key = encode(key)
+        cdef tuple op
+        with self.lock:
+            op = self.pending.get(encoded_key)
+            if op is None and not self.unqlite._exists(encoded_key) or \
+                    op is not None and op[0] == WB_DELETE:
+                raise KeyError('key not found')
+            self._queue(encoded_key, WB_DELETE, None)
+
+    def fetch(self, key):
+        """Retrieve the value at the given key, including queued writes."""
+        return codec_decode(self.unqlite.codec_id, self._fetch(encode(key)))
+
+    cdef bytes _fetch(self, bytes encoded_key):
+        cdef tuple op
+        with self.lock:
+            op = self.pending.get(encoded_key)
+            if op is None:
+                return self.unqlite._fetch(encoded_key)
+            elif op[0] == WB_STORE:
+                return op[1]
+            elif op[0] == WB_DELETE:
+                raise KeyError('key not found')
+            try:
+                return self.unqlite._fetch(encoded_key) + op[1]
+            except KeyError:
+                return op[1]
+
+    def exists(self, key):
+        cdef bytes encoded_key = encode(key)
+        cdef tuple op
+        with self.lock:
+            op = self.pending.get(encoded_key)
+            if op is None:
+                return self.unqlite._exists(encoded_key)
+            return op[0] != WB_DELETE
+
+    def on_commit(self, fn):
+        """
+        Call `fn(exc)` once the writes queued so far have been committed,
+        with `exc` set to None, or to the exception if the flush failed.
+        """
+        with self.lock:
+            if self.pending:
+                self.callbacks.append(fn)
+                return
+        fn(None)
+
+    def flush(self):
+        """
+        Write the queued operations in a single transaction. Returns the
+        number of keys written. If a flush started by the timer failed, its
+        exception is raised, after the queued operations have been written.
+        """
+        cdef dict pending
+        cdef list callbacks
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if not self.pending:
+                self.check_error()
+                return 0
+            pending, self.pending = self.pending, {}
+            callbacks, self.callbacks = self.callbacks, []
+            self.nops = 0
+            try:
+                self._write(pending)
+            except BaseException as exc:
+                for fn in callbacks:
+                    fn(exc)
+                raise
+            for fn in callbacks:
+                fn(None)
+            self.check_error()
+            return len(pending)
+
+    cdef _write(self, dict pending):
+        cdef UnQLite db = self.unqlite
+        cdef bint transaction = not (db._is_private() or db.in_transaction)
+        if transaction:
+            db.check_call(db._transaction_call(MET_BEGIN))
+        try:
+            # Stores are written by a batch loop that releases the GIL.
+            db._store_batch([(key, op[1]) for key, op in pending.items()
+                             if op[0] == WB_STORE], True)
+            for key, op in pending.items():
+                if op[0] == WB_APPEND:
+                    db._append(key, op[1])
+                elif op[0] == WB_DELETE:
+                    try:
+                        db._delete(key)
+                    except KeyError:
+                        pass
+            if transaction:
+                db.check_call(db._transaction_call(MET_COMMIT))
+        except BaseException:
+            if transaction:
+                db._transaction_call(MET_ROLLBACK)
+                db.count_valid = False
+                if db.cache is not None:
+                    db.cache.clear()
+            raise
+
+    cdef _discard(self):
+        # Drop the queued writes, e.g. when the database is rolled back.
+        cdef list callbacks
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            self.pending = {}
+            self.nops = 0
+            callbacks, self.callbacks = self.callbacks, []
+        if callbacks:
+            exc = UnQLiteError('Queued writes were rolled back.')
+            for fn in callbacks:
+                fn(exc)
+
+    def _timed_flush(self):
+        cdef UnQLite db = self.unqlite
+        try:
+            with self.lock:
+                # Writes are not buffered while a transaction is open, and
+                # commit() flushes the buffer.
+                if self.timer is None or db.in_transaction:
+                    return
+                self.flush()
+        except Exception as exc:
+            with self.lock:
+                if not self.closed:
+                    self.error = exc
+
+    def close(self):
+        """Flush the queued writes and detach the buffer from the database."""
+        if self.closed:
+            return False
+        try:
+            self.flush()
+        finally:
+            with self.lock:
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+                self.closed = True
+                if self.unqlite.writer is self:
+                    self.unqlite.writer = None
+        return True
+
+
 cdef class Cursor(object):
     """Cursor interface for efficiently iterating through database."""
     cdef UnQLite unqlite
     cdef unqlite_kv_cursor *cursor
     cdef bint consumed
     cdef unsigned int generation
+    # Scratch space that keys and values are streamed into before being
+    # converted to Python objects. Re-used for the lifetime of the cursor,
+    # unless it grows past CURSOR_ARENA_RETAIN.
+    cdef kv_buffer arena
 
     def __cinit__(self, UnQLite unqlite):
         self.unqlite = unqlite
         self.cursor = <unqlite_kv_cursor *>0
+        kv_buffer_init(&self.arena, NULL, 0, True)
         self.unqlite.check_call(
             unqlite_kv_cursor_init(self.unqlite.database, &self.cursor))
         self.generation = unqlite.generation
 
     def __dealloc__(self):
+        PyMem_RawFree(self.arena.data)
         # unqlite_close() releases all of a database's outstanding cursors,
         # so only release here while the original handle is still alive.
         if self.cursor and self.unqlite is not None and \
@@ -819,40 +3189,62 @@ cdef class Cursor(object):
     cpdef reset(self):
         """Reset the cursor's position."""
         self.check_cursor()
+        self.unqlite._wait_idle()
         unqlite_kv_cursor_reset(self.cursor)
+        self.consumed = False
 
     cpdef seek(self, key, int flags=UNQLITE_CURSOR_MATCH_EXACT):
         """
         Seek to the given key. The flags specify how UnQLite will determine
         when to stop. Values are:
 
-        * UNQLITE_CURSOR_MATCH_EXACT (default).
-        * UNQLITE_CURSOR_MATCH_LE
-        * UNQLITE_CURSOR_MATCH_GE
+        * CURSOR_MATCH_EXACT (default).
+        * CURSOR_MATCH_LE
+        * CURSOR_MATCH_GE
+
+        The LE and GE flags position the cursor on the closest key when
+        there is no exact match. They require an ordered storage engine such
+        as "btree"; the hash-based engines only support exact matches.
         """
         cdef bytes encoded_key = encode(key)
+        cdef int nkey = len(encoded_key)
+        cdef const char *k = encoded_key
+        cdef unsigned long long start = 0
+        cdef int ret
 
         self.check_cursor()
-        self.unqlite.check_call(unqlite_kv_cursor_seek(
-            self.cursor,
-            <char *>encoded_key,
-            len(encoded_key),
-            flags))
+        if self.unqlite.metrics is not None:
+            start = unqlite_clock_ns()
+        self.unqlite._wait_idle()
+        ret = unqlite_kv_cursor_seek(self.cursor, k, nkey, flags)
+        if self.unqlite.metrics is not None:
+            self.unqlite.metrics.record(MET_CURSOR_SEEK, start, ret)
+        self.unqlite.check_call(ret)
+        self.consumed = False
 
     cpdef first(self):
         """Set cursor to the first record in the database."""
+        cdef int ret
         self.check_cursor()
-        self.unqlite.check_call(unqlite_kv_cursor_first_entry(self.cursor))
+        self.unqlite._wait_idle()
+        ret = unqlite_kv_cursor_first_entry(self.cursor)
+        self.unqlite.check_call(ret)
+        self.consumed = False
 
     cpdef last(self):
         """Set cursor to the last record in the database."""
+        cdef int ret
         self.check_cursor()
-        self.unqlite.check_call(unqlite_kv_cursor_last_entry(self.cursor))
+        self.unqlite._wait_idle()
+        ret = unqlite_kv_cursor_last_entry(self.cursor)
+        self.unqlite.check_call(ret)
+        self.consumed = False
 
     cpdef next_entry(self):
         """Move cursor to the next entry."""
         cdef int ret
         self.check_cursor()
+        self.unqlite._wait_idle()
         ret = unqlite_kv_cursor_next_entry(self.cursor)
         if ret != UNQLITE_OK:
             raise StopIteration
@@ -861,6 +3253,7 @@ cdef class Cursor(object):
         """Move cursor to the previous entry."""
         cdef int ret
         self.check_cursor()
+        self.unqlite._wait_idle()
         ret = unqlite_kv_cursor_prev_entry(self.cursor)
         if ret != UNQLITE_OK:
             raise StopIteration
@@ -871,6 +3264,7 @@ cdef class Cursor(object):
         pointing to a valid record.
         """
         self.check_cursor()
+        self.unqlite._wait_idle()
         if unqlite_kv_cursor_valid_entry(self.cursor):
             return True
         return False
@@ -879,109 +3273,436 @@ cdef class Cursor(object):
         self.consumed = False
         return self
 
+    cdef inline void _trim_arena(self) noexcept:
+        if self.arena.capacity > CURSOR_ARENA_RETAIN:
+            PyMem_RawFree(self.arena.data)
+            kv_buffer_init(&self.arena, NULL, 0, True)
+
     cpdef key(self):
         """Retrieve the key at the cursor's current location."""
-        cdef char *buf
-        cdef int buf_size
+        cdef int ret
 
         self.check_cursor()
-        self.unqlite.check_call(
-            unqlite_kv_cursor_key(self.cursor, <void *>0, &buf_size))
-
+        self.arena.size = 0
+        self.unqlite._wait_idle()
+        ret = unqlite_kv_cursor_key_callback(
+            self.cursor, kv_buffer_consumer, &self.arena)
         try:
-            buf = <char *>PyMem_Malloc(buf_size * sizeof(char))
-            if not buf:
+            if self.arena.nomem:
+                self.arena.nomem = False
                 raise MemoryError
-            unqlite_kv_cursor_key(
-                self.cursor,
-                <char *>buf,
-                &buf_size)
-
-            key = buf[:buf_size]
-            try:
-                return key.decode('utf-8')
-            except UnicodeDecodeError:
-                return key
+            self.unqlite.check_call(ret)
+            return decode_key(self.arena.data, self.arena.size)
         finally:
-            PyMem_Free(buf)
+            self._trim_arena()
 
     cpdef value(self):
         """Retrieve the value at the cursor's current location."""
-        cdef char *buf
-        cdef unqlite_int64 buf_size
+        cdef int ret
 
         self.check_cursor()
-        self.unqlite.check_call(
-            unqlite_kv_cursor_data(self.cursor, <void *>0, &buf_size))
-
+        self.arena.size = 0
+        self.unqlite._wait_idle()
+        ret = unqlite_kv_cursor_data_callback(
+            self.cursor, kv_buffer_consumer, &self.arena)
         try:
-            buf = <char *>PyMem_Malloc(buf_size * sizeof(char))
-            if not buf:
+            if self.arena.nomem:
+                self.arena.nomem = False
                 raise MemoryError
-            unqlite_kv_cursor_data(
-                self.cursor,
-                <char *>buf,
-                &buf_size)
+            self.unqlite.check_call(ret)
+            return codec_decode_buf(self.unqlite.codec_id, self.arena.data,
+                                    self.arena.size)
+        finally:
+            self._trim_arena()
 
-            value = buf[:buf_size]
-            return value
+    def value_view(self):
+        """
+        Retrieve the value at the cursor's current location as a read-only
+        `memoryview`. See :py:meth:`UnQLite.fetch_view`.
+        """
+        cdef kv_view view
+        cdef int ret
+
+        self.check_cursor()
+        if not self.unqlite._init_view(&view):
+            return memoryview(self.value())
+        try:
+            self.unqlite._wait_idle()
+            ret = unqlite_kv_cursor_data_callback(
+                self.cursor, kv_view_consumer, &view)
+            return self.unqlite._finish_view(&view, ret)
         finally:
-            PyMem_Free(buf)
+            PyMem_RawFree(view.buf.data)
 
     cpdef delete(self):
         """Delete the record at the cursor's current location."""
+        cdef int ret
         self.check_cursor()
-        self.unqlite.check_call(unqlite_kv_cursor_delete_entry(self.cursor))
+        if self.unqlite.cache is not None:
+            self.arena.size = 0
+            self.unqlite._wait_idle()
+            ret = unqlite_kv_cursor_key_callback(
+                self.cursor, kv_buffer_consumer, &self.arena)
+            if self.arena.nomem:
+                self.arena.nomem = False
+                raise MemoryError
+            self.unqlite.check_call(ret)
+            self.unqlite.cache.discard(self.arena.data[:self.arena.size])
+            self._trim_arena()
+        self.unqlite.epoch += 1
+        if self.unqlite.vm_collections:
+            self.unqlite.vm_epoch += 1
+        self.unqlite._wait_idle()
+        ret = unqlite_kv_cursor_delete_entry(self.cursor)
+        if ret == UNQLITE_OK and self.unqlite.count_valid:
+            self.unqlite.record_count -= 1
+        self.unqlite.check_call(ret)
 
     def __next__(self):
-        cdef int ret
+        cdef list batch
 
         if self.consumed:
             raise StopIteration
 
-        self.check_cursor()
-        if not unqlite_kv_cursor_valid_entry(self.cursor):
-            self.consumed = True
+        batch = self._fetch_batch(1, True, True)
+        if not batch:
             raise StopIteration
+        return batch[0]
 
-        key = self.key()
-        value = self.value()
-        ret = unqlite_kv_cursor_next_entry(self.cursor)
-        if ret != UNQLITE_OK:
-            self.consumed = True
+    cpdef list fetch_batch(self, int n=100, bint keys=True, bint values=True):
+        """
+        Read up to `n` records starting at the cursor's current location,
+        advancing the cursor past them. Returns a list of (key, value)
+        tuples, or of keys or values alone if only one of `keys` or `values`
+        is requested. An empty list indicates the cursor is exhausted.
+        """
+        if n < 1:
+            raise ValueError('n must be a positive integer.')
+        if not keys and not values:
+            raise ValueError('At least one of keys or values is required.')
+        if self.consumed:
+            return []
+        return self._fetch_batch(n, keys, values)
+
+    cdef list _fetch_batch(self, Py_ssize_t n, bint want_keys,
+                           bint want_values):
+        # Keys and values are streamed into the arena by a C loop, which keeps
+        # the GIL as UnQLite's mutex does not cover cursors. `offsets` records
+        # the end of each key and value in the arena. Value pages are never
+        # read when only keys are requested.
+        cdef Py_ssize_t *offsets
+        cdef Py_ssize_t i, count = 0, pos = 0
+        cdef int ret = UNQLITE_OK
+        cdef int codec
+        cdef list accum
+        cdef char *data
+        cdef unsigned long long start = 0
+
+        self.check_cursor()
+        offsets = <Py_ssize_t *>PyMem_Malloc(2 * n * sizeof(Py_ssize_t))
+        if not offsets:
+            raise MemoryError
+        if self.unqlite.metrics is not None:
+            start = unqlite_clock_ns()
 
-        return (key, value)
+        try:
+            self.arena.size = 0
+            self.unqlite._wait_idle()
+            while count < n:
+                if not unqlite_kv_cursor_valid_entry(self.cursor):
+                    self.consumed = True
+                    break
+                if want_keys:
+                    ret = unqlite_kv_cursor_key_callback(
+                        self.cursor, kv_buffer_consumer, &self.arena)
+                    if ret != UNQLITE_OK:
+                        break
+                offsets[2 * count] = self.arena.size
+                if want_values:
+                    ret = unqlite_kv_cursor_data_callback(
+                        self.cursor, kv_buffer_consumer, &self.arena)
+                    if ret != UNQLITE_OK:
+                        break
+                offsets[2 * count + 1] = self.arena.size
+                count += 1
+                if unqlite_kv_cursor_next_entry(self.cursor) != UNQLITE_OK:
+                    self.consumed = True
+                    break
+
+            if self.arena.nomem:
+                self.arena.nomem = False
+                raise MemoryError
+            if self.unqlite.metrics is not None:
+                self.unqlite.metrics.record(MET_CURSOR_READ, start, ret,
+                                            self.arena.size)
+            self.unqlite.check_call(ret)
+
+            accum = [None] * count
+            data = self.arena.data
+            codec = self.unqlite.codec_id
+            for i in range(count):
+                if want_keys and want_values:
+                    accum[i] = (
+                        decode_key(data + pos, offsets[2 * i] - pos),
+                        codec_decode_buf(
+                            codec, data + offsets[2 * i],
+                            offsets[2 * i + 1] - offsets[2 * i]))
+                elif want_keys:
+                    accum[i] = decode_key(data + pos, offsets[2 * i] - pos)
+                else:
+                    accum[i] = codec_decode_buf(
+                        codec, data + offsets[2 * i],
+                        offsets[2 * i + 1] - offsets[2 * i])
+                pos = offsets[2 * i + 1]
+            return accum
+        finally:
+            PyMem_Free(offsets)
+            self._trim_arena()
 
     def fetch_until(self, stop_key, bint include_stop_key=True):
+        cdef bytes encoded_stop_key
+        cdef bint ordered = self.unqlite.ordered
+        cdef bint length_first = self.unqlite.comparator == 'length'
+        cdef int rc
+
+        if ordered:
+            # Keys are visited in sorted order, so stop as soon as one sorts
+            # after the stop key, even if the stop key itself is missing.
+            encoded_stop_key = encode(stop_key)
         for key, value in self:
-            if key == stop_key:
+            if ordered:
+                rc = compare_keys(encode(key), encoded_stop_key, length_first)
+                if rc >= 0:
+                    if include_stop_key and rc == 0:
+                        yield (key, value)
+                    return
+            elif key == stop_key:
                 if include_stop_key:
                     yield (key, value)
                 return
-            else:
-                yield (key, value)
+            yield (key, value)
 
 
 # Foreign function callback signature.
 ctypedef int (*unqlite_filter_fn)(unqlite_context *, int, unqlite_value **) noexcept
 
 
-cdef class VM(object):
+cdef class ValueFactory(object):
+    """
+    Base class for objects that allocate Jx9 values (VMs and the contexts
+    passed to foreign functions), sharing a single conversion routine.
+    """
+    cdef unqlite_value* create_array(self):
+        return NULL
+
+    cdef unqlite_value* create_scalar(self):
+        return NULL
+
+    cdef release_value(self, unqlite_value *ptr):
+        pass
+
+    cdef unqlite_value* create_value(self, value) except NULL:
+        """
+        Create an `unqlite_value` corresponding to the given Python value.
+        """
+        cdef unqlite_value *ptr
+        if is_container(value):
+            ptr = self.create_array()
+        else:
+            ptr = self.create_scalar()
+        try:
+            python_to_unqlite_value(self, ptr, value)
+        except:
+            self.release_value(ptr)
+            raise
+        return ptr
+
+
+# Time spent by a VM in each phase of a run, recorded while a VMProfiler is
+# attached to its database. A run ends when the VM is reset, re-compiled,
+# closed or handed back to the VM cache.
+cdef struct vm_run:
+    unsigned long long compile_ns
+    unsigned long long bind_ns
+    unsigned long long execute_ns
+    unsigned long long extract_ns
+    unsigned long long callback_ns
+    unsigned long long callbacks
+    unsigned long long output_bytes
+    bint compiled
+    bint active
+
+
+cdef class ScriptProfile(object):
+    """Totals of the runs of one Jx9 script."""
+    cdef readonly object script
+    cdef unsigned long long runs
+    cdef unsigned long long compiles
+    cdef unsigned long long slow
+    cdef unsigned long long max_ns
+    cdef vm_run totals
+
+    def __init__(self, script):
+        self.script = script
+        self.runs = self.compiles = self.slow = self.max_ns = 0
+        memset(&self.totals, 0, sizeof(vm_run))
+
+    def stats(self):
+        cdef vm_run *t = &self.totals
+        return {
+            'hash': hashlib.sha1(encode(self.script)).hexdigest()[:12],
+            'script': self.script,
+            'runs': self.runs,
+            'compiles': self.compiles,
+            'slow': self.slow,
+            'total_ns': vm_run_total(t),
+            'max_ns': self.max_ns,
+            'compile_ns': t.compile_ns,
+            'bind_ns': t.bind_ns,
+            'execute_ns': t.execute_ns,
+            'extract_ns': t.extract_ns,
+            'callback_ns': t.callback_ns,
+            'callbacks': t.callbacks,
+            'output_bytes': t.output_bytes,
+        }
+
+
+cdef inline unsigned long long vm_run_total(vm_run *run):
+    # Callbacks run during execution, so are included in execute_ns.
+    return run.compile_ns + run.bind_ns + run.execute_ns + run.extract_ns
+
+
+cdef class VMProfiler(object):
+    """
+    Records how long the Jx9 VMs of a database spend compiling, binding
+    variables, executing (including Python callbacks) and extracting
+    results, aggregated by script. Runs that take at least `slow_ms` are
+    passed to `on_slow`, or logged as warnings by the "unqlite" logger.
+    """
+    cdef UnQLite unqlite
+    cdef readonly object slow_ms
+    cdef object on_slow
+    cdef unsigned long long slow_ns
+    # ScriptProfile for each script, keyed by the encoded script text.
+    cdef dict scripts
+
+    def __init__(self, UnQLite unqlite, slow_ms=None, on_slow=None):
+        self.unqlite = unqlite
+        self.slow_ms = slow_ms
+        self.slow_ns = 0 if slow_ms is None else <unsigned long long>(
+            slow_ms * 1000000)
+        self.on_slow = on_slow
+        self.scripts = {}
+        unqlite.profiler = self
+
+    cdef finish(self, VM vm):
+        cdef vm_run *run = &vm.timings
+        cdef vm_run *t
+        cdef ScriptProfile profile
+        cdef unsigned long long total = vm_run_total(run)
+
+        profile = self.scripts.get(vm.encoded_code)
+        if profile is None:
+            profile = self.scripts[vm.encoded_code] = ScriptProfile(vm.code)
+        t = &profile.totals
+        profile.runs += 1
+        profile.compiles += run.compiled
+        t.compile_ns += run.compile_ns
+        t.bind_ns += run.bind_ns
+        t.execute_ns += run.execute_ns
+        t.extract_ns += run.extract_ns
+        t.callback_ns += run.callback_ns
+        t.callbacks += run.callbacks
+        t.output_bytes += run.output_bytes
+        if total > profile.max_ns:
+            profile.max_ns = total
+        if self.slow_ms is not None and total >= self.slow_ns:
+            profile.slow += 1
+            data = profile.stats()
+            for key in ('runs', 'compiles', 'slow', 'max_ns'):
+                del data[key]
+            data.update(
+                total_ns=total,
+                compile_ns=run.compile_ns,
+                bind_ns=run.bind_ns,
+                execute_ns=run.execute_ns,
+                extract_ns=run.extract_ns,
+                callback_ns=run.callback_ns,
+                callbacks=run.callbacks,
+                output_bytes=run.output_bytes)
+            if self.on_slow is not None:
+                self.on_slow(data)
+            else:
+                logger.warning('Slow Jx9 script %s (%.2fms): %r',
+                               data['hash'], total / 1e6, vm.code)
+
+    def stats(self):
+        """
+        Return a dict of timings for each script, ordered by total time
+        spent, slowest first.
+        """
+        cdef ScriptProfile profile
+        accum = [profile.stats() for profile in self.scripts.values()]
+        accum.sort(key=lambda data: data['total_ns'], reverse=True)
+        return accum
+
+    def reset(self):
+        self.scripts = {}
+
+    def close(self):
+        """Stop profiling. Collected stats remain available."""
+        if self.unqlite.profiler is self:
+            self.unqlite.profiler = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+cdef class VMVariable(object):
+    """
+    A variable bound with UNQLITE_VM_CONFIG_CREATE_VAR. Jx9 does not make a
+    private copy of the name, so it is kept alive here, along with a scalar
+    that is re-used whenever a scalar value is bound.
+    """
+    cdef bytes name
+    cdef unqlite_value *scalar
+
+
+cdef class VM(ValueFactory):
     """Jx9 virtual-machine interface."""
     cdef UnQLite unqlite
     cdef unqlite_vm *vm
     cdef readonly bint need_reset
     cdef readonly code
     cdef readonly bytes encoded_code
-    cdef set encoded_names
+    # Variables bound since the script was compiled, keyed by name.
+    cdef dict variables
     cdef unsigned int generation
+    # Set when the owner accounts for any writes made by the script (see
+    # UnQLite._checkin_vm), so executing it does not invalidate cached VMs.
+    cdef bint managed
+    cdef unsigned long long epoch
+    cdef unsigned int uses
+    # Timings of the current run, while the database has a VMProfiler.
+    cdef vm_run timings
+    # Streaming output (see set_output()). Once the output consumer has been
+    # installed, output is buffered in `output_chunks` while no sink is set.
+    cdef bint output_installed
+    cdef object output_sink
+    cdef object output_decoder
+    cdef object output_error
+    cdef list output_chunks
 
     def __cinit__(self, UnQLite unqlite, code):
         self.unqlite = unqlite
         self.vm = <unqlite_vm *>0
         self.code = code
         self.encoded_code = encode(code)
-        self.encoded_names = set()
+        self.variables = {}
+        memset(&self.timings, 0, sizeof(vm_run))
 
     def __dealloc__(self):
         # unqlite_close() releases all of a database's outstanding VMs, so
@@ -1001,18 +3722,32 @@ cdef class VM(object):
     cpdef compile(self):
         """Compile the Jx9 script."""
         cdef int rc
+        cdef unsigned long long start = 0
         if self.vm:
             self.close()
-        self.encoded_names.clear()
+        self.variables.clear()
+        self.need_reset = False
+        self.output_chunks = None
         cdef const char *code = <const char *>self.encoded_code
+        if self.unqlite.metrics is not None or \
+                self.unqlite.profiler is not None:
+            start = unqlite_clock_ns()
         rc = unqlite_compile(
             self.unqlite.database,
             code,
             len(self.encoded_code),
             &self.vm)
+        if self.unqlite.metrics is not None:
+            self.unqlite.metrics.record(MET_COMPILE, start, rc)
+        if self.unqlite.profiler is not None:
+            self.timings.compile_ns += unqlite_clock_ns() - start
+            self.timings.compiled = self.timings.active = True
         if rc != UNQLITE_OK:
+            self._finish_run()
             raise self._compile_error(rc)
         self.generation = self.unqlite.generation
+        if self.output_sink is not None:
+            self._install_output()
 
     cdef _compile_error(self, int rc):
         cdef char *zBuf = NULL
@@ -1027,20 +3762,144 @@ cdef class VM(object):
 
     cpdef execute(self):
         """Execute the compiled Jx9 script."""
+        cdef unsigned long long start
+        cdef int rc
         self.check_vm()
+        self.unqlite._flush_writes()
+
+        if not self.managed:
+            self.unqlite.epoch += 1
+            self.unqlite.vm_epoch += 1
+            self.unqlite.count_valid = False
+            if self.unqlite.cache is not None:
+                self.unqlite.cache.clear()
 
         # Cannot release GIL here as the Jx9 script may invoke python-side code
         # like user-defined functions or filters.
-        self.unqlite.check_call(unqlite_vm_exec(self.vm))
+        self.need_reset = True
+        self.unqlite._wait_idle()
+        if self.unqlite.metrics is None and self.unqlite.profiler is None:
+            rc = unqlite_vm_exec(self.vm)
+        else:
+            start = unqlite_clock_ns()
+            rc = unqlite_vm_exec(self.vm)
+            if self.unqlite.metrics is not None:
+                self.unqlite.metrics.record(MET_EXECUTE, start, rc)
+            if self.unqlite.profiler is not None:
+                self.timings.execute_ns += unqlite_clock_ns() - start
+                self.timings.active = True
+        if self.output_installed:
+            self._finish_output()
+        self.unqlite.check_call(rc)
+
+    def set_output(self, target, encoding=None):
+        """
+        Stream the output of the Jx9 script to `target` as it is generated,
+        instead of buffering all of it for `output()`. The target may be a
+        callable, which is called with each chunk, a file-like object, or a
+        generator, which is sent each chunk. Chunks are bytes, unless an
+        `encoding` is given or the target is a text file. Pass None to
+        buffer the output again.
+        """
+        if target is None:
+            sink = None
+        elif isinstance(target, GeneratorType):
+            if inspect.getgeneratorstate(target) == inspect.GEN_CREATED:
+                next(target)
+            sink = target.send
+        elif hasattr(target, 'write'):
+            if encoding is None and isinstance(target, io.TextIOBase):
+                encoding = 'utf-8'
+            sink = target.write
+        elif callable(target):
+            sink = target
+        else:
+            raise TypeError('Output target must be a callable, a file-like '
+                            'object or a generator.')
+
+        self.output_sink = sink
+        self.output_decoder = None
+        if sink is not None and encoding is not None:
+            self.output_decoder = codecs.getincrementaldecoder(encoding)(
+                'replace')
+        if self.vm:
+            self._install_output()
+
+    cdef _install_output(self):
+        self.check_vm()
+        if self.output_sink is None and self.output_chunks is None:
+            if not self.output_installed:
+                return
+            # The built-in consumer cannot be restored once replaced, so the
+            # output is buffered here instead.
+            self.output_chunks = []
+        if not self.output_installed:
+            self.unqlite.check_call(unqlite_vm_config(
+                self.vm,
+                UNQLITE_VM_CONFIG_OUTPUT,
+                vm_output_consumer,
+                <void *>self))
+            self.output_installed = True
+
+    cdef _finish_output(self):
+        if self.output_decoder is not None:
+            tail = self.output_decoder.decode(b'', True)
+            if tail and self.output_error is None:
+                self.output_sink(tail)
+        if self.output_error is not None:
+            exc, self.output_error = self.output_error, None
+            raise exc
+
+    cdef _finish_run(self):
+        if self.timings.active:
+            if self.unqlite.profiler is not None:
+                self.unqlite.profiler.finish(self)
+            memset(&self.timings, 0, sizeof(vm_run))
 
     cpdef reset(self):
         self.check_vm()
+        self._finish_run()
+        if self.output_chunks:
+            self.output_chunks = []
         self.unqlite.check_call(unqlite_vm_reset(self.vm))
+        self.need_reset = False
         return True
 
+    def run(self, result='ret', **params):
+        """
+        Bind the given variables, execute the script and return the value of
+        the `result` variable (or None if `result` is None). The script is
+        compiled on first use and the VM is reset between runs, so a VM can
+        be run repeatedly with different parameters.
+        """
+        return self._run(result, params)
+
+    cdef _run(self, result, dict params):
+        cdef unsigned long long start
+
+        if not self.vm:
+            self.compile()
+        elif self.need_reset:
+            self.reset()
+        if params:
+            self._bind(params)
+        self.execute()
+        if result is None:
+            return
+        if self.unqlite.profiler is None:
+            return self._get_value(result, None, False)
+        start = unqlite_clock_ns()
+        try:
+            return self._get_value(result, None, False)
+        finally:
+            self.timings.extract_ns += unqlite_clock_ns() - start
+            self.timings.active = True
+
     cpdef close(self):
         """Close and release the virtual machine."""
-        self.encoded_names.clear()
+        self._finish_run()
+        self.variables.clear()
+        self.output_installed = False
         if self.vm:
             if self.unqlite.is_open and \
                     self.unqlite.generation == self.generation:
@@ -1054,18 +3913,6 @@ cdef class VM(object):
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.close()
 
-    cdef unqlite_value* create_value(self, value):
-        """
-        Create an `unqlite_value` corresponding to the given Python value.
-        """
-        cdef unqlite_value *ptr
-        if isinstance(value, (list, tuple, dict)):
-            ptr = self.create_array()
-        else:
-            ptr = self.create_scalar()
-        python_to_unqlite_value(self, ptr, value)
-        return ptr
-
     cdef release_value(self, unqlite_value *ptr):
         """Release the given `unqlite_value`."""
         self.unqlite.check_call(unqlite_vm_release_value(self.vm, ptr))
@@ -1078,30 +3925,84 @@ cdef class VM(object):
 
     def set_value(self, name, value):
         """Set the value of a variable in the Jx9 script."""
+        cdef unsigned long long start
+        if self.unqlite.profiler is None:
+            self._set_value(name, value)
+            return
+        start = unqlite_clock_ns()
+        try:
+            self._set_value(name, value)
+        finally:
+            self.timings.bind_ns += unqlite_clock_ns() - start
+            self.timings.active = True
+
+    cdef _bind(self, dict params):
+        cdef unsigned long long start
+        if self.unqlite.profiler is None:
+            for name, value in params.items():
+                self._set_value(name, value)
+            return
+        start = unqlite_clock_ns()
+        try:
+            for name, value in params.items():
+                self._set_value(name, value)
+        finally:
+            self.timings.bind_ns += unqlite_clock_ns() - start
+            self.timings.active = True
+
+    cdef _set_value(self, name, value):
         cdef unqlite_value *ptr
-        cdef bytes encoded_name = encode(name)
+        cdef VMVariable var
 
         self.check_vm()
 
-        # since Jx9 does not make a private copy of the name,
-        # we need to keep it alive by adding it to a set
-        self.encoded_names.add(encoded_name)
+        var = self.variables.get(name)
+        if var is None:
+            var = VMVariable()
+            var.name = encode(name)
+            self.variables[name] = var
 
-        ptr = self.create_value(value)
+        # Jx9 makes a private copy of the value, so arrays are released once
+        # bound, while the variable's scalar is re-used for the next value.
+        if is_container(value):
+            ptr = self.create_value(value)
+            try:
+                self._create_var(var, ptr)
+            finally:
+                self.release_value(ptr)
+        else:
+            if not var.scalar:
+                var.scalar = self.create_scalar()
+                if not var.scalar:
+                    raise MemoryError('Unable to allocate Jx9 value.')
+            set_scalar(var.scalar, value)
+            self._create_var(var, var.scalar)
+
+    cdef _create_var(self, VMVariable var, unqlite_value *ptr):
         self.unqlite.check_call(unqlite_vm_config(
             self.vm,
             UNQLITE_VM_CONFIG_CREATE_VAR,
-            <const char *>encoded_name,
+            <const char *>var.name,
             ptr))
-        # since Jx9 makes a private copy of the value,
-        # we do not need to keep the value alive
-        self.release_value(ptr)
 
-    def get_value(self, name):
+    def get_value(self, name, fields=None, raw=False):
         """
         Retrieve the value of a variable after the execution of the
-        Jx9 script.
+        Jx9 script. If `fields` is given, only those keys (and "__id") are
+        converted from a JSON object, or from each object in a JSON array.
+        If `raw` is true, the value is returned as UTF-8 encoded JSON.
         """
+        cdef unsigned long long start
+        if self.unqlite.profiler is None:
+            return self._get_value(name, fields, raw)
+        start = unqlite_clock_ns()
+        try:
+            return self._get_value(name, fields, raw)
+        finally:
+            self.timings.extract_ns += unqlite_clock_ns() - start
+            self.timings.active = True
+
+    cdef _get_value(self, name, fields, bint raw):
         cdef unqlite_value *ptr
         cdef bytes encoded_name = encode(name)
 
@@ -1112,6 +4013,11 @@ cdef class VM(object):
             raise KeyError(name)
         # The extracted value is owned by the VM (not a copy) and is freed
         # when the VM is released.
+        if raw:
+            return unqlite_value_to_json(
+                ptr, projection(fields) if fields is not None else None)
+        elif fields is not None:
+            return project_value(ptr, projection(fields))
         return unqlite_value_to_python(ptr)
 
     def __getitem__(self, name):
@@ -1121,8 +4027,7 @@ cdef class VM(object):
         self.set_value(name, value)
 
     cpdef set_values(self, dict data):
-        for key, value in data.items():
-            self.set_value(key, value)
+        self._bind(data)
 
     def output(self):
         """
@@ -1134,6 +4039,14 @@ cdef class VM(object):
         cdef bytes result
 
         self.check_vm()
+        if self.output_installed:
+            # Streamed output has already been accounted for by the consumer.
+            result = b''.join(self.output_chunks or ())
+            try:
+                return result.decode('utf-8')
+            except UnicodeDecodeError:
+                return result
+
         self.unqlite.check_call(unqlite_vm_config(
             self.vm,
             UNQLITE_VM_CONFIG_EXTRACT_OUTPUT,
@@ -1141,13 +4054,46 @@ cdef class VM(object):
             &nlen))
 
         result = (<const char *>buf)[:nlen]
+        if self.unqlite.profiler is not None:
+            self.timings.output_bytes += nlen
+            self.timings.active = True
         try:
             return result.decode('utf-8')
         except UnicodeDecodeError:
             return result
 
 
-cdef class Context(object):
+cdef int vm_output_consumer(const void *data, unsigned int nbytes,
+                            void *user_data) noexcept:
+    # Installed with UNQLITE_VM_CONFIG_OUTPUT. Errors raised by the sink are
+    # stored on the VM and re-raised once the script has been aborted.
+    cdef VM vm = <VM>user_data
+    chunk = (<const char *>data)[:nbytes]
+
+    if vm.unqlite.profiler is not None:
+        vm.timings.output_bytes += nbytes
+        vm.timings.active = True
+    if vm.output_sink is None:
+        if vm.output_chunks is not None:
+            vm.output_chunks.append(chunk)
+        return UNQLITE_OK
+
+    try:
+        if vm.output_decoder is not None:
+            chunk = vm.output_decoder.decode(chunk)
+            if not chunk:
+                return UNQLITE_OK
+        vm.output_sink(chunk)
+    except StopIteration:
+        # The generator has finished, so stop the script.
+        return UNQLITE_ABORT
+    except BaseException as exc:
+        vm.output_error = exc
+        return UNQLITE_ABORT
+    return UNQLITE_OK
+
+
+cdef class Context(ValueFactory):
     cdef unqlite_context *context
 
     def __cinit__(self):
@@ -1156,19 +4102,8 @@ cdef class Context(object):
     cdef set_context(self, unqlite_context *context):
         self.context = context
 
-    cdef unqlite_value * create_value(self, value):
-        cdef unqlite_value *ptr
-
-        if isinstance(value, (list, tuple, dict)):
-            ptr = self.create_array()
-        else:
-            ptr = self.create_scalar()
-
-        self.python_to_unqlite_value(ptr, value)
-        return ptr
-
-    cdef release_value(self, unqlite_value *ptr):
-        unqlite_context_release_value(self.context, ptr)
+    cdef release_value(self, unqlite_value *ptr):
+        unqlite_context_release_value(self.context, ptr)
 
     cdef unqlite_value* create_array(self):
         return unqlite_context_new_array(self.context)
@@ -1182,45 +4117,21 @@ cdef class Context(object):
         unqlite_result_value(self.context, ptr)
         self.release_value(ptr)
 
-    cdef python_to_unqlite_value(self, unqlite_value *ptr, python_value):
-        cdef unqlite_value *item_ptr = <unqlite_value *>0
-        cdef bytes encoded_value
-
-        if isinstance(python_value, unicode):
-            encoded_value = encode(python_value)
-            unqlite_value_string(ptr, encoded_value, len(encoded_value))
-        elif isinstance(python_value, bytes):
-            unqlite_value_string(ptr, python_value, len(python_value))
-        elif isinstance(python_value, (list, tuple)):
-            for item in python_value:
-                item_ptr = self.create_value(item)
-                unqlite_array_add_elem(ptr, NULL, item_ptr)
-                self.release_value(item_ptr)
-        elif isinstance(python_value, dict):
-            for key, value in python_value.items():
-                encoded_value = encode(key)
-                item_ptr = self.create_value(value)
-                unqlite_array_add_strkey_elem(
-                    ptr,
-                    <const char *>encoded_value,
-                    item_ptr)
-                self.release_value(item_ptr)
-        elif isinstance(python_value, bool):
-            unqlite_value_bool(ptr, python_value)
-        elif isinstance(python_value, int):
-            unqlite_value_int64(ptr, python_value)
-        elif isinstance(python_value, float):
-            unqlite_value_double(ptr, python_value)
-        else:
-            unqlite_value_null(ptr)
-
 
 cdef int py_filter_wrapper(unqlite_context *context, int nargs, unqlite_value **values) noexcept:
+    # The user data is a (VM, callback) tuple, so time spent in the callback
+    # can be attributed to the VM when profiling.
     cdef int i
     cdef list converted = []
-    cdef object callback = <object>unqlite_context_user_data(context)
+    cdef tuple binding = <tuple>unqlite_context_user_data(context)
+    cdef VM vm = binding[0]
+    cdef object callback = binding[1]
     cdef Context context_wrapper = Context()
+    cdef unsigned long long start = 0
+    cdef bint profiling = vm.unqlite.profiler is not None
 
+    if profiling:
+        start = unqlite_clock_ns()
     context_wrapper.set_context(context)
 
     for i in range(nargs):
@@ -1234,9 +4145,185 @@ cdef int py_filter_wrapper(unqlite_context *context, int nargs, unqlite_value **
         return UNQLITE_ABORT
     else:
         context_wrapper.push_result(ret)
+    finally:
+        if profiling:
+            vm.timings.callback_ns += unqlite_clock_ns() - start
+            vm.timings.callbacks += 1
     return UNQLITE_OK
 
 
+# Lookup operators supported by Collection.where(), e.g. age__gte=21. Values
+# are bound as VM variables, so scripts only depend on the shape of a query.
+cdef dict WHERE_OPERATORS = {
+    'eq': '==',
+    'ne': '!=',
+    'lt': '<',
+    'lte': '<=',
+    'gt': '>',
+    'gte': '>=',
+    'in': None,
+    'isnull': None,
+}
+cdef dict where_scripts = {}
+
+
+cdef tuple compile_where(dict lookups):
+    """
+    Compile keyword lookups into a Jx9 script that filters the collection
+    natively. Returns the script and the variables to bind.
+    """
+    cdef dict params = {}
+    cdef list exprs = []
+    cdef list shape = []
+    cdef int i
+
+    for i, (key, value) in enumerate(sorted(lookups.items())):
+        field, _, op = key.rpartition('__')
+        if not field or op not in WHERE_OPERATORS:
+            field, op = key, 'eq'
+        params['f%d' % i] = field
+        if op == 'isnull':
+            kind = bool(value)
+        elif op == 'in':
+            kind = None
+            params['v%d' % i] = list(value)
+        else:
+            # Jx9 comparisons are loose, so guard on type to match Python.
+            if isinstance(value, bool) or value is None:
+                kind = 'o'
+            elif isinstance(value, (int, float)):
+                kind = 'n'
+            elif isinstance(value, basestring):
+                kind = 's'
+            else:
+                kind = 'o'
+            params['v%d' % i] = value
+        shape.append((op, kind))
+
+    key = tuple(shape)
+    script = where_scripts.get(key)
+    if script is None:
+        for i, (op, kind) in enumerate(shape):
+            lhs = '$rec[$f%d]' % i
+            rhs = '$v%d' % i
+            if op == 'isnull':
+                expr = ('is_null(%s)' if kind else '!is_null(%s)') % lhs
+            elif op == 'in':
+                expr = 'in_array(%s, %s, TRUE)' % (lhs, rhs)
+            else:
+                operator = WHERE_OPERATORS[op]
+                if kind == 'n':
+                    guard = '(is_int(%s) || is_float(%s))' % (lhs, lhs)
+                elif kind == 's':
+                    guard = 'is_string(%s)' % lhs
+                else:
+                    guard = None
+                    if operator in ('==', '!='):
+                        operator += '='  # Strict comparison.
+                if guard is None:
+                    expr = '%s %s %s' % (lhs, operator, rhs)
+                elif operator == '!=':
+                    expr = '!(%s && %s == %s)' % (guard, lhs, rhs)
+                else:
+                    expr = '(%s && %s %s %s)' % (guard, lhs, operator, rhs)
+            exprs.append(expr)
+
+        script = ('$ret = db_fetch_all($collection, function($rec) { '
+                  'return %s; });' % (' && '.join(exprs) or 'TRUE'))
+        if len(where_scripts) >= 256:
+            where_scripts.clear()
+        where_scripts[key] = script
+    return script, params
+
+
+# Range operators supported by Collection.find().
+cdef dict INDEX_RANGE_OPERATORS = {
+    'lt': operator.lt,
+    'lte': operator.le,
+    'gt': operator.gt,
+    'gte': operator.ge,
+}
+
+
+cdef bytes index_token(value):
+    """
+    Encode a field value for use in a secondary index key, or return None if
+    the value cannot be indexed. Numbers and strings are encoded so that
+    tokens of the same type sort in the order of their values, and tokens
+    never contain NUL bytes. Integral floats share a token with the
+    corresponding int, mirroring Python equality.
+    """
+    if value is None:
+        return b'N'
+    elif value is True:
+        return b'T'
+    elif value is False:
+        return b'F'
+    elif isinstance(value, (int, float)):
+        return b'n' + index_number(value)
+    elif isinstance(value, basestring):
+        # \x01 escapes NUL bytes, preserving the order of the strings.
+        return b's' + encode(value).replace(b'\x01', b'\x01\x02').replace(
+            b'\x00', b'\x01\x01')
+    return None
+
+
+cdef bytes index_number(value):
+    # The bits of a double compare in numeric order once the sign bit of
+    # positive numbers, or every bit of negative numbers, is flipped. They
+    # are written in hex to keep NUL bytes out of the key. Ints a double
+    # cannot represent exactly are followed by their decimal value.
+    cdef double d
+    cdef unsigned long long bits
+    cdef bytes token
+    try:
+        d = value
+    except OverflowError:
+        d = float('inf') if value > 0 else float('-inf')
+    if d == 0:
+        d = 0.
+    memcpy(&bits, &d, sizeof(bits))
+    if bits >> 63:
+        bits = ~bits
+    else:
+        bits |= 1ULL << 63
+    token = b'%016x' % bits
+    if isinstance(value, int) and d != value:
+        token += b'%d' % value
+    return token
+
+
+cdef index_value(bytes token):
+    # Decodes a number or string token created by index_token().
+    cdef unsigned long long bits
+    cdef double d
+    if token[:1] == b's':
+        return decode(token[1:].replace(b'\x01\x01', b'\x00').replace(
+            b'\x01\x02', b'\x01'))
+    elif token[:1] != b'n':
+        return None
+    elif len(token) > 17:
+        return int(token[17:])
+    bits = int(token[1:17], 16)
+    if bits >> 63:
+        bits &= ~(1ULL << 63)
+    else:
+        bits = ~bits
+    memcpy(&d, &bits, sizeof(d))
+    return d
+
+
+cdef bint index_value_matches(candidate, op, value):
+    # Ranges only compare numbers with numbers and strings with strings.
+    if isinstance(value, basestring):
+        if not isinstance(candidate, basestring):
+            return False
+    elif isinstance(candidate, bool) or \
+            not isinstance(candidate, (int, float)):
+        return False
+    return INDEX_RANGE_OPERATORS[op](candidate, value)
+
+
 cdef class Collection(object):
     """
     Manage collections of UnQLite JSON documents.
@@ -1256,45 +4343,330 @@ cdef class Collection(object):
             vm.execute()
 
     def _simple_execute(self, basestring script, **kwargs):
-        cdef VM vm
-        with VM(self.unqlite, script) as vm:
+        return self._run(script, kwargs, True)
+
+    def _simple_read(self, basestring script, **kwargs):
+        return self._run(script, kwargs, False)
+
+    cdef _run(self, script, dict params, bint wrote, fields=None,
+              bint raw=False, bint reuse=True):
+        # Every script must assign $ret unconditionally: VMs may be re-used,
+        # and Jx9 globals survive a VM reset. Scripts that depend on the
+        # record cursor of a collection, which a VM keeps between runs, are
+        # not re-used so that each call starts from the first record.
+        cdef VM vm = self.unqlite._checkout_vm(script)
+        try:
             vm['collection'] = self.name
-            vm.set_values(kwargs)
+            vm._bind(params)
             vm.execute()
             try:
-                return vm['ret']
+                ret = vm.get_value('ret', fields, raw)
             except KeyError:
                 raise ValueError('Error fetching return value from script.')
+        except BaseException:
+            self.unqlite._checkin_vm(script, vm, True, False)
+            raise
+        if reuse and self.unqlite.vm_cache_size > 0:
+            self.unqlite.vm_collections.add(encode(self.name))
+        self.unqlite._checkin_vm(script, vm, wrote, reuse)
+        return ret
 
-    def all(self):
-        """Retrieve all records in the given collection."""
-        return self._simple_execute('$ret = db_fetch_all($collection);')
+    def all(self, fields=None, raw=False):
+        """
+        Retrieve all records in the given collection, optionally converting
+        only the given fields, or returning them as JSON if `raw` is true.
+        """
+        return self._run('$ret = db_fetch_all($collection);', {}, False,
+                         fields, raw)
 
-    cpdef filter(self, filter_fn):
+    cpdef filter(self, filter_fn, fields=None, raw=False):
         """
         Filter the records in the collection using the provided Python
-        callback.
+        callback, optionally converting only the given fields of the
+        matching records, or returning them as JSON if `raw` is true.
         """
         cdef unqlite_filter_fn filter_callback = py_filter_wrapper
         cdef VM vm
-        cdef void *cb_pointer = <void *>filter_fn
+        cdef tuple binding
 
         script = '$ret = db_fetch_all($collection, _filter_fn)'
         with VM(self.unqlite, script) as vm:
+            binding = (vm, filter_fn)
             unqlite_create_function(
                 vm.vm,
                 '_filter_fn',
                 filter_callback,
-                cb_pointer)
+                <void *>binding)
             vm['collection'] = self.name
             vm.execute()
-            ret = vm['ret']
+            ret = vm.get_value('ret', fields, raw)
             unqlite_delete_function(
                 vm.vm,
                 '_filter_fn')
 
         return ret
 
+    def where(self, **lookups):
+        """
+        Return the records matching the given field lookups, which are
+        evaluated by Jx9 so non-matching records are never converted.
+        Lookups take the form field=value or field__op=value, where op is one
+        of eq, ne, lt, lte, gt, gte, in or isnull. All lookups must match.
+        """
+        script, params = compile_where(lookups)
+        return self._run(script, params, False)
+
+    # Secondary indexes live in the key/value store next to the collection,
+    # under keys that cannot clash with the "<name>_<id>" keys used by Jx9:
+    #
+    # <name>\0idx                          JSON list of indexed fields.
+    # <name>\0idx\0<field>\0<token>\0<id>  Empty, one per indexed record.
+    #
+    # Tokens are created by index_token(). Lookups seek to the keys beginning
+    # with "<name>\0idx\0<field>\0<token>\0". The layout above is only used
+    # with the ordered "btree" engine, as other engines cannot seek. They
+    # keep the IDs of each token's records in one value instead, and the
+    # tokens of each field in a directory, so lookups fetch what they need:
+    #
+    # <name>\0idx\0<field>               Tokens, each preceded by "\0".
+    # <name>\0idx\0<field>\0<token>      Record IDs, each preceded by "\0".
+    #
+    # Only the methods of this class keep indexes up-to-date; records written
+    # by Jx9 scripts are not indexed. Index records are never serialized
+    # with the database's codec.
+    cdef bytes _index_key(self, field=None):
+        cdef bytes key = encode(self.name) + b'\x00idx'
+        if field is not None:
+            key += b'\x00' + encode(field) + b'\x00'
+        return key
+
+    cdef list _indexes(self):
+        # The indexed fields are cached by the database handle, which clears
+        # the cache when a transaction is rolled back.
+        cdef list fields = self.unqlite.index_fields.get(self.name)
+        if fields is None:
+            try:
+                fields = json.loads(self.unqlite._fetch_raw(self._index_key()))
+            except KeyError:
+                fields = []
+            self.unqlite.index_fields[self.name] = fields
+        return fields
+
+    cpdef list indexes(self):
+        """Return the list of indexed fields."""
+        return list(self._indexes())
+
+    cdef bint _index_sorted(self):
+        return self.unqlite.ordered and self.unqlite.comparator == 'memcmp'
+
+    def _index_keys(self, bytes prefix, bytes start=None):
+        # Yields the keys beginning with prefix in order, starting from start
+        # if given. Requires the ordered "btree" engine.
+        cdef Cursor cursor
+        cdef list batch
+        with self.unqlite.cursor() as cursor:
+            try:
+                cursor.seek(start or prefix, UNQLITE_CURSOR_MATCH_GE)
+            except KeyError:
+                return
+            while True:
+                batch = cursor.fetch_batch(100, True, False)
+                if not batch:
+                    return
+                for key in batch:
+                    key = encode(key)
+                    if not key.startswith(prefix):
+                        return
+                    yield key
+
+    def create_index(self, field):
+        """
+        Index the given field, so records can be looked up by its value using
+        `find()`. Existing records are indexed immediately. Returns False if
+        the field is already indexed.
+        """
+        cdef list fields = self._indexes()
+        if field in fields:
+            return False
+
+        fields = fields + [field]
+        with self.unqlite._atomic():
+            for record in self.iterator():
+                if isinstance(record, dict):
+                    self._index_record([field], record['__id'], record, True)
+            self.unqlite._store_raw(self._index_key(),
+                                    encode(json.dumps(fields)))
+        self.unqlite.index_fields[self.name] = fields
+        return True
+
+    def drop_index(self, field):
+        """Remove the index on the given field."""
+        cdef list fields = self._indexes()
+        if field not in fields:
+            return False
+
+        fields = [f for f in fields if f != field]
+        with self.unqlite._atomic():
+            if self._index_sorted():
+                keys = list(self._index_keys(self._index_key(field)))
+            else:
+                keys = [self._index_key(field) + token
+                        for token in self._index_tokens(field)]
+                keys.append(self._index_key(field)[:-1])
+            for key in keys:
+                try:
+                    self.unqlite.delete(key)
+                except KeyError:
+                    pass
+            if fields:
+                self.unqlite._store_raw(self._index_key(),
+                                        encode(json.dumps(fields)))
+            else:
+                self.unqlite.delete(self._index_key())
+        self.unqlite.index_fields[self.name] = fields
+        return True
+
+    cdef list _index_tokens(self, field):
+        # Returns the tokens in a field's directory, see above.
+        try:
+            return self.unqlite._fetch_raw(
+                self._index_key(field)[:-1]).split(b'\x00')[1:]
+        except KeyError:
+            return []
+
+    cdef _index_record(self, list fields, record_id, record, bint add):
+        cdef bytes entry = b'\x00' + encode(str(record_id))
+        cdef bint is_sorted = self._index_sorted()
+        cdef bytes key, token
+
+        if not isinstance(record, dict):
+            return
+
+        for field in fields:
+            if field not in record:
+                continue
+            token = index_token(record[field])
+            if token is None:
+                continue
+
+            key = self._index_key(field) + token
+            if is_sorted:
+                if add:
+                    self.unqlite._store_raw(key + entry, b'')
+                else:
+                    try:
+                        self.unqlite.delete(key + entry)
+                    except KeyError:
+                        pass
+            elif add:
+                if not self.unqlite.exists(key):
+                    self.unqlite._append_raw(self._index_key(field)[:-1],
+                                             b'\x00' + token)
+                self.unqlite._append_raw(key, entry)
+            else:
+                self._index_remove(key, entry)
+                if not self.unqlite.exists(key):
+                    self._index_remove(self._index_key(field)[:-1],
+                                       b'\x00' + token)
+
+    cdef _index_remove(self, bytes key, bytes entry):
+        # Removes an entry from a list of record IDs or tokens, deleting the
+        # key once the list is empty.
+        cdef bytes value
+        try:
+            value = self.unqlite._fetch_raw(key) + b'\x00'
+        except KeyError:
+            return
+        value = value.replace(entry + b'\x00', b'\x00', 1)[:-1]
+        if value:
+            self.unqlite._store_raw(key, value)
+        else:
+            self.unqlite.delete(key)
+
+    cdef set _index_lookup(self, field, op, value):
+        cdef bytes prefix = self._index_key(field)
+        cdef set ids = set()
+        cdef set tokens
+        cdef bytes key, token, start, bound, entries
+
+        if op == 'eq' or op == 'in':
+            tokens = set([index_token(item)
+                          for item in ([value] if op == 'eq' else value)])
+            tokens.discard(None)
+        elif not self._index_sorted():
+            # Range lookups check each of the field's tokens of the same
+            # type as the value.
+            token = index_token(value)
+            tokens = set([t for t in self._index_tokens(field)
+                          if t[:1] == token[:1] and
+                          index_value_matches(index_value(t), op, value)])
+        else:
+            # Range lookups visit the tokens of the same type as the value,
+            # from the lower bound if there is one, until a token sorts after
+            # the upper bound. Numbers are compared by their double, as ints
+            # that share a double are not ordered by their decimal suffix.
+            token = index_token(value)
+            bound = token[:17] if token[:1] == b'n' else token
+            start = prefix + (bound if op in ('gt', 'gte') else token[:1])
+            for key in self._index_keys(prefix + token[:1], start):
+                token, _, record_id = key[len(prefix):].rpartition(b'\x00')
+                if index_value_matches(index_value(token), op, value):
+                    ids.add(int(record_id))
+                elif op in ('lt', 'lte') and token[:len(bound)] > bound:
+                    break
+            return ids
+
+        if self._index_sorted():
+            for token in tokens:
+                start = prefix + token + b'\x00'
+                for key in self._index_keys(start):
+                    ids.add(int(key[len(start):]))
+            return ids
+        for token in tokens:
+            try:
+                entries = self.unqlite._fetch_raw(prefix + token)
+            except KeyError:
+                continue
+            ids.update([int(record_id)
+                        for record_id in entries.split(b'\x00')[1:]])
+        return ids
+
+    def _fetch_ids(self, record_ids):
+        return self._simple_read(
+            '$ret = []; foreach ($ids as $id) { '
+            '$rec = db_fetch_by_id($collection, $id); '
+            'if (!is_null($rec)) { $ret[] = $rec; } }',
+            ids=list(record_ids))
+
+    def find(self, **lookups):
+        """
+        Return the records matching the given lookups using secondary
+        indexes. Lookups take the form field=value or field__op=value, where
+        op is one of eq, in, lt, lte, gt or gte, and each field must be
+        indexed. All lookups must match.
+        """
+        cdef list fields = self._indexes()
+        cdef set ids = None, matches
+
+        for key, value in lookups.items():
+            field, _, op = key.rpartition('__')
+            if not field or (op not in INDEX_RANGE_OPERATORS and
+                             op not in ('eq', 'in')):
+                field, op = key, 'eq'
+            if field not in fields:
+                raise ValueError('No index on field "%s".' % field)
+            if op in INDEX_RANGE_OPERATORS and (
+                    isinstance(value, bool) or
+                    not isinstance(value, (basestring, int, float))):
+                raise ValueError('Range lookups require a number or string.')
+
+            matches = self._index_lookup(field, op, value)
+            ids = matches if ids is None else ids & matches
+
+        if ids is None:
+            return self.all()
+        return self._fetch_ids(sorted(ids))
+
     def create(self):
         """
         Create the named collection.
@@ -1308,28 +4680,31 @@ cdef class Collection(object):
 
     def drop(self):
         """Drop the collection and all associated records."""
-        return self._simple_execute('if (db_exists($collection)) { '
-                                    '$ret = db_drop_collection($collection); }'
-                                    'else { $ret = false; }')
+        ret = self._simple_execute('if (db_exists($collection)) { '
+                                   '$ret = db_drop_collection($collection); }'
+                                   'else { $ret = false; }')
+        for field in self.indexes():
+            self.drop_index(field)
+        return ret
 
     def exists(self):
         """Return boolean indicating whether the collection exists."""
-        return self._simple_execute('$ret = db_exists($collection);')
+        return self._simple_read('$ret = db_exists($collection);')
 
     def last_record_id(self):
         """Return the ID of the last document to be stored."""
-        return self._simple_execute('$ret = db_last_record_id($collection);')
+        return self._simple_read('$ret = db_last_record_id($collection);')
 
     def current_record_id(self):
         """Return the ID of the current JSON document."""
-        return self._simple_execute(
-            '$ret = db_current_record_id($collection);')
+        return self._run('$ret = db_current_record_id($collection);', {},
+                         False, None, False, False)
 
     def reset_cursor(self):
         self._execute('db_reset_record_cursor($collection);')
 
     def creation_date(self):
-        return self._simple_execute('$ret = db_creation_date($collection);')
+        return self._simple_read('$ret = db_creation_date($collection);')
 
     def set_schema(self, _schema=None, **kwargs):
         schema = _schema or {}
@@ -1338,43 +4713,153 @@ cdef class Collection(object):
             '$ret = db_set_schema($collection, $schema);', schema=schema)
 
     def get_schema(self):
-        return self._simple_execute('$ret = db_get_schema($collection);')
+        return self._simple_read('$ret = db_get_schema($collection);')
 
     def __len__(self):
         """Return the number of records in the document collection."""
-        return self._simple_execute('$ret = db_total_records($collection);')
+        return self._simple_read('$ret = db_total_records($collection);')
 
     def delete(self, record_id):
         """Delete the document associated with the given ID."""
+        cdef list fields = self._indexes()
         script = '$ret = db_drop_record($collection, $record_id);'
-        return self._simple_execute(script, record_id=record_id)
+        if not fields:
+            return self._simple_execute(script, record_id=record_id)
+
+        with self.unqlite._atomic():
+            old = self.fetch(record_id)
+            ret = self._simple_execute(script, record_id=record_id)
+            if ret and old is not None:
+                self._index_record(fields, record_id, old, False)
+        return ret
 
-    def fetch(self, record_id):
-        """Fetch the document associated with the given ID."""
+    def fetch(self, record_id, fields=None, raw=False):
+        """
+        Fetch the document associated with the given ID, optionally
+        converting only the given fields, or returning it as JSON if `raw`
+        is true.
+        """
         script = '$ret = db_fetch_by_id($collection, $record_id);'
-        return self._simple_execute(script, record_id=record_id)
+        return self._run(script, {'record_id': record_id}, False, fields,
+                         raw)
 
     def store(self, record, return_id=True):
         """
         Create a new JSON document in the collection, optionally returning
         the new record's ID.
         """
+        cdef list fields = self._indexes()
+        if not fields:
+            return self._store(record, return_id)
+
+        with self.unqlite._atomic():
+            if isinstance(record, list):
+                ids = self.store_many(record)
+                if not return_id:
+                    return True
+                elif not ids:
+                    raise ValueError('Error fetching return value from '
+                                     'script.')
+                return ids[-1]
+
+            record_id = self._store(record, True)
+            self._index_record(fields, record_id, record, True)
+        return record_id if return_id else True
+
+    def _store(self, record, return_id):
         if return_id:
             script = ('if (db_store($collection, $record)) { '
-                      '$ret = db_last_record_id($collection); }')
+                      '$ret = db_last_record_id($collection); } '
+                      'else { $ret = null; }')
+            ret = self._simple_execute(script, record=record)
+            if ret is None:
+                raise ValueError('Error fetching return value from script.')
+            return ret
         else:
             script = '$ret = db_store($collection, $record);'
-        return self._simple_execute(script, record=record)
+            return self._simple_execute(script, record=record)
+
+    def store_many(self, records, chunk_size=1000):
+        """
+        Store an iterable of JSON documents, converting and storing up to
+        `chunk_size` documents per VM execution, all inside a single
+        transaction. Returns the IDs assigned to the new records (as a range
+        when they are contiguous).
+        """
+        cdef list chunk
+        cdef VM vm
+
+        if chunk_size < 1:
+            raise ValueError('chunk_size must be at least 1.')
+
+        # Returns the last ID and the number of records stored, which may
+        # differ from the size of the chunk if any record was a JSON array.
+        script = ('$n = db_total_records($collection); '
+                  'if (db_store($collection, $records)) { '
+                  '$ret = [db_last_record_id($collection), '
+                  'db_total_records($collection) - $n]; } '
+                  'else { $ret = null; }')
+
+        ids = range(0)
+        iterator = iter(records)
+        fields = self._indexes()
+        with self.unqlite._atomic():
+            while True:
+                chunk = list(islice(iterator, chunk_size))
+                if not chunk:
+                    break
+
+                # A fresh VM per chunk, as UnQLite caches every stored record
+                # in the VM that stored it.
+                with VM(self.unqlite, script) as vm:
+                    vm['collection'] = self.name
+                    vm['records'] = chunk
+                    vm.execute()
+                    ret = vm['ret']
+                if ret is None:
+                    raise ValueError('Error storing records in collection.')
+
+                last, n = ret
+                first = last - n + 1
+                if fields:
+                    if n == len(chunk):
+                        for record_id, record in enumerate(chunk, first):
+                            self._index_record(fields, record_id, record, True)
+                    else:
+                        # Some records were JSON arrays and were expanded.
+                        for record in self._fetch_ids(range(first, last + 1)):
+                            self._index_record(fields, record['__id'], record,
+                                               True)
+                if isinstance(ids, range) and (not ids or ids.stop == first):
+                    ids = range(ids.start if ids else first, last + 1)
+                else:
+                    ids = list(ids)
+                    ids.extend(range(first, last + 1))
+        return ids
 
     def update(self, record_id, record):
         """
         Update the record identified by the given ID.
         """
+        cdef list fields = self._indexes()
         script = '$ret = db_update_record($collection, $record_id, $record);'
-        return self._simple_execute(script, record_id=record_id, record=record)
+        if not fields:
+            return self._simple_execute(script, record_id=record_id,
+                                        record=record)
+
+        with self.unqlite._atomic():
+            old = self.fetch(record_id)
+            ret = self._simple_execute(script, record_id=record_id,
+                                       record=record)
+            if ret:
+                if old is not None:
+                    self._index_record(fields, record_id, old, False)
+                self._index_record(fields, record_id, record, True)
+        return ret
 
     def fetch_current(self):
-        return self._simple_execute('$ret = db_fetch($collection);')
+        return self._run('$ret = db_fetch($collection);', {}, False, None,
+                         False, False)
 
     def __delitem__(self, record_id):
         self.delete(record_id)
@@ -1386,10 +4871,10 @@ cdef class Collection(object):
         self.update(record_id, record)
 
     def error_log(self):
-        return self._simple_execute('$ret = db_errlog();')
+        return self._simple_read('$ret = db_errlog();')
 
-    def iterator(self):
-        return CollectionIterator(self)
+    def iterator(self, batch_size=100, fields=None):
+        return CollectionIterator(self, batch_size, fields)
 
     def __iter__(self):
         return iter(CollectionIterator(self))
@@ -1400,71 +4885,596 @@ cdef class CollectionIterator(object):
         VM vm
         UnQLite unqlite
         bint done
+        list rows
+        Py_ssize_t idx
+        readonly int batch_size
+        readonly object fields
         public Collection collection
 
-    def __init__(self, Collection collection):
+    def __init__(self, Collection collection, int batch_size=100,
+                 fields=None):
+        if batch_size < 1:
+            raise ValueError('batch_size must be at least 1.')
         self.collection = collection
         self.unqlite = self.collection.unqlite
+        self.batch_size = batch_size
+        self.fields = fields
         self.vm = None
         self.done = True
+        self.rows = []
+        self.idx = 0
 
     def __iter__(self):
         if self.vm is not None:
             self.vm.close()
 
-        script = '$row = db_fetch($collection)'
+        # Fetch up to $n rows per execution, so the cost of running the VM
+        # and converting the result is spread across a batch of rows.
+        script = ('$rows = []; $i = 0; '
+                  'while ($i < $n) { '
+                  '$row = db_fetch($collection); '
+                  'if (is_null($row)) { break; } '
+                  '$rows[] = $row; $i++; }')
         self.vm = VM(self.unqlite, script)
+        self.vm.managed = True  # Read-only.
         self.vm.compile()
         self.vm['collection'] = self.collection.name
+        self.vm['n'] = self.batch_size
         self.done = False
+        self.rows = []
+        self.idx = 0
         return self
 
     def __next__(self):
-        if self.done:
+        if self.idx < len(self.rows):
+            row = self.rows[self.idx]
+            self.idx += 1
+            return row
+        elif self.done:
             raise StopIteration
 
         self.vm.execute()
-        row = self.vm['row']
-        if row is None:
+        self.rows = self.vm.get_value('rows', self.fields)
+        self.idx = 0
+        if len(self.rows) < self.batch_size:
+            # Short batch, collection is exhausted.
             self.done = True
             self.vm.close()
             self.vm = None
+        else:
+            self.vm.reset()
+
+        if not self.rows:
             raise StopIteration
+        self.idx = 1
+        return self.rows[0]
+
+
+# Operations queued for the I/O thread of an AsyncUnQLite.
+cdef enum:
+    AIO_FETCH = 0
+    AIO_EXISTS = 1
+    AIO_READ = 2      # Read-only call, e.g. fetching a batch from a cursor.
+    AIO_STORE = 3
+    AIO_APPEND = 4
+    AIO_DELETE = 5
+    AIO_CALL = 6      # Call that may write, e.g. a Collection method.
+    AIO_BEGIN = 7
+    AIO_COMMIT = 8
+    AIO_ROLLBACK = 9
+    AIO_CLOSE = 10
+
+cdef object aio_missing = object()
+
+# Transaction opened by AsyncUnQLite.begin() in the current task. Tasks
+# created while it is open inherit it, and their operations are part of the
+# transaction; operations queued from other tasks wait for it to finish.
+aio_transaction = contextvars.ContextVar('unqlite_transaction',
+                                         default=None)
+
+
+def _aio_settle(list results):
+    # Runs on the event loop: complete the futures of a processed batch.
+    for fut, ok, value in results:
+        if fut.cancelled():
+            continue
+        elif ok:
+            fut.set_result(value)
+        else:
+            fut.set_exception(value)
+
+
+def _aio_open_cursor(UnQLite db):
+    cursor = db.cursor()
+    cursor.reset()
+    return cursor
+
+
+def _aio_open_iterator(Collection collection, batch_size, fields):
+    return iter(collection.iterator(batch_size, fields))
+
+
+def _aio_next_batch(CollectionIterator it, Py_ssize_t n):
+    # Not islice(): calling iter() on a CollectionIterator restarts it.
+    cdef list batch = []
+    while len(batch) < n:
+        try:
+            batch.append(next(it))
+        except StopIteration:
+            break
+    return batch
+
+
+cdef class AsyncUnQLite(object):
+    """
+    asyncio front-end for an UnQLite database. Every operation is queued to
+    a dedicated I/O thread, which processes whatever has accumulated in the
+    queue as a batch: consecutive fetches and stores are performed with a
+    single call into the library, and the writes of a batch share one
+    transaction. The futures of a batch are completed with one wake-up of
+    the event loop.
+    """
+    cdef readonly UnQLite unqlite
+    cdef readonly bint group_commit
+    cdef readonly int max_batch
+    cdef object queue
+    cdef object thread
+    cdef bint closing
+    # Token identifying the explicit transaction in progress, or None.
+    # Batches are not committed automatically during a transaction, and the
+    # operations of tasks outside it are held until it is finished.
+    cdef object open_transaction
+    cdef list held
+
+    def __init__(self, filename=':mem:', *args, group_commit=True,
+                 max_batch=256, **kwargs):
+        if max_batch < 1:
+            raise ValueError('max_batch must be at least 1.')
+        self.unqlite = UnQLite(filename, *args, **kwargs)
+        self.group_commit = group_commit
+        self.max_batch = max_batch
+        self.queue = queue.SimpleQueue()
+        self.closing = False
+        self.open_transaction = None
+        self.held = []
+        self.thread = threading.Thread(target=self._run,
+                                       name='unqlite-io', daemon=True)
+        self.thread.start()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    cdef _submit(self, int kind, args):
+        if self.closing:
+            raise UnQLiteError('Database is closed.')
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self.queue.put((kind, args, loop, fut, aio_transaction.get()))
+        return fut
+
+    def fetch(self, key):
+        """Retrieve the value at the given key. Returns an awaitable."""
+        return self._submit(AIO_FETCH, key)
+
+    def store(self, key, value):
+        """Store key/value. Returns an awaitable."""
+        return self._submit(AIO_STORE, (key, value))
+
+    def append(self, key, value):
+        """Append to the value stored at the given key. Returns an awaitable."""
+        return self._submit(AIO_APPEND, (key, value))
+
+    def delete(self, key):
+        """Delete the value stored at the given key. Returns an awaitable."""
+        return self._submit(AIO_DELETE, key)
+
+    def exists(self, key):
+        """Check whether the given key exists. Returns an awaitable."""
+        return self._submit(AIO_EXISTS, key)
+
+    async def get(self, key, default=None):
+        try:
+            return await self.fetch(key)
+        except KeyError:
+            return default
+
+    def run(self, fn, *args, **kwargs):
+        """
+        Call `fn(db, *args, **kwargs)` on the I/O thread, where `db` is the
+        underlying UnQLite object. Returns an awaitable.
+        """
+        return self._submit(AIO_CALL, (fn, (self.unqlite,) + args, kwargs))
+
+    def begin(self):
+        # A transaction begun again by its own task keeps its token.
+        token = aio_transaction.get()
+        if token is None or token is not self.open_transaction:
+            token = object()
+            aio_transaction.set(token)
+        return self._submit(AIO_BEGIN, token)
+
+    def commit(self):
+        return self._submit(AIO_COMMIT, None)
+
+    def rollback(self):
+        return self._submit(AIO_ROLLBACK, None)
+
+    def transaction(self):
+        """Create an asynchronous context manager wrapping a transaction."""
+        return AsyncTransaction(self)
+
+    def keys(self, int batch_size=100):
+        """Asynchronously iterate through the database's keys."""
+        return self._iterate(batch_size, True, False)
+
+    def values(self, int batch_size=100):
+        """Asynchronously iterate through the database's values."""
+        return self._iterate(batch_size, False, True)
+
+    def items(self, int batch_size=100):
+        """Asynchronously iterate through the database's key/value pairs."""
+        return self._iterate(batch_size, True, True)
+
+    def __aiter__(self):
+        return self._iterate(100, True, True)
+
+    async def _iterate(self, int batch_size, bint keys, bint values):
+        cdef Cursor cursor
+        cdef list batch
+        cursor = await self._submit(AIO_READ, (_aio_open_cursor,
+                                               (self.unqlite,), None))
+        while True:
+            batch = await self._submit(AIO_READ, (
+                cursor.fetch_batch, (batch_size, keys, values), None))
+            if not batch:
+                break
+            for item in batch:
+                yield item
+
+    def collection(self, name):
+        """Create a wrapper for working with Jx9 collections."""
+        return AsyncCollection(self, name)
+
+    async def close(self):
+        """
+        Close the database once the operations queued so far have been
+        processed, and stop the I/O thread.
+        """
+        if self.closing:
+            return False
+        fut = self._submit(AIO_CLOSE, None)
+        self.closing = True
+        return await fut
+
+    def _run(self):
+        cdef list batch
+        cdef bint done = False
+        q = self.queue
+        while not done:
+            batch = [q.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(q.get_nowait())
+                except queue.Empty:
+                    break
+            done = self._process(batch)
+
+        # Fail anything held or queued concurrently with close().
+        batch = [(op[2], op[3], False, UnQLiteError('Database is closed.'))
+                 for op in self.held]
+        self.held = []
+        while True:
+            try:
+                op = q.get_nowait()
+            except queue.Empty:
+                break
+            batch.append((op[2], op[3], False,
+                          UnQLiteError('Database is closed.')))
+        self._complete(batch)
+
+    cdef bint _process(self, list batch) except -1:
+        # Split the batch at transaction and close requests, which apply to
+        # the operations queued before them.
+        cdef list results = []
+        cdef list segment = []
+        cdef bint done = False
+        cdef Py_ssize_t i = 0
+        cdef int kind
+        while i < len(batch):
+            op = batch[i]
+            i += 1
+            kind = op[0]
+            if self.open_transaction is not None and kind != AIO_CLOSE \
+                    and op[4] is not self.open_transaction:
+                # Operations of other tasks are neither visible to the
+                # transaction nor rolled back with it.
+                self.held.append(op)
+                continue
+            if kind < AIO_BEGIN:
+                segment.append(op)
+                continue
+            if segment:
+                self._run_segment(segment, results)
+                segment = []
+            results.append(self._run_control(op))
+            if kind == AIO_CLOSE:
+                done = True
+                break
+            if self.open_transaction is None and self.held:
+                batch[i:i] = self.held
+                self.held = []
+        if segment:
+            self._run_segment(segment, results)
+        self._complete(results)
+        return done
+
+    cdef tuple _run_control(self, tuple op):
+        cdef int kind = op[0]
+        cdef UnQLite db = self.unqlite
+        try:
+            if kind == AIO_BEGIN:
+                value = db.begin()
+                self.open_transaction = op[1]
+            elif kind == AIO_COMMIT:
+                try:
+                    value = db.commit()
+                finally:
+                    self.open_transaction = None
+            elif kind == AIO_ROLLBACK:
+                self.open_transaction = None
+                value = db.rollback()
+            else:
+                value = db.close()
+        except Exception as exc:
+            return (op[2], op[3], False, exc)
+        return (op[2], op[3], True, value)
+
+    cdef _run_segment(self, list ops, list results):
+        cdef UnQLite db = self.unqlite
+        cdef Py_ssize_t i = 0, j, n = len(ops), start = len(results)
+        cdef bint auto = False
+        cdef int kind
+
+        if self.group_commit and self.open_transaction is None and \
+                not db._is_private() and \
+                not (db.flags & UNQLITE_OPEN_READONLY):
+            for op in ops:
+                if op[0] >= AIO_STORE:
+                    auto = True
+                    break
+        if auto:
+            try:
+                db.begin()
+            except Exception as exc:
+                for op in ops:
+                    results.append((op[2], op[3], False, exc))
+                return
+
+        while i < n:
+            kind = ops[i][0]
+            j = i + 1
+            if kind == AIO_FETCH or kind == AIO_STORE:
+                while j < n and ops[j][0] == kind:
+                    j += 1
+            if kind == AIO_FETCH and j - i > 1:
+                self._fetch_run(ops[i:j], results)
+            elif kind == AIO_STORE and j - i > 1:
+                self._store_run(ops[i:j], results)
+            else:
+                results.append(self._run_op(ops[i]))
+            i = j
+
+        if auto:
+            try:
+                db.commit()
+            except Exception as exc:
+                db.rollback()
+                # Writes of the batch were lost.
+                for i in range(n):
+                    if ops[i][0] >= AIO_STORE:
+                        results[start + i] = (ops[i][2], ops[i][3], False, exc)
+
+    cdef tuple _run_op(self, tuple op):
+        cdef int kind = op[0]
+        cdef UnQLite db = self.unqlite
+        args = op[1]
+        try:
+            if kind == AIO_FETCH:
+                value = db.fetch(args)
+            elif kind == AIO_EXISTS:
+                value = db.exists(args)
+            elif kind == AIO_STORE:
+                value = db.store(args[0], args[1])
+            elif kind == AIO_APPEND:
+                value = db.append(args[0], args[1])
+            elif kind == AIO_DELETE:
+                value = db.delete(args)
+            else:
+                fn, fn_args, fn_kwargs = args
+                value = fn(*fn_args, **(fn_kwargs or {}))
+        except Exception as exc:
+            return (op[2], op[3], False, exc)
+        return (op[2], op[3], True, value)
+
+    cdef _fetch_run(self, list ops, list results):
+        # All lookups are performed in one call, without the GIL.
+        cdef list values
+        try:
+            values = self.unqlite.fetch_many([op[1] for op in ops],
+                                             aio_missing)
+        except Exception:
+            for op in ops:
+                results.append(self._run_op(op))
+            return
+        for op, value in zip(ops, values):
+            if value is aio_missing:
+                results.append((op[2], op[3], False,
+                                KeyError('key not found')))
+            else:
+                results.append((op[2], op[3], True, value))
+
+    cdef _store_run(self, list ops, list results):
+        try:
+            self.unqlite._store_batch([op[1] for op in ops])
+        except Exception:
+            # The batch stops at the first failure; storing the same values
+            # again is harmless and tells which of the writes failed.
+            for op in ops:
+                results.append(self._run_op(op))
+            return
+        for op in ops:
+            results.append((op[2], op[3], True, None))
+
+    cdef _complete(self, list results):
+        # One call_soon_threadsafe() per event loop and batch.
+        cdef dict by_loop = {}
+        for loop, fut, ok, value in results:
+            if fut is not None:
+                by_loop.setdefault(loop, []).append((fut, ok, value))
+        for loop, items in by_loop.items():
+            try:
+                loop.call_soon_threadsafe(_aio_settle, items)
+            except RuntimeError:
+                pass  # Event loop is closed.
+
+
+cdef class AsyncTransaction(object):
+    """Expose a transaction as an asynchronous context manager."""
+    cdef AsyncUnQLite db
+
+    def __init__(self, AsyncUnQLite db):
+        self.db = db
+
+    async def __aenter__(self):
+        await self.db.begin()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if exc_type:
+            await self.db.rollback()
+        else:
+            try:
+                await self.db.commit()
+            except Exception:
+                await self.db.rollback()
+                raise
+
+
+cdef class AsyncCollection(object):
+    """
+    Asynchronous wrapper for a Collection. Every Collection method is
+    available as a method returning an awaitable, and records can be
+    iterated over with `async for`.
+    """
+    cdef readonly AsyncUnQLite db
+    cdef readonly Collection collection
+
+    def __init__(self, AsyncUnQLite db, name):
+        self.db = db
+        self.collection = Collection(db.unqlite, name)
+
+    def __getattr__(self, attr):
+        method = getattr(self.collection, attr)
+        if not callable(method) or attr.startswith('_'):
+            raise AttributeError(attr)
+
+        def submit(*args, **kwargs):
+            return self.db._submit(AIO_CALL, (method, args, kwargs))
+        return submit
+
+    def __aiter__(self):
+        return self.iterator()
+
+    async def iterator(self, int batch_size=100, fields=None):
+        cdef list batch
+        it = await self.db._submit(AIO_READ, (
+            _aio_open_iterator, (self.collection, batch_size, fields), None))
+        while True:
+            batch = await self.db._submit(AIO_READ, (
+                _aio_next_batch, (it, batch_size), None))
+            if not batch:
+                break
+            for item in batch:
+                yield item
+            if len(batch) < batch_size:
+                break
+
+
+# Dictionary keys are decoded through a small cache, so the keys shared by
+# every record in a collection are decoded once and the resulting strings
+# are shared (which also means their hash is only computed once).
+cdef enum:
+    KEY_CACHE_SIZE = 512
+    KEY_CACHE_MAX_LENGTH = 64
+
+cdef list key_cache = [None] * KEY_CACHE_SIZE
+
+cdef object cached_key(const char *buf, int nbytes):
+    cdef unsigned int h = 2166136261u
+    cdef unsigned int slot
+    cdef const char *cached
+    cdef Py_ssize_t ncached
+    cdef int i
+
+    if nbytes > KEY_CACHE_MAX_LENGTH:
+        return decode_key(buf, nbytes)
 
-        self.vm.reset()
-        return row
+    # FNV-1a.
+    for i in range(nbytes):
+        h = (h ^ <unsigned char>buf[i]) * 16777619u
+    slot = h % KEY_CACHE_SIZE
+
+    key = key_cache[slot]
+    if key is not None:
+        cached = PyUnicode_AsUTF8AndSize(key, &ncached)
+        if ncached == nbytes and memcmp(cached, buf, nbytes) == 0:
+            return key
+
+    key = decode_key(buf, nbytes)
+    if PyUnicode_CheckExact(key):
+        key_cache[slot] = key
+    return key
+
+
+cdef struct walk_state:
+    PyObject *container
+    Py_ssize_t index
 
 
 cdef unqlite_value_to_python(unqlite_value *ptr):
     cdef list json_array
     cdef dict json_object
+    cdef walk_state state
     cdef const char *buf
     cdef int nbytes
-    cdef bytes bytestring
+    cdef Py_ssize_t count
 
-    if unqlite_value_is_json_object(ptr):
+    # Ordered by how common each type is in typical documents. Objects must
+    # be tested before arrays, as Jx9 objects are also arrays.
+    if unqlite_value_is_string(ptr):
+        buf = unqlite_value_to_string(ptr, &nbytes)
+        return decode_key(buf, nbytes)
+    elif unqlite_value_is_int(ptr):
+        return unqlite_value_to_int64(ptr)
+    elif unqlite_value_is_json_object(ptr):
         json_object = {}
-        unqlite_array_walk(
-            ptr,
-            unqlite_value_to_dict,
-            <void *>json_object)
+        state.container = <PyObject *>json_object
+        state.index = 0
+        unqlite_array_walk(ptr, unqlite_value_to_dict, &state)
         return json_object
     elif unqlite_value_is_json_array(ptr):
-        json_array = []
-        unqlite_array_walk(
-            ptr,
-            unqlite_value_to_list,
-            <void *>json_array)
+        count = unqlite_array_count(ptr)
+        json_array = PyList_New(count)
+        state.container = <PyObject *>json_array
+        state.index = 0
+        unqlite_array_walk(ptr, unqlite_value_to_list, &state)
+        if state.index < count:
+            # Walk was interrupted, discard the unused slots.
+            del json_array[state.index:]
         return json_array
-    elif unqlite_value_is_string(ptr):
-        buf = unqlite_value_to_string(ptr, &nbytes)
-        bytestring = buf[:nbytes]
-        try:
-            return decode(bytestring)
-        except UnicodeDecodeError:
-            return bytestring
-    elif unqlite_value_is_int(ptr):
-        return unqlite_value_to_int64(ptr)
     elif unqlite_value_is_float(ptr):
         return unqlite_value_to_double(ptr)
     elif unqlite_value_is_bool(ptr):
@@ -1473,45 +5483,354 @@ cdef unqlite_value_to_python(unqlite_value *ptr):
         return None
     raise TypeError('Unrecognized type.')
 
-cdef python_to_unqlite_value(VM vm, unqlite_value *ptr, python_value):
-    cdef unqlite_value *item_ptr = <unqlite_value *>0
-    cdef bytes encoded_value
-
-    if isinstance(python_value, unicode):
-        encoded_value = encode(python_value)
-        unqlite_value_string(ptr, encoded_value, len(encoded_value))
-    elif isinstance(python_value, bytes):
-        unqlite_value_string(ptr, python_value, len(python_value))
-    elif isinstance(python_value, (list, tuple)):
-        for item in python_value:
-            item_ptr = vm.create_value(item)
-            unqlite_array_add_elem(ptr, NULL, item_ptr)
-            vm.release_value(item_ptr)
-    elif isinstance(python_value, dict):
-        for key, value in python_value.items():
-            encoded_value = encode(key)
-            item_ptr = vm.create_value(value)
-            unqlite_array_add_strkey_elem(
-                ptr,
-                <const char *>encoded_value,
-                item_ptr)
-            vm.release_value(item_ptr)
-    elif isinstance(python_value, bool):
-        unqlite_value_bool(ptr, python_value)
-    elif isinstance(python_value, int):
-        unqlite_value_int64(ptr, python_value)
-    elif isinstance(python_value, float):
-        unqlite_value_double(ptr, python_value)
-    else:
-        unqlite_value_null(ptr)
-
 cdef int unqlite_value_to_list(unqlite_value *key, unqlite_value *value, void *user_data) noexcept:
-    cdef list accum
-    accum = <list>user_data
-    accum.append(unqlite_value_to_python(value))
+    cdef walk_state *state = <walk_state *>user_data
+    cdef list accum = <list>state.container
+    item = unqlite_value_to_python(value)
+    if state.index < len(accum):
+        # Fill the pre-sized list. PyList_SET_ITEM steals a reference.
+        Py_INCREF(item)
+        PyList_SET_ITEM(accum, state.index, item)
+    else:
+        accum.append(item)
+    state.index += 1
 
 cdef int unqlite_value_to_dict(unqlite_value *key, unqlite_value *value, void *user_data) noexcept:
-    cdef dict accum
-    accum = <dict>user_data
-    pkey = unqlite_value_to_python(key)
+    cdef walk_state *state = <walk_state *>user_data
+    cdef dict accum = <dict>state.container
+    cdef const char *buf
+    cdef int nbytes
+
+    if unqlite_value_is_string(key):
+        buf = unqlite_value_to_string(key, &nbytes)
+        pkey = cached_key(buf, nbytes)
+    else:
+        pkey = unqlite_value_to_python(key)
     accum[pkey] = unqlite_value_to_python(value)
+
+
+cdef inline bint is_container(value):
+    cdef type t = type(value)
+    return t is dict or t is list or t is tuple or \
+        isinstance(value, (dict, list, tuple))
+
+cdef int python_to_unqlite_value(ValueFactory factory, unqlite_value *ptr,
+                                 python_value) except -1:
+    """
+    Convert a Python value into the given `unqlite_value`, which must be an
+    array if the value is a dict, list or tuple.
+    """
+    cdef unqlite_value *scalar
+    cdef bytes encoded_key
+
+    if not is_container(python_value):
+        set_scalar(ptr, python_value)
+        return 0
+
+    # A single scalar is re-used for every non-container item, as Jx9 copies
+    # the value when it is added to the array.
+    scalar = factory.create_scalar()
+    try:
+        if isinstance(python_value, dict):
+            for key, value in python_value.items():
+                encoded_key = encode(key)
+                add_item(factory, ptr, scalar, encoded_key, value)
+        else:
+            for value in python_value:
+                add_item(factory, ptr, scalar, None, value)
+    finally:
+        factory.release_value(scalar)
+    return 0
+
+cdef int add_item(ValueFactory factory, unqlite_value *array,
+                  unqlite_value *scalar, bytes key, value) except -1:
+    cdef unqlite_value *item_ptr
+
+    if is_container(value):
+        item_ptr = factory.create_array()
+        try:
+            python_to_unqlite_value(factory, item_ptr, value)
+            add_elem(array, key, item_ptr)
+        finally:
+            factory.release_value(item_ptr)
+    else:
+        set_scalar(scalar, value)
+        add_elem(array, key, scalar)
+    return 0
+
+cdef inline add_elem(unqlite_value *array, bytes key, unqlite_value *item):
+    if key is None:
+        unqlite_array_add_elem(array, NULL, item)
+    else:
+        unqlite_array_add_strkey_elem(array, <const char *>key, item)
+
+cdef int set_scalar(unqlite_value *ptr, value) except -1:
+    cdef type t = type(value)
+    cdef const char *buf
+    cdef Py_ssize_t nbytes
+
+    # Exact type checks first, falling back to isinstance() for subclasses.
+    if t is unicode or (t is not bytes and isinstance(value, unicode)):
+        buf = PyUnicode_AsUTF8AndSize(value, &nbytes)
+        # unqlite_value_string() appends, so reset strings being re-used.
+        unqlite_value_reset_string_cursor(ptr)
+        unqlite_value_string(ptr, buf, nbytes)
+    elif t is int and not isinstance(value, bool):
+        unqlite_value_int64(ptr, value)
+    elif t is float:
+        unqlite_value_double(ptr, value)
+    elif t is bool:
+        unqlite_value_bool(ptr, value)
+    elif value is None:
+        unqlite_value_null(ptr)
+    elif isinstance(value, bytes):
+        unqlite_value_reset_string_cursor(ptr)
+        unqlite_value_string(ptr, <bytes>value, len(<bytes>value))
+    elif isinstance(value, bool):
+        unqlite_value_bool(ptr, value)
+    elif isinstance(value, int):
+        unqlite_value_int64(ptr, value)
+    elif isinstance(value, float):
+        unqlite_value_double(ptr, value)
+    else:
+        unqlite_value_null(ptr)
+    return 0
+
+
+cdef tuple projection(fields):
+    """
+    Normalize a list of field names into (name, encoded name) pairs. The
+    record ID is always included.
+    """
+    cdef list accum = [(decode(field), encode(field)) for field in fields]
+    if not any(name == '__id' for name, _ in accum):
+        accum.append(('__id', b'__id'))
+    return tuple(accum)
+
+cdef project_value(unqlite_value *ptr, tuple fields):
+    """
+    Convert a JSON object, keeping only the given fields, or a JSON array,
+    projecting each of its elements. Other fields are never converted.
+    """
+    cdef dict json_object
+    cdef list json_array
+    cdef tuple state
+    cdef unqlite_value *item_ptr
+    cdef bytes encoded
+
+    if unqlite_value_is_json_object(ptr):
+        json_object = {}
+        for name, encoded in fields:
+            item_ptr = unqlite_array_fetch(ptr, encoded, len(encoded))
+            if item_ptr:
+                json_object[name] = unqlite_value_to_python(item_ptr)
+        return json_object
+    elif unqlite_value_is_json_array(ptr):
+        json_array = []
+        state = (json_array, fields)
+        unqlite_array_walk(
+            ptr,
+            unqlite_value_to_projected_list,
+            <void *>state)
+        return json_array
+    return unqlite_value_to_python(ptr)
+
+cdef int unqlite_value_to_projected_list(unqlite_value *key, unqlite_value *value, void *user_data) noexcept:
+    cdef tuple state = <tuple>user_data
+    cdef list accum = state[0]
+    accum.append(project_value_item(value, state[1]))
+
+cdef project_value_item(unqlite_value *ptr, tuple fields):
+    # Elements of a projected array are only projected if they are objects.
+    if unqlite_value_is_json_object(ptr):
+        return project_value(ptr, fields)
+    return unqlite_value_to_python(ptr)
+
+
+# Serialize values directly to JSON, without building Python objects. The
+# output is accumulated in a growable kv_buffer.
+cdef struct json_state:
+    kv_buffer *buf
+    PyObject *fields
+    int count
+    bint failed
+
+cdef inline int json_write(kv_buffer *buf, const char *data,
+                           Py_ssize_t nbytes) except -1:
+    if nbytes == 0:
+        return 0
+    elif buf.size + nbytes <= buf.capacity:
+        memcpy(buf.data + buf.size, data, nbytes)
+        buf.size += nbytes
+        buf.total += nbytes
+        return 0
+    kv_buffer_consumer(data, <unsigned int>nbytes, buf)
+    if buf.nomem:
+        raise MemoryError
+    return 0
+
+cdef int json_write_string(kv_buffer *buf, const char *data,
+                           int nbytes) except -1:
+    # Bytes that are not valid UTF-8 are replaced with U+FFFD, so that the
+    # output can always be parsed.
+    cdef char escape[7]
+    cdef unsigned char c
+    cdef int i = 0, n, start = 0
+
+    json_write(buf, '"', 1)
+    while i < nbytes:
+        c = <unsigned char>data[i]
+        if c >= 0x80:
+            n = utf8_sequence_length(<const unsigned char *>data + i,
+                                     nbytes - i)
+            if n:
+                i += n
+                continue
+            json_write(buf, data + start, i - start)
+            json_write(buf, b'\xef\xbf\xbd', 3)
+            i += 1
+            start = i
+            continue
+        elif c >= 0x20 and c != 0x22 and c != 0x5c:
+            i += 1
+            continue
+        json_write(buf, data + start, i - start)
+        if c == 0x22:
+            json_write(buf, '\\"', 2)
+        elif c == 0x5c:
+            json_write(buf, '\\\\', 2)
+        elif c == 0x0a:
+            json_write(buf, '\\n', 2)
+        elif c == 0x0d:
+            json_write(buf, '\\r', 2)
+        elif c == 0x09:
+            json_write(buf, '\\t', 2)
+        else:
+            snprintf(escape, 7, '\\u%04x', c)
+            json_write(buf, escape, 6)
+        i += 1
+        start = i
+    json_write(buf, data + start, nbytes - start)
+    json_write(buf, '"', 1)
+    return 0
+
+cdef int json_write_value(kv_buffer *buf, unqlite_value *ptr,
+                          fields) except -1:
+    cdef json_state state
+    cdef unqlite_value *item_ptr
+    cdef const char *data
+    cdef char *formatted
+    cdef char number[32]
+    cdef int nbytes
+    cdef double dval
+    cdef bytes encoded
+
+    if unqlite_value_is_string(ptr):
+        data = unqlite_value_to_string(ptr, &nbytes)
+        json_write_string(buf, data, nbytes)
+    elif unqlite_value_is_int(ptr):
+        nbytes = snprintf(number, 32, '%lld',
+                          <long long>unqlite_value_to_int64(ptr))
+        json_write(buf, number, nbytes)
+    elif unqlite_value_is_json_object(ptr) and fields is not None:
+        json_write(buf, '{', 1)
+        state.count = 0
+        for _, encoded in fields:
+            item_ptr = unqlite_array_fetch(ptr, encoded, len(encoded))
+            if not item_ptr:
+                continue
+            if state.count:
+                json_write(buf, ',', 1)
+            json_write_string(buf, encoded, len(encoded))
+            json_write(buf, ':', 1)
+            json_write_value(buf, item_ptr, None)
+            state.count += 1
+        json_write(buf, '}', 1)
+    elif unqlite_value_is_json_array(ptr):
+        state.buf = buf
+        state.fields = <PyObject *>fields
+        state.count = 0
+        state.failed = False
+        if unqlite_value_is_json_object(ptr):
+            json_write(buf, '{', 1)
+            unqlite_array_walk(ptr, json_write_object_item, &state)
+            json_write(buf, '}', 1)
+        else:
+            json_write(buf, '[', 1)
+            unqlite_array_walk(ptr, json_write_array_item, &state)
+            json_write(buf, ']', 1)
+        if state.failed:
+            raise MemoryError
+    elif unqlite_value_is_float(ptr):
+        dval = unqlite_value_to_double(ptr)
+        # Match the json module's handling of non-finite values.
+        if isnan(dval):
+            json_write(buf, 'NaN', 3)
+        elif isinf(dval):
+            if dval > 0:
+                json_write(buf, 'Infinity', 8)
+            else:
+                json_write(buf, '-Infinity', 9)
+        else:
+            formatted = PyOS_double_to_string(dval, b'r', 0,
+                                              Py_DTSF_ADD_DOT_0, NULL)
+            try:
+                json_write(buf, formatted, strlen(formatted))
+            finally:
+                PyMem_Free(formatted)
+    elif unqlite_value_is_bool(ptr):
+        if unqlite_value_to_bool(ptr):
+            json_write(buf, 'true', 4)
+        else:
+            json_write(buf, 'false', 5)
+    else:
+        json_write(buf, 'null', 4)
+    return 0
+
+cdef int json_write_array_item(unqlite_value *key, unqlite_value *value, void *user_data) noexcept:
+    cdef json_state *state = <json_state *>user_data
+    cdef object fields = <object>state.fields
+    try:
+        if state.count:
+            json_write(state.buf, ',', 1)
+        # Elements of a projected array are only projected if they are
+        # objects, as in project_value().
+        if unqlite_value_is_json_object(value):
+            json_write_value(state.buf, value, fields)
+        else:
+            json_write_value(state.buf, value, None)
+    except BaseException:
+        state.failed = True
+        return UNQLITE_ABORT
+    state.count += 1
+    return UNQLITE_OK
+
+cdef int json_write_object_item(unqlite_value *key, unqlite_value *value, void *user_data) noexcept:
+    cdef json_state *state = <json_state *>user_data
+    cdef const char *data
+    cdef int nbytes
+    try:
+        if state.count:
+            json_write(state.buf, ',', 1)
+        data = unqlite_value_to_string(key, &nbytes)
+        json_write_string(state.buf, data, nbytes)
+        json_write(state.buf, ':', 1)
+        json_write_value(state.buf, value, None)
+    except BaseException:
+        state.failed = True
+        return UNQLITE_ABORT
+    state.count += 1
+    return UNQLITE_OK
+
+cdef bytes unqlite_value_to_json(unqlite_value *ptr, tuple fields=None):
+    """
+    Serialize a value to UTF-8 encoded JSON. If `fields` is given, objects
+    (or the objects in an array) only include those fields.
+    """
+    cdef kv_buffer buf
+    kv_buffer_init(&buf, NULL, 0, True)
+    try:
+        json_write_value(&buf, ptr, fields)
+        return buf.data[:buf.size]
+    finally:
+        PyMem_RawFree(buf.data)